@@ -1,27 +1,41 @@
-from flask import Flask, render_template, request, redirect, url_for, flash, send_from_directory, session, jsonify
+from flask import Flask, render_template, request, redirect, url_for, flash, send_file, session, jsonify, Response, stream_with_context
 import os
+import json
+import base64
+import fcntl
+import shutil
+import mimetypes
 from datetime import datetime, timedelta
 from functools import wraps
-from bin.modules.db_manager import DBManager
+from bin.modules.db_manager import db
 from bin.modules.file_manager import FileManager
 from bin.modules.uploader import Uploader
-from bin.modules.downloader import Downloader
+from bin.modules.downloader import Downloader, disk_cache
+from bin.modules.job_queue import JobQueue
+from bin.modules import metrics
+from bin.modules.chunked_upload import ChunkedUploads
+from bin.modules.progress_broker import ProgressBroker
 from apscheduler.schedulers.background import BackgroundScheduler
 from werkzeug.formparser import parse_form_data
 import uuid
-import threading
-from bin.modules.url_downloader import URLDownloader
+from bin.modules.url_downloader import URLDownloader, torrent_ingest
 
 # Initialize managers
-db = DBManager()
 fm = FileManager()
 
 # Create Flask app
 app = Flask(__name__)
 app.secret_key = "your_secret_key_here"  # Replace with a secure key
 
-# Dictionary to track URL download tasks
-url_download_tasks = {}
+# Uploads and URL downloads run as durable jobs, visible from every worker.
+# Progress of jobs running in this process is pushed to /task/events
+# subscribers through the broker.
+progress_broker = ProgressBroker()
+jobs = JobQueue(db, progress_broker)
+# Resumable uploads, sent from the browser in parts of one chunk each
+chunked_uploads = ChunkedUploads(db, os.path.join(fm.base_path, "uploads"), fm.chunk_size * 1024 * 1024)
+# Files uploaded through /upload wait here, one folder each, for a worker
+staging_root = fm.create_path(os.path.join(fm.base_path, "staging"))
 
 # Ensure output directory exists (for merged files)
 if not os.path.exists(fm.output_path):
@@ -82,12 +96,114 @@ def logout():
 
 # ---- Main routes ----
 
+# Listing orders accepted by / and /api/files, and their files columns
+FILE_SORTS = {"name": "file_name", "size": "size", "uploaded": "uploaded_at"}
+FILES_PER_PAGE = 50
+
+def encode_cursor(record, sort):
+    # Opaque pointer to the last row of a page: its sort value and id
+    value = record[{"file_name": 1, "size": 5, "uploaded_at": 6}[sort]]
+    return base64.urlsafe_b64encode(json.dumps([value, record[0]]).encode()).decode()
+
+def decode_cursor(cursor):
+    try:
+        value, file_id = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        return value, int(file_id)
+    except Exception:
+        return None
+
+def list_user_files(user_id, args, limit):
+    # One page of the user's files for the sort/order/cursor query args
+    sort = args.get("sort", "uploaded")
+    if sort not in FILE_SORTS:
+        sort = "uploaded"
+    order = "asc" if args.get("order") == "asc" else "desc"
+    after = decode_cursor(args["cursor"]) if args.get("cursor") else None
+    # One extra row tells whether there is a next page
+    records = db.list_files(user_id, FILE_SORTS[sort], order == "desc", after, limit + 1)
+    next_cursor = encode_cursor(records[limit - 1], FILE_SORTS[sort]) if len(records) > limit else None
+    return records[:limit], sort, order, next_cursor
+
+@app.template_filter("filesize")
+def filesize(size):
+    size = float(size or 0)
+    for unit in ("B", "KB", "MB", "GB"):
+        if size < 1024:
+            return f"{size:.0f} {unit}" if unit == "B" else f"{size:.1f} {unit}"
+        size /= 1024
+    return f"{size:.1f} TB"
+
 @app.route("/")
 @login_required
 def index():
     user_id = session["user_id"]
-    files = db.get_files(user_id=user_id)
-    return render_template("index.html", files=files)
+    files, sort, order, next_cursor = list_user_files(user_id, request.args, FILES_PER_PAGE)
+    total_files, total_size = db.get_file_totals(user_id)
+    return render_template(
+        "index.html", files=files, sort=sort, order=order, next_cursor=next_cursor,
+        total_files=total_files, total_size=total_size,
+    )
+
+@app.route("/api/files")
+@login_required
+def api_files():
+    user_id = session["user_id"]
+    try:
+        limit = min(max(int(request.args.get("limit", FILES_PER_PAGE)), 1), 500)
+    except ValueError:
+        return jsonify({"error": "limit must be a number"}), 400
+    files, sort, order, next_cursor = list_user_files(user_id, request.args, limit)
+    total_files, total_size = db.get_file_totals(user_id)
+    return jsonify({
+        "files": [
+            {"name": record[1], "hash": record[2], "size": record[5], "uploaded_at": record[6] or None}
+            for record in files
+        ],
+        "sort": sort,
+        "order": order,
+        "next_cursor": next_cursor,
+        "total_files": total_files,
+        "total_size": total_size,
+    })
+
+@app.route("/api/tags")
+@login_required
+def api_tags():
+    return jsonify({"tags": [{"name": name, "count": count} for name, count in db.get_tag_counts(session["user_id"])]})
+
+@app.route("/api/files/<file_hash>/tags", methods=["PUT"])
+@login_required
+def api_file_tags(file_hash):
+    tags = (request.get_json(silent=True) or {}).get("tags")
+    if not isinstance(tags, list) or not all(isinstance(tag, str) for tag in tags):
+        return jsonify({"error": "tags must be a list of strings"}), 400
+    tags = db.set_file_tags(session["user_id"], file_hash, tags)
+    if tags is None:
+        return jsonify({"error": "File not found"}), 404
+    return jsonify({"hash": file_hash, "tags": tags})
+
+@app.route("/api/search")
+@login_required
+def api_search():
+    # ?q=words in names or tags&tags=a,b&mode=and|or
+    tags = [tag for tag in request.args.get("tags", "").split(",") if tag.strip()]
+    mode = request.args.get("mode", "and")
+    if mode not in ("and", "or"):
+        return jsonify({"error": "mode must be and or or"}), 400
+    try:
+        limit = min(max(int(request.args.get("limit", FILES_PER_PAGE)), 1), 500)
+    except ValueError:
+        return jsonify({"error": "limit must be a number"}), 400
+    records = db.search_files(session["user_id"], tags, mode == "and", request.args.get("q"), limit)
+    return jsonify({
+        "files": [
+            {
+                "name": record[1], "hash": record[2], "size": record[5], "uploaded_at": record[6] or None,
+                "tags": sorted(record[7].split("\x1f")) if record[7] else [],
+            }
+            for record in records
+        ],
+    })
 
 @app.route("/upload", methods=["GET", "POST"])
 @login_required
@@ -104,19 +220,18 @@ def upload():
             flash("No selected file")
             return redirect(request.url)
         
-        upload_path = os.path.join(fm.base_path, file_storage.filename)
+        # Stage the upload in its own folder so concurrent uploads of the same
+        # file name do not clash
+        staging_path = fm.create_path(os.path.join(staging_root, str(uuid.uuid4())))
+        upload_path = os.path.join(staging_path, file_storage.filename)
         # Stream the file to disk in small chunks
         with open(upload_path, "wb") as f:
             for chunk in iter(lambda: file_storage.stream.read(4096), b""):
                 f.write(chunk)
         
-        # Process the upload as before
-        uploader = Uploader(upload_path)
-        try:
-            uploader.run(user_id=session["user_id"])
-            flash("File uploaded and processed successfully.")
-        except Exception as e:
-            flash(str(e))
+        # Telegram upload happens on the ingest workers
+        jobs.submit("upload", session["user_id"], {"path": upload_path})
+        flash("File queued for processing.")
         return redirect(url_for("index"))
     return render_template("upload.html")
 
@@ -128,78 +243,179 @@ def upload_from_url():
         flash("No URL provided")
         return redirect(url_for("upload"))
     
-    # Generate task ID for tracking progress
-    task_id = str(uuid.uuid4())
-    url_download_tasks[task_id] = {
-        "progress": 0,
-        "status": "Starting download...",
-        "complete": False,
-        "success": False
-    }
-    
-    # Start download in background thread
-    thread = threading.Thread(
-        target=process_url_download,
-        args=(url, task_id, session["user_id"])
-    )
-    thread.daemon = True
-    thread.start()
-    
+    # The job ID doubles as the task ID for tracking progress
+    task_id = jobs.submit("url", session["user_id"], {"url": url}, status="Starting download...")
+    return jsonify({"task_id": task_id})
+
+@app.route("/uploads", methods=["POST"])
+@login_required
+def create_upload():
+    data = request.get_json(silent=True) or {}
+    file_name = os.path.basename(str(data.get("file_name") or ""))
+    size = data.get("size")
+    if not file_name or not isinstance(size, int) or size < 0:
+        return jsonify({"error": "file_name and size are required"}), 400
+    return jsonify(chunked_uploads.create(session["user_id"], file_name, size)), 201
+
+@app.route("/uploads/<upload_id>", methods=["GET", "DELETE"])
+@login_required
+def upload_status(upload_id):
+    upload_session = chunked_uploads.get(upload_id, session["user_id"])
+    if upload_session is None:
+        return jsonify({"error": "Upload not found"}), 404
+    if request.method == "DELETE":
+        chunked_uploads.discard(upload_id)
+        return "", 204
+    return jsonify(chunked_uploads.status(upload_session))
+
+@app.route("/uploads/<upload_id>/parts/<int:part_index>", methods=["PUT"])
+@login_required
+def upload_part(upload_id, part_index):
+    upload_session = chunked_uploads.get(upload_id, session["user_id"])
+    if upload_session is None:
+        return jsonify({"error": "Upload not found"}), 404
+    try:
+        chunked_uploads.write_part(upload_session, part_index, request.stream)
+    except Exception as e:
+        return jsonify({"error": str(e)}), 400
+    return jsonify({"upload_id": upload_id, "part": part_index})
+
+@app.route("/uploads/<upload_id>/complete", methods=["POST"])
+@login_required
+def complete_upload(upload_id):
+    if chunked_uploads.get(upload_id, session["user_id"]) is None:
+        return jsonify({"error": "Upload not found"}), 404
+    task_id = jobs.submit("chunked_upload", session["user_id"], {"upload_id": upload_id}, status="Finishing upload...")
     return jsonify({"task_id": task_id})
 
-# Add this improved function to handle URL downloads
+@app.route("/transfers")
+@login_required
+def list_transfers():
+    # Uploads and downloads that failed or were interrupted, with how far
+    # they got; downloads are listed under the name of the user's file
+    user_id = session["user_id"]
+    return jsonify([{
+        "id": transfer[0],
+        "kind": transfer[1],
+        "file_name": transfer_file_name(user_id, transfer),
+        "size": transfer[5],
+        "chunks_done": transfer[8],
+        "updated_at": transfer[7],
+        "resumable": os.path.isfile(transfer[4]),
+    } for transfer in db.get_transfers(user_id)])
+
+def transfer_file_name(user_id, transfer):
+    if transfer[1] == "download":
+        file_record = db.get_file(user_id, transfer[2])
+        if file_record:
+            return file_record[1]
+    return os.path.basename(transfer[4])
+
+@app.route("/transfers/<transfer_id>/resume", methods=["POST"])
+@login_required
+def resume_transfer(transfer_id):
+    transfer = db.get_transfer(transfer_id)
+    if transfer is None or transfer[3] != session["user_id"]:
+        return jsonify({"error": "Transfer not found"}), 404
+    if not os.path.isfile(transfer[4]):
+        return jsonify({"error": "The file is no longer available"}), 410
+    if transfer[1] == "download":
+        # /download picks up the checkpoints of the same file
+        return jsonify({"download_url": url_for("download", file_hash=transfer[2])})
+    # The uploader picks up the checkpoints of the same file
+    task_id = jobs.submit("upload", session["user_id"], {"path": transfer[4]}, status="Resuming upload...")
+    return jsonify({"task_id": task_id})
+
+def remove_staged(path):
+    # Remove the staging folder holding `path`, if it was uploaded through
+    # /upload; other paths belong to someone else
+    folder = os.path.dirname(os.path.abspath(path))
+    if os.path.dirname(folder) == staging_root:
+        shutil.rmtree(folder, ignore_errors=True)
 
-def process_url_download(url, task_id, user_id):
+def process_upload(task_id, user_id, payload):
+    upload_path = payload["path"]
+    if not os.path.isfile(upload_path):
+        raise Exception("Staged upload is missing.")
+    jobs.progress(task_id, 0, "Processing file and uploading to Telegram...", stage="upload")
+    uploader = Uploader(upload_path, progress_callback=lambda details: report_upload(task_id, details))
     try:
+        uploader.run(user_id=user_id)
+    except Exception:
+        # A failed upload with a checkpoint keeps its staged file, so it can
+        # be resumed until the checkpoint is purged
+        if uploader.transfer_id is None or db.get_transfer(uploader.transfer_id) is None:
+            remove_staged(upload_path)
+        raise
+    remove_staged(upload_path)
+
+def process_url_download(task_id, user_id, payload):
+    url = payload["url"]
+    try:
+        downloader = URLDownloader(fm.base_path)
+        if torrent_ingest == "stream" and downloader.is_torrent(url):
+            return ingest_torrent(task_id, user_id, downloader, url)
+
         # Update task status
-        url_download_tasks[task_id]["status"] = "Downloading from URL..."
+        jobs.progress(task_id, 0, "Downloading from URL...")
         
         # Download the file
-        downloader = URLDownloader(fm.base_path)
-        
-        def update_progress(progress, status_message=None):
-            url_download_tasks[task_id]["progress"] = progress
-            if status_message:
-                url_download_tasks[task_id]["status"] = status_message
+        def update_progress(progress, status_message=None, **details):
+            jobs.progress(task_id, progress, status_message, stage="download", **details)
         
         local_path = downloader.download_from_url(url, progress_callback=update_progress)
         
         # Update task status
-        url_download_tasks[task_id]["status"] = "Processing file and uploading to Telegram..."
-        url_download_tasks[task_id]["progress"] = 0
+        jobs.progress(task_id, 0, "Processing file and uploading to Telegram...", stage="upload")
         
         # Process the downloaded file
-        uploader = Uploader(local_path)
+        uploader = Uploader(local_path, progress_callback=lambda details: report_upload(task_id, details))
         uploader.run(user_id=user_id)
-        
-        # Complete task
-        url_download_tasks[task_id]["status"] = "Complete"
-        url_download_tasks[task_id]["progress"] = 100
-        url_download_tasks[task_id]["complete"] = True
-        url_download_tasks[task_id]["success"] = True
-        
-        # Schedule task cleanup after 30 minutes
-        def cleanup_task():
-            if task_id in url_download_tasks:
-                del url_download_tasks[task_id]
-                
-        scheduler.add_job(
-            func=cleanup_task,
-            trigger="date",
-            run_date=datetime.now() + timedelta(minutes=30)
-        )
-        
     except Exception as e:
         app.logger.error(f"Error processing URL download: {str(e)}")
-        url_download_tasks[task_id]["status"] = f"Error: {str(e)}"
-        url_download_tasks[task_id]["complete"] = True
-        url_download_tasks[task_id]["success"] = False
+        raise
+
+def ingest_torrent(task_id, user_id, downloader, url):
+    # Chunks of the torrent's zip go to Telegram as soon as the pieces they
+    # are built from have downloaded, so downloading and uploading overlap
+    # and only a window of the torrent is ever on disk
+    jobs.progress(task_id, 0, "Waiting for torrent metadata...")
+    progress = [0]
+
+    def update_upload(details):
+        progress[0] = report_upload(task_id, details)
+
+    def update_status(status_message):
+        jobs.progress(task_id, progress[0], status_message)
+
+    with downloader.open_torrent_stream(url, status_callback=update_status) as stream:
+        # The path only names the upload, so a retried job resumes it
+        path = os.path.join(fm.base_path, "torrents", stream.info_hash, stream.name)
+        uploader = Uploader(path, progress_callback=update_upload, stream=stream, size=stream.size)
+        uploader.run(user_id=user_id)
+
+def report_upload(task_id, details):
+    # Sizes known up front can be estimates, like a torrent's before zipping
+    progress = min(100, 100 * details["bytes_done"] / details["bytes_total"]) if details["bytes_total"] else 0
+    jobs.progress(task_id, progress, **details)
+    return progress
+
+def process_chunked_upload(task_id, user_id, payload):
+    def update_progress(progress, status_message=None):
+        jobs.progress(task_id, progress, status_message, stage="upload")
+
+    chunked_uploads.finish(payload["upload_id"], progress_callback=update_progress)
+
+jobs.register("upload", process_upload)
+jobs.register("chunked_upload", process_chunked_upload)
+jobs.register("url", process_url_download)
 
 @app.route("/task/progress/<task_id>")
 @login_required
 def task_progress(task_id):
-    if task_id in url_download_tasks:
-        return jsonify(url_download_tasks[task_id])
+    job = jobs.get(task_id)
+    if job and job["user_id"] == session["user_id"]:
+        return jsonify(job)
     return jsonify({
         "progress": 0,
         "status": "Task not found",
@@ -208,46 +424,127 @@ def task_progress(task_id):
         "error": "Task ID not found"
     })
 
+@app.route("/task/events/<task_id>")
+@login_required
+def task_events(task_id):
+    # Server-Sent Events variant of /task/progress: one long-lived request
+    # per task receiving coalesced updates, instead of a poll every second.
+    job = jobs.get(task_id)
+    if not job or job["user_id"] != session["user_id"]:
+        return jsonify({"error": "Task ID not found"}), 404
+
+    def events():
+        # Jobs running in another worker process are followed through the
+        # jobs table
+        for snapshot in progress_broker.subscribe(task_id, fallback=lambda: jobs.get(task_id)):
+            if snapshot is None:
+                yield ": keepalive\n\n"
+            else:
+                snapshot.pop("user_id", None)
+                yield f"data: {json.dumps(snapshot)}\n\n"
+
+    response = Response(stream_with_context(events()), mimetype="text/event-stream")
+    response.headers["Cache-Control"] = "no-cache"
+    response.headers["X-Accel-Buffering"] = "no"
+    return response
+
+def get_user_file(file_hash):
+    # Find file record by file hash; ensure the file belongs to the logged-in user
+    return db.get_file(session["user_id"], file_hash)
+
+def stream_file(file_record, as_attachment):
+    file_name, file_hash = file_record[1], file_record[2]
+    cached_file = disk_cache.get_path(file_hash)
+    if cached_file:
+        try:
+            return send_file(cached_file, download_name=file_name, as_attachment=as_attachment)
+        except FileNotFoundError:
+            # Evicted between the lookup and the send; stream it instead
+            pass
+
+    downloader = Downloader(file_name, file_hash, user_id=session["user_id"])
+    if as_attachment:
+        # Downloads are written in place to a preallocated file and only
+        # sent once the whole file matches its hash; send_file serves any
+        # byte range of it. Verified chunks are checkpointed, so a failed
+        # download continues where it stopped the next time it is asked for.
+        try:
+            output_file_path = downloader.run()
+        except Exception as e:
+            app.logger.error(f"Error downloading {file_hash}: {e}")
+            if downloader.transfer_id is not None and db.get_transfer(downloader.transfer_id):
+                flash(f"Download failed: {e}. Download the file again to continue where it stopped.")
+            else:
+                flash(f"Download failed: {e}")
+            return redirect(url_for("index"))
+        try:
+            return send_file(output_file_path, download_name=file_name, as_attachment=True)
+        except FileNotFoundError:
+            # The cache evicted it again before it could be opened
+            pass
+
+    # Inline playback streams straight from Telegram, so it can start and
+    # seek before the file has been downloaded. /download leaves the whole
+    # file in the cache checked above, so later requests for it, streams
+    # included, are served from disk.
+    try:
+        downloader.load_bots()
+    except Exception as e:
+        flash(str(e))
+        return redirect(url_for("index"))
+    chunks = downloader.get_chunks()
+    content_length = downloader.get_content_length(chunks)
+
+    # Serve only the chunks covering the requested range, if sizes are known
+    byte_range = request.range.range_for_length(content_length) if request.range and content_length is not None else None
+    if request.range and content_length is not None and byte_range is None:
+        response = Response(status=416)
+        response.headers["Content-Range"] = f"bytes */{content_length}"
+        return response
+
+    mimetype = mimetypes.guess_type(file_name)[0] or "application/octet-stream"
+    if byte_range:
+        start, stop = byte_range
+        response = Response(stream_with_context(downloader.stream(chunks, start, stop - 1)), status=206, mimetype=mimetype)
+        response.headers["Content-Range"] = f"bytes {start}-{stop - 1}/{content_length}"
+        response.headers["Content-Length"] = str(stop - start)
+    else:
+        response = Response(stream_with_context(downloader.stream(chunks)), mimetype=mimetype)
+        if content_length is not None:
+            response.headers["Content-Length"] = str(content_length)
+    if content_length is not None:
+        response.headers["Accept-Ranges"] = "bytes"
+    response.headers.set("Content-Disposition", "attachment" if as_attachment else "inline", filename=file_name)
+    return response
+
 @app.route("/download/<file_hash>")
 @login_required
 def download(file_hash):
-    # Find file record by file hash; ensure the file belongs to the logged-in user
-    user_id = session["user_id"]
-    file_record = next((record for record in db.get_files(user_id=user_id) if record[2] == file_hash), None)
+    file_record = get_user_file(file_hash)
     if not file_record:
         flash("File not found")
         return redirect(url_for("index"))
+    return stream_file(file_record, as_attachment=True)
 
-    file_name = file_record[1]
-    output_file = os.path.join(fm.output_path, file_name)
-    if not os.path.isfile(output_file):
-        downloader = Downloader(file_name)
-        downloader.run()
-
-    if not os.path.isfile(output_file):
-        flash("Merged file not found after processing.")
+@app.route("/stream/<file_hash>")
+@login_required
+def stream(file_hash):
+    # Inline variant of /download for in-browser media playback and seeking
+    file_record = get_user_file(file_hash)
+    if not file_record:
+        flash("File not found")
         return redirect(url_for("index"))
-
-    return send_from_directory(fm.output_path, file_name, as_attachment=True)
+    return stream_file(file_record, as_attachment=False)
 
 @app.route("/delete/<file_hash>", methods=["POST"])
 @login_required
 def delete_file(file_hash):
     user_id = session["user_id"]
-    file_record = next((record for record in db.get_files(user_id=user_id) if record[2] == file_hash), None)
+    file_record = get_user_file(file_hash)
     if not file_record:
         flash("File not found")
         return redirect(url_for("index"))
 
-    file_name = file_record[1]
-    output_file = os.path.join(fm.output_path, file_name)
-    if os.path.isfile(output_file):
-        try:
-            os.remove(output_file)
-            app.logger.info(f"Deleted merged file: {output_file}")
-        except Exception as e:
-            app.logger.error(f"Error deleting merged file: {e}")
-
     for directory in [fm.base_path, fm.loaded_chunks, fm.split_chunks]:
         if os.path.exists(directory):
             for f in os.listdir(directory):
@@ -260,16 +557,30 @@ def delete_file(file_hash):
                         app.logger.error(f"Error deleting chunk file {file_path}: {e}")
 
     try:
-        db.delete_file(file_hash)
+        if db.delete_file(file_hash, user_id):
+            # No other user stores this content; drop the cached copy too
+            disk_cache.discard(file_hash)
         flash("File deleted successfully.")
     except Exception as e:
         flash(str(e))
     return redirect(url_for("index"))
 
+@app.route("/cache/stats")
+@login_required
+def cache_stats():
+    return jsonify(disk_cache.stats())
+
+@app.route("/metrics")
+def metrics_endpoint():
+    # Prometheus scrape target, merged across gunicorn workers
+    body, content_type = metrics.render(db)
+    return Response(body, content_type=content_type)
+
 def cleanup_old_files():
+    # Downloaded content in the output folder is managed by disk_cache
     now = datetime.now()
     one_day_ago = now - timedelta(days=1)
-    directories = [fm.base_path, fm.loaded_chunks, fm.output_path]
+    directories = [fm.base_path, fm.loaded_chunks]
     for directory in directories:
         if os.path.exists(directory):
             for filename in os.listdir(directory):
@@ -283,13 +594,49 @@ def cleanup_old_files():
                         except Exception as e:
                             app.logger.error(f"Error deleting file {file_path}: {e}")
 
-scheduler = BackgroundScheduler()
-scheduler.add_job(func=cleanup_old_files, trigger="interval", hours=24)
-scheduler.start()
+def purge_old_jobs():
+    jobs.db.purge_jobs((datetime.now() - timedelta(days=1)).timestamp())
+
+def purge_stale_uploads():
+    chunked_uploads.purge((datetime.now() - timedelta(days=1)).timestamp())
+
+def purge_stale_transfers():
+    # Checkpoints nobody resumed within a day, with their staged uploads and
+    # partial downloads
+    for transfer_id, kind, path in db.get_stale_transfers((datetime.now() - timedelta(days=1)).timestamp()):
+        if kind == "download":
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+        else:
+            remove_staged(path)
+        db.delete_transfer(transfer_id)
+
+# Every gunicorn worker imports this module, but only the one holding this
+# lock runs the periodic jobs; it is held for the life of that worker.
+scheduler_lock = open(os.path.join(fm.create_path(os.path.join(fm.base_path, "locks")), "scheduler.lock"), "w")
+
+def start_scheduler():
+    try:
+        fcntl.flock(scheduler_lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        return None
+    scheduler = BackgroundScheduler()
+    scheduler.add_job(func=cleanup_old_files, trigger="interval", hours=24)
+    scheduler.add_job(func=purge_old_jobs, trigger="interval", hours=24)
+    scheduler.add_job(func=purge_stale_uploads, trigger="interval", hours=1)
+    scheduler.add_job(func=purge_stale_transfers, trigger="interval", hours=1)
+    scheduler.start()
+    return scheduler
+
+scheduler = start_scheduler()
+jobs.start()
 
 if __name__ == "__main__":
     try:
         port = int(os.environ.get("PORT", 5000))
         app.run(host="0.0.0.0",port=port,debug=False)
     except (KeyboardInterrupt, SystemExit):
-        scheduler.shutdown()
+        if scheduler:
+            scheduler.shutdown()
@@ -0,0 +1,69 @@
+# Compare fixed-size and content-defined chunking on two versions of a file:
+#
+#   python benchmarks/bench_cdc.py --size-mb 512
+#
+# The second version gets a few small insertions and deletions spread over
+# the file. For each strategy this reports chunking throughput and how much
+# of the new version is made of chunks the old version already stored.
+import io
+import os
+import sys
+import time
+import random
+import hashlib
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from bin.modules.cdc import FastCDC, numpy
+
+MB = 1024 * 1024
+
+def make_versions(size: int, edits: int, seed: int) -> tuple:
+    rng = random.Random(seed)
+    old = os.urandom(size)
+    new = bytearray(old)
+    # Edit back to front so earlier offsets stay valid
+    for offset in sorted(rng.sample(range(size), edits), reverse=True):
+        if rng.random() < 0.5:
+            new[offset:offset] = rng.randbytes(rng.randint(1, 4096))
+        else:
+            del new[offset:offset + rng.randint(1, 4096)]
+    return old, bytes(new)
+
+def fixed_split(data: bytes, chunk_size: int) -> list:
+    return [data[i:i + chunk_size] for i in range(0, len(data), chunk_size)]
+
+def measure(name: str, split, old: bytes, new: bytes) -> None:
+    start = time.perf_counter()
+    old_chunks = split(old)
+    new_chunks = split(new)
+    elapsed = time.perf_counter() - start
+
+    stored = {hashlib.md5(chunk).digest() for chunk in old_chunks}
+    reused = [chunk for chunk in new_chunks if hashlib.md5(chunk).digest() in stored]
+    reused_bytes = sum(len(chunk) for chunk in reused)
+    average = len(new) / len(new_chunks) / MB
+    print(
+        f"{name:<6} {(len(old) + len(new)) / MB / elapsed:8.1f} MB/s  "
+        f"{len(new_chunks):5d} chunks (avg {average:5.2f} MB)  "
+        f"reused {len(reused)}/{len(new_chunks)} chunks, {100 * reused_bytes / len(new):5.1f}% of bytes"
+    )
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Compare fixed and content-defined chunking")
+    parser.add_argument("--size-mb", type=int, default=256, help="size of the generated file")
+    parser.add_argument("--edits", type=int, default=8, help="insertions/deletions in the new version")
+    parser.add_argument("--min-mb", type=float, default=2)
+    parser.add_argument("--avg-mb", type=float, default=8)
+    parser.add_argument("--max-mb", type=float, default=20)
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    old, new = make_versions(args.size_mb * MB, args.edits, args.seed)
+    chunker = FastCDC(int(args.min_mb * MB), int(args.avg_mb * MB), int(args.max_mb * MB))
+    print(f"{args.size_mb} MB, {args.edits} edits, numpy {'on' if numpy is not None else 'off'}")
+    measure("fixed", lambda data: fixed_split(data, int(args.max_mb * MB)), old, new)
+    measure("cdc", lambda data: list(chunker.split(io.BytesIO(data))), old, new)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,71 @@
+# Compare file hashing modes on a large file:
+#
+#   python benchmarks/bench_hash.py --size-mb 4096
+#
+# "md5-4k" is the old FileManager.get_file_hash (4 KB reads, one core),
+# "md5" a whole-file MD5 with large reads, and "tree" the parallel tree hash
+# used by HASH_MODE=tree with 1..N worker threads.
+import os
+import sys
+import time
+import hashlib
+import argparse
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from bin.modules.file_manager import FileManager
+
+def make_file(path: str, size_mb: int) -> None:
+    block = os.urandom(1024 * 1024)
+    with open(path, "wb") as f:
+        for _ in range(size_mb):
+            f.write(block)
+
+def md5_small_reads(fm: FileManager, path: str) -> str:
+    gen, hasher = fm.get_file_hash(path)
+    for _ in gen:
+        pass
+    return hasher.hexdigest()
+
+def md5_large_reads(fm: FileManager, path: str) -> str:
+    hasher = hashlib.md5()
+    with open(path, "rb") as f:
+        for data in iter(lambda: f.read(fm.hash_buffer), b""):
+            hasher.update(data)
+    return hasher.hexdigest()
+
+def run(name: str, size_mb: int, func) -> None:
+    start = time.perf_counter()
+    result = func()
+    elapsed = time.perf_counter() - start
+    print(f"{name:<12} {elapsed:8.2f} s {size_mb / elapsed:10.1f} MB/s  {result}")
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Compare file hashing modes")
+    parser.add_argument("--size-mb", type=int, default=2048, help="size of the generated test file")
+    parser.add_argument("--file", help="hash this file instead of generating one")
+    parser.add_argument("--workers", type=int, nargs="*", help="tree hash thread counts to try")
+    args = parser.parse_args()
+
+    fm = FileManager(base_path=tempfile.gettempdir(), base_output=tempfile.gettempdir())
+    path = args.file
+    if path is None:
+        path = os.path.join(tempfile.gettempdir(), "bench_hash.bin")
+        make_file(path, args.size_mb)
+    size_mb = os.path.getsize(path) / (1024 * 1024)
+    workers = args.workers or sorted({1, 2, 4, os.cpu_count() or 1})
+
+    try:
+        print(f"{size_mb:.0f} MB, {fm.chunk_size} MB chunks, {os.cpu_count()} CPUs")
+        # Warm the page cache so every mode reads from memory
+        md5_large_reads(fm, path)
+        run("md5-4k", size_mb, lambda: md5_small_reads(fm, path))
+        run("md5", size_mb, lambda: md5_large_reads(fm, path))
+        for count in workers:
+            run(f"tree x{count}", size_mb, lambda: fm.get_tree_hash(path, workers=count))
+    finally:
+        if args.file is None:
+            os.remove(path)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,205 @@
+# Upload/download throughput against the local mock Bot API:
+#
+#   python benchmarks/bench_transfer.py --sizes-mb 64 256 --chunk-mb 5 20 \
+#       --bots 1 4 --in-flight 2 4 --engine threads async --latency-ms 50 \
+#       --bandwidth 20 --output results.json
+#
+# Every combination runs in a fresh process with its own database, bots in
+# bot_settings pointing at benchmarks/mock_telegram.py, TRANSFER_ENGINE, and
+# BOT_IN_FLIGHT / BOT_MAX_IN_FLIGHT set from --in-flight. Results hold MB/s,
+# p50/p99 chunk latency and peak RSS per run, as JSON that can be diffed
+# between releases.
+import os
+import sys
+import json
+import time
+import signal
+import argparse
+import platform
+import itertools
+import subprocess
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+from benchmarks.mock_telegram import add_arguments
+
+MB = 1024 * 1024
+
+def percentile(values: list, fraction: float) -> float | None:
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+def summary(seconds: float, size: int, latencies: list, complete: bool) -> dict:
+    return {
+        "seconds": round(seconds, 3),
+        "mb_per_s": round(size / MB / seconds, 2) if seconds else None,
+        "chunk_requests": len(latencies),
+        "chunk_p50_ms": round(percentile(latencies, 0.5) * 1000, 1) if latencies else None,
+        "chunk_p99_ms": round(percentile(latencies, 0.99) * 1000, 1) if latencies else None,
+        "complete": complete,
+    }
+
+def run_one(config: dict) -> dict:
+    # Runs in the child process; the environment is already set up
+    import logging
+    logging.basicConfig(level=logging.WARNING)
+    import resource
+    from bin.modules.db_manager import db
+    from bin.modules.telegram_bot import TelegramBot
+    from bin.modules.async_engine import AsyncTelegramBot
+    from bin.modules import uploader, downloader
+
+    # Time every request the bots make, per phase
+    latencies = {"upload": [], "download": []}
+    phase = ["upload"]
+
+    def timed(method):
+        def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return method(*args, **kwargs)
+            finally:
+                latencies[phase[0]].append(time.perf_counter() - started)
+        return wrapper
+
+    def async_timed(method):
+        async def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return await method(*args, **kwargs)
+            finally:
+                latencies[phase[0]].append(time.perf_counter() - started)
+        return wrapper
+
+    for cls, wrap in ((TelegramBot, timed), (AsyncTelegramBot, async_timed)):
+        cls.send_document = wrap(cls.send_document)
+        cls.download_document = wrap(cls.download_document)
+
+    bots = db.get_bots()
+    db.edit_bot({"id": bots[0][0], "token": "bench1", "chat_id": 1})
+    for i in range(2, config["bots"] + 1):
+        db.add_bot(f"bench{i}", 1)
+    uploader.fm.chunk_size = config["chunk_mb"]
+
+    size = config["size_mb"] * MB
+    path = os.path.join(uploader.fm.base_path, "bench.bin")
+    with open(path, "wb") as f:
+        for _ in range(config["size_mb"]):
+            f.write(os.urandom(MB))
+
+    started = time.perf_counter()
+    uploader.Uploader(path).run(user_id=1)
+    upload_seconds = time.perf_counter() - started
+    record = db.get_file_by_name("bench.bin")[0]
+    stored = sum(chunk[6] or 0 for chunk in db.get_chunks(record[2]))
+
+    phase[0] = "download"
+    started = time.perf_counter()
+    try:
+        output = downloader.Downloader("bench.bin", record[2]).run()
+        downloaded = os.path.getsize(output)
+    except Exception as e:
+        logging.error(f"Download failed: {e}")
+        downloaded = 0
+    download_seconds = time.perf_counter() - started
+
+    return {
+        "upload": summary(upload_seconds, size, latencies["upload"], stored == size),
+        "download": summary(download_seconds, size, latencies["download"], downloaded == size),
+        # ru_maxrss is in KB on Linux
+        "peak_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+    }
+
+def start_mock(args) -> tuple:
+    command = [sys.executable, os.path.join(ROOT, "benchmarks", "mock_telegram.py"), "--port", "0"]
+    for name in ("latency_ms", "jitter_ms", "bandwidth", "bot_rps", "p429", "retry_after",
+                 "error_rate", "corrupt_rate", "max_download_mb", "seed"):
+        value = getattr(args, name)
+        if value is not None:
+            command += ["--" + name.replace("_", "-"), str(value)]
+    process = subprocess.Popen(command, stdout=subprocess.PIPE, text=True)
+    return process, process.stdout.readline().strip()
+
+def git_revision() -> str | None:
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], cwd=ROOT, capture_output=True, text=True).stdout.strip() or None
+    except OSError:
+        return None
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Transfer throughput against a mock Bot API")
+    parser.add_argument("--sizes-mb", type=int, nargs="+", default=[64])
+    parser.add_argument("--chunk-mb", type=int, nargs="+", default=[20], help="FileManager.chunk_size values")
+    parser.add_argument("--bots", type=int, nargs="+", default=[1, 4], help="bots in bot_settings")
+    parser.add_argument("--in-flight", type=int, nargs="+", default=[2], help="requests in flight per bot")
+    parser.add_argument("--engine", nargs="+", default=["threads"], choices=["threads", "async"])
+    parser.add_argument("--repeat", type=int, default=1)
+    parser.add_argument("--output", help="write the JSON results here instead of stdout")
+    parser.add_argument("--child", help=argparse.SUPPRESS)
+    add_arguments(parser)
+    args = parser.parse_args()
+
+    if args.child:
+        print(json.dumps(run_one(json.loads(args.child))))
+        return
+
+    mock, url = start_mock(args)
+    results = []
+    try:
+        for size_mb, chunk_mb, bots, in_flight, engine, repeat in itertools.product(
+            args.sizes_mb, args.chunk_mb, args.bots, args.in_flight, args.engine, range(args.repeat)
+        ):
+            config = {"size_mb": size_mb, "chunk_mb": chunk_mb, "bots": bots, "in_flight": in_flight, "engine": engine}
+            with tempfile.TemporaryDirectory(prefix="bench_transfer_") as workdir:
+                env = dict(
+                    os.environ,
+                    PYTHONPATH=ROOT,
+                    DB_PATH=os.path.join(workdir, "bench.sqlite3"),
+                    TELEGRAM_API_URL=url,
+                    TRANSFER_ENGINE=engine,
+                    BOT_IN_FLIGHT=str(in_flight),
+                    BOT_MAX_IN_FLIGHT=str(in_flight),
+                )
+                child = subprocess.run(
+                    [sys.executable, os.path.abspath(__file__), "--child", json.dumps(config)],
+                    cwd=workdir, env=env, capture_output=True, text=True,
+                )
+            if child.returncode != 0:
+                result = dict(config, error=child.stderr.strip().splitlines()[-1:])
+            else:
+                result = dict(config, **json.loads(child.stdout.strip().splitlines()[-1]))
+            results.append(result)
+            if "error" in result:
+                print(f"{size_mb} MB / {chunk_mb} MB chunks / {bots} bots x{in_flight} / {engine}: failed {result['error']}", file=sys.stderr)
+            else:
+                print(
+                    f"{size_mb} MB / {chunk_mb} MB chunks / {bots} bots x{in_flight} / {engine}: "
+                    f"up {result['upload']['mb_per_s']} MB/s, down {result['download']['mb_per_s']} MB/s, "
+                    f"p99 {result['upload']['chunk_p99_ms']}/{result['download']['chunk_p99_ms']} ms, "
+                    f"rss {result['peak_rss_mb']} MB",
+                    file=sys.stderr,
+                )
+    finally:
+        mock.send_signal(signal.SIGINT)
+        mock.wait()
+
+    report = {
+        "revision": git_revision(),
+        "python": platform.python_version(),
+        "cpus": os.cpu_count(),
+        "mock": {name: getattr(args, name) for name in (
+            "latency_ms", "jitter_ms", "bandwidth", "bot_rps", "p429", "error_rate", "corrupt_rate")},
+        "results": results,
+    }
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,272 @@
+# Local stand-in for the Telegram Bot API, for benchmarks and for trying
+# transfers without real bots:
+#
+#   python benchmarks/mock_telegram.py --port 8081 --latency-ms 80 --bandwidth 10
+#   TELEGRAM_API_URL=http://127.0.0.1:8081 python app.py
+#
+# It implements sendDocument, getFile and the /file/bot<token>/<path>
+# download path. Documents are kept in a temporary directory. Latency,
+# a per-connection bandwidth cap, 429 rate limiting and injected errors or
+# corrupted downloads are configurable, so retry and integrity handling can
+# be exercised as well as throughput.
+import io
+import os
+import sys
+import json
+import time
+import uuid
+import random
+import shutil
+import argparse
+import tempfile
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+from werkzeug.formparser import parse_form_data
+
+MB = 1024 * 1024
+
+class MockTelegram(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address: tuple, storage: str, latency: float = 0, jitter: float = 0, bandwidth: float = 0,
+                 bot_rps: float = 0, p429: float = 0, retry_after: int = 1, error_rate: float = 0,
+                 corrupt_rate: float = 0, max_download: int = 20 * MB, seed: int = None) -> None:
+        super().__init__(address, Handler)
+        self.storage = storage
+        self.latency = latency
+        self.jitter = jitter
+        # Bytes per second per connection; 0 means unlimited
+        self.bandwidth = bandwidth
+        # Requests per second each bot token may make before getting 429s
+        self.bot_rps = bot_rps
+        self.p429 = p429
+        self.retry_after = retry_after
+        self.error_rate = error_rate
+        self.corrupt_rate = corrupt_rate
+        # Bots can only download files up to 20 MB from Telegram
+        self.max_download = max_download
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.requests = {}
+        self.stats = {"requests": 0, "uploaded": 0, "downloaded": 0, "429": 0, "errors": 0, "corrupted": 0}
+
+    def count(self, key: str, amount: int = 1) -> None:
+        with self.lock:
+            self.stats[key] += amount
+
+    def chance(self, rate: float) -> bool:
+        with self.lock:
+            return rate > 0 and self.random.random() < rate
+
+    def rate_limited(self, token: str) -> bool:
+        # Sliding one second window per bot token
+        if self.chance(self.p429):
+            return True
+        if not self.bot_rps:
+            return False
+        now = time.monotonic()
+        with self.lock:
+            recent = [t for t in self.requests.get(token, []) if now - t < 1]
+            limited = len(recent) >= self.bot_rps
+            if not limited:
+                recent.append(now)
+            self.requests[token] = recent
+        return limited
+
+    def delay(self) -> None:
+        with self.lock:
+            jitter = self.random.uniform(-self.jitter, self.jitter) if self.jitter else 0
+        if self.latency + jitter > 0:
+            time.sleep(self.latency + jitter)
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    server: MockTelegram
+
+    def log_message(self, format, *args) -> None:
+        pass
+
+    def send_json(self, status: int, body: dict, headers: dict = None) -> None:
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def send_error_json(self, status: int, description: str, parameters: dict = None) -> None:
+        body = {"ok": False, "error_code": status, "description": description}
+        headers = None
+        if parameters:
+            body["parameters"] = parameters
+            headers = {"Retry-After": str(parameters["retry_after"])}
+        self.send_json(status, body, headers)
+
+    def throttled(self, size: int, started: float) -> None:
+        # Sleep until `size` bytes fit the bandwidth cap since `started`
+        if self.server.bandwidth:
+            wait = started + size / self.server.bandwidth - time.monotonic()
+            if wait > 0:
+                time.sleep(wait)
+
+    def read_body(self) -> bytes:
+        remaining = int(self.headers.get("Content-Length", 0))
+        body = io.BytesIO()
+        started = time.monotonic()
+        while remaining:
+            data = self.rfile.read(min(remaining, MB))
+            if not data:
+                break
+            body.write(data)
+            remaining -= len(data)
+            self.throttled(body.tell(), started)
+        return body.getvalue()
+
+    def injected_failure(self, token: str) -> bool:
+        # Answers the request with a 429 or 500 when one is due
+        if self.server.rate_limited(token):
+            self.server.count("429")
+            retry_after = self.server.retry_after
+            self.send_error_json(429, f"Too Many Requests: retry after {retry_after}", {"retry_after": retry_after})
+            return True
+        if self.server.chance(self.server.error_rate):
+            self.server.count("errors")
+            self.send_error_json(500, "Internal Server Error: injected")
+            return True
+        return False
+
+    def route(self) -> tuple:
+        # (kind, token, rest) for /bot<token>/<method> and /file/bot<token>/<path>
+        url = urlparse(self.path)
+        parts = url.path.lstrip("/").split("/", 2)
+        if parts[0] == "file" and len(parts) == 3 and parts[1].startswith("bot"):
+            return "file", parts[1][3:], parts[2], url
+        if parts[0].startswith("bot") and len(parts) == 2:
+            return "method", parts[0][3:], parts[1], url
+        return None, None, None, url
+
+    def do_POST(self) -> None:
+        self.server.count("requests")
+        kind, token, method, url = self.route()
+        body = self.read_body()
+        self.server.delay()
+        if kind != "method" or method != "sendDocument":
+            return self.send_error_json(404, "Not Found: method not found")
+        if self.injected_failure(token):
+            return
+        environ = {
+            "wsgi.input": io.BytesIO(body),
+            "CONTENT_LENGTH": str(len(body)),
+            "CONTENT_TYPE": self.headers.get("Content-Type", ""),
+            "REQUEST_METHOD": "POST",
+        }
+        _, form, files = parse_form_data(environ)
+        document = files.get("document")
+        if document is None or not form.get("chat_id"):
+            return self.send_error_json(400, "Bad Request: chat_id and document are required")
+        file_id = uuid.uuid4().hex
+        file_path = os.path.join(self.server.storage, file_id)
+        document.save(file_path)
+        size = os.path.getsize(file_path)
+        self.server.count("uploaded", size)
+        self.send_json(200, {"ok": True, "result": {
+            "message_id": 1,
+            "chat": {"id": form["chat_id"]},
+            "document": {"file_id": file_id, "file_unique_id": file_id[:16], "file_name": document.filename, "file_size": size},
+        }})
+
+    def do_GET(self) -> None:
+        self.server.count("requests")
+        kind, token, rest, url = self.route()
+        self.server.delay()
+        if kind == "method" and rest == "getFile":
+            return self.get_file(token, parse_qs(url.query).get("file_id", [""])[0])
+        if kind == "file":
+            return self.download(token, rest)
+        self.send_error_json(404, "Not Found: method not found")
+
+    def get_file(self, token: str, file_id: str) -> None:
+        if self.injected_failure(token):
+            return
+        file_path = os.path.join(self.server.storage, os.path.basename(file_id))
+        if not file_id or not os.path.exists(file_path):
+            return self.send_error_json(400, "Bad Request: invalid file_id")
+        size = os.path.getsize(file_path)
+        if size > self.server.max_download:
+            return self.send_error_json(400, "Bad Request: file is too big")
+        self.send_json(200, {"ok": True, "result": {
+            "file_id": file_id, "file_unique_id": file_id[:16], "file_size": size, "file_path": f"documents/{file_id}",
+        }})
+
+    def download(self, token: str, path: str) -> None:
+        if self.injected_failure(token):
+            return
+        file_path = os.path.join(self.server.storage, os.path.basename(path))
+        if not os.path.exists(file_path):
+            return self.send_error_json(404, "Not Found")
+        size = os.path.getsize(file_path)
+        corrupt = size > 0 and self.server.chance(self.server.corrupt_rate)
+        self.send_response(200)
+        self.send_header("Content-Type", "application/octet-stream")
+        self.send_header("Content-Length", str(size))
+        self.end_headers()
+        sent = 0
+        started = time.monotonic()
+        with open(file_path, "rb") as f:
+            for data in iter(lambda: f.read(MB), b""):
+                if corrupt:
+                    # Flip one byte of the first piece
+                    data = bytes([data[0] ^ 0xFF]) + data[1:]
+                    corrupt = False
+                    self.server.count("corrupted")
+                self.wfile.write(data)
+                sent += len(data)
+                self.throttled(sent, started)
+        self.server.count("downloaded", sent)
+
+def add_arguments(parser: argparse.ArgumentParser) -> None:
+    # Shared with bench_transfer.py, which passes them through
+    parser.add_argument("--latency-ms", type=float, default=0, help="added to every request")
+    parser.add_argument("--jitter-ms", type=float, default=0, help="latency varies by up to this much")
+    parser.add_argument("--bandwidth", type=float, default=0, help="MB/s per connection, 0 for unlimited")
+    parser.add_argument("--bot-rps", type=float, default=0, help="requests per second per bot before 429s")
+    parser.add_argument("--p429", type=float, default=0, help="fraction of requests answered with 429")
+    parser.add_argument("--retry-after", type=int, default=1, help="retry_after sent with 429s")
+    parser.add_argument("--error-rate", type=float, default=0, help="fraction of requests answered with 500")
+    parser.add_argument("--corrupt-rate", type=float, default=0, help="fraction of downloads with a flipped byte")
+    parser.add_argument("--max-download-mb", type=float, default=20, help="largest file getFile hands out")
+    parser.add_argument("--seed", type=int, default=None)
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Local mock of the Telegram Bot API")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8081, help="0 picks a free port")
+    parser.add_argument("--storage", help="directory for documents, a temporary one by default")
+    add_arguments(parser)
+    args = parser.parse_args()
+
+    storage = args.storage or tempfile.mkdtemp(prefix="mock_telegram_")
+    os.makedirs(storage, exist_ok=True)
+    server = MockTelegram(
+        (args.host, args.port), storage,
+        latency=args.latency_ms / 1000, jitter=args.jitter_ms / 1000, bandwidth=args.bandwidth * MB,
+        bot_rps=args.bot_rps, p429=args.p429, retry_after=args.retry_after, error_rate=args.error_rate,
+        corrupt_rate=args.corrupt_rate, max_download=int(args.max_download_mb * MB), seed=args.seed,
+    )
+    # The first line tells callers where to connect
+    print(f"http://{server.server_address[0]}:{server.server_address[1]}", flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        print(json.dumps(server.stats), file=sys.stderr)
+        if args.storage is None:
+            shutil.rmtree(storage, ignore_errors=True)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,240 @@
+import os
+import time
+import atexit
+import asyncio
+import logging
+import threading
+import aiohttp
+from concurrent.futures import ThreadPoolExecutor
+from bin.modules.chunk_scheduler import retry_timeout, should_retry, retry_reason, expired, begin, report, remote_errors
+from bin.modules.metrics import bot_bytes, chunk_seconds, chunk_retries, chunk_failures, queue_depth
+from bin.modules.telegram_bot import TelegramBot, api_error
+
+# "threads" runs transfers on ChunkScheduler, "async" on AsyncTransferEngine
+transfer_engine = os.getenv("TRANSFER_ENGINE", "threads")
+
+# Errors that count against a bot, including aiohttp's own
+async_remote_errors = remote_errors + (aiohttp.ClientError,)
+
+# Connections the shared session keeps open across all async transfers;
+# each transfer is capped by its own max_in_flight on top of this
+max_connections = int(os.getenv("ASYNC_MAX_CONNECTIONS", 100))
+
+# Every async transfer in the process runs on one event loop thread and
+# sends through one aiohttp session, so keep-alive connections to Telegram
+# are reused from one transfer to the next, like the bots' requests sessions
+loop_lock = threading.Lock()
+transfer_loop = None
+transfer_session = None
+
+def get_loop() -> asyncio.AbstractEventLoop:
+    global transfer_loop
+    with loop_lock:
+        if transfer_loop is None:
+            transfer_loop = asyncio.new_event_loop()
+            threading.Thread(target=transfer_loop.run_forever, daemon=True).start()
+        return transfer_loop
+
+async def get_session() -> aiohttp.ClientSession:
+    # Only called on the transfer loop, which the session is bound to
+    global transfer_session
+    if transfer_session is None or transfer_session.closed:
+        transfer_session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=max_connections),
+            timeout=aiohttp.ClientTimeout(total=None, sock_connect=30, sock_read=300),
+        )
+    return transfer_session
+
+@atexit.register
+def close_session() -> None:
+    if transfer_session is not None and not transfer_session.closed:
+        asyncio.run_coroutine_threadsafe(transfer_session.close(), transfer_loop).result(5)
+
+class AsyncTelegramBot:
+    # asyncio counterpart of TelegramBot, sharing its token and chat id but
+    # sending through the shared pooled aiohttp session.
+    def __init__(self, bot: TelegramBot, session: aiohttp.ClientSession) -> None:
+        self.bot = bot
+        self.name = bot.name
+        self.controller = bot.controller
+        self.session = session
+
+    async def send_document(self, document: bytes, file_name: str = None) -> str:
+        form = aiohttp.FormData()
+        form.add_field("chat_id", str(self.bot.chat_id))
+        form.add_field("document", document, filename=file_name or "document")
+        started = time.perf_counter()
+        async with self.session.post(self.bot.base_url + "sendDocument", data=form) as response:
+            try:
+                response_data = await response.json(content_type=None)
+            except ValueError:
+                response_data = None
+            if not response_data or not response_data.get("ok"):
+                raise api_error("uploading document", response.status, response_data, response.headers)
+        chunk_seconds.labels(self.name, "send").observe(time.perf_counter() - started)
+        bot_bytes.labels(self.name, "sent").inc(len(document))
+        return response_data["result"]["document"]["file_id"]
+
+    async def download_document(self, file_id: str, destination=None) -> bytes | int | None:
+        url = self.bot.base_url + "getFile"
+        started = time.perf_counter()
+        async with self.session.get(url, params={"file_id": file_id}) as response:
+            if response.status == 400:
+                return None
+            if response.status != 200:
+                try:
+                    response_data = await response.json(content_type=None)
+                except ValueError:
+                    response_data = None
+                raise api_error("getting file", response.status, response_data, response.headers)
+            file_info = (await response.json(content_type=None))["result"]
+
+        async with self.session.get(self.bot.file_url + file_info["file_path"]) as file_response:
+            if file_response.status != 200:
+                raise api_error("downloading file", file_response.status, None, file_response.headers)
+            if destination is None:
+                content = await file_response.read()
+                self.__fetched(started, len(content))
+                return content
+            written = 0
+            async for piece in file_response.content.iter_chunked(self.bot.piece_size):
+                destination.write(piece)
+                written += len(piece)
+            self.__fetched(started, written)
+            return written
+
+    def __fetched(self, started: float, size: int) -> None:
+        chunk_seconds.labels(self.name, "fetch").observe(time.perf_counter() - started)
+        bot_bytes.labels(self.name, "received").inc(size)
+
+class AsyncTransferEngine:
+    # Drives many concurrent chunk transfers per bot from a single event
+    # loop. Each bot gets `in_flight_per_bot` worker tasks (by default as
+    # many as its controller allows when the transfer starts) pulling from
+    # one shared queue, and `max_in_flight` caps requests across all bots. As in
+    # ChunkScheduler, each bot's controller decides how many of its workers
+    # may send at once, and failed chunks are queued again until their
+    # deadline.
+    def __init__(self, bots: list, in_flight_per_bot: int = None, max_in_flight: int = None, max_queued: int = 0, operation: str = "transfer"):
+        if in_flight_per_bot is None and os.getenv("ASYNC_BOT_IN_FLIGHT"):
+            in_flight_per_bot = int(os.getenv("ASYNC_BOT_IN_FLIGHT"))
+        if max_in_flight is None:
+            max_in_flight = int(os.getenv("ASYNC_MAX_IN_FLIGHT", 16))
+        self.bots = bots
+        self.in_flight_per_bot = in_flight_per_bot
+        self.max_in_flight = max(1, max_in_flight)
+        self.max_queued = max_queued
+        self.operation = operation
+        self.retry_timeout = retry_timeout
+        self.handoff_wait = 0.25
+        # Items given up on
+        self.failed = []
+
+    def map(self, handler, items) -> None:
+        # Blocking entry point for the synchronous Uploader/Downloader API.
+        # `handler` is a coroutine function taking (item, AsyncTelegramBot).
+        asyncio.run_coroutine_threadsafe(self.__map(handler, items), get_loop()).result()
+        if self.failed:
+            raise Exception(f"{len(self.failed)} chunks could not be transferred")
+
+    async def __map(self, handler, items) -> None:
+        loop = asyncio.get_running_loop()
+        # Entries are [item, attempts, deadline (set on the first try), holds
+        # a producer slot, last error]; the slots throttle the producer so
+        # retries never wait for room. A chunk keeps its slot until it has
+        # been sent or given up on, so a transfer never holds more than
+        # max_queued chunks beyond one per worker.
+        work_queue = asyncio.Queue()
+        bots = [
+            bot
+            for bot in self.bots
+            for _ in range(max(1, self.in_flight_per_bot or int(bot.controller.limit)))
+        ]
+        slots = asyncio.Semaphore(self.max_queued + len(bots)) if self.max_queued else None
+        in_flight = asyncio.Semaphore(self.max_in_flight)
+        pending = [0]
+        idle = asyncio.Condition()
+        session = await get_session()
+
+        async def settle(entry: list):
+            if entry[3]:
+                entry[3] = False
+                slots.release()
+            async with idle:
+                pending[0] -= 1
+                idle.notify_all()
+
+        async def fail(entry: list):
+            logging.error(f"Chunk transfer failed after {entry[1]} attempts: {entry[4]}")
+            chunk_failures.labels(self.operation).inc()
+            self.failed.append(entry[0])
+            await settle(entry)
+
+        async def work(bot: AsyncTelegramBot):
+            while True:
+                entry = await work_queue.get()
+                if entry is None:
+                    break
+                if expired(entry):
+                    queue_depth.labels("async").dec()
+                    await fail(entry)
+                    continue
+                if not await bot.controller.acquire_async(self.handoff_wait):
+                    # Blocked or busy: give the chunk back for another bot
+                    work_queue.put_nowait(entry)
+                    await bot.controller.wait_ready_async(1)
+                    continue
+                queue_depth.labels("async").dec()
+                begin(entry, self.retry_timeout)
+
+                error = None
+                try:
+                    async with in_flight:
+                        await handler(entry[0], bot)
+                except Exception as e:
+                    error = e
+                finally:
+                    bot.controller.release()
+                report(bot.controller, error, async_remote_errors)
+                if error is None:
+                    await settle(entry)
+                    continue
+
+                entry[1] += 1
+                entry[4] = error
+                if should_retry(error, entry[2]):
+                    logging.warning(f"Chunk transfer on {bot.name} failed, retrying: {error}")
+                    chunk_retries.labels(self.operation, retry_reason(error)).inc()
+                    queue_depth.labels("async").inc()
+                    work_queue.put_nowait(entry)
+                    continue
+                await fail(entry)
+
+        workers = [
+            asyncio.create_task(work(AsyncTelegramBot(bot, session)))
+            for bot in bots
+        ]
+        # Items may come from blocking file reads or wait for a torrent's
+        # pieces, so pull them on a thread of their own; the loop's default
+        # executor is shared with every other transfer
+        producer = ThreadPoolExecutor(max_workers=1)
+        try:
+            iterator = iter(items)
+            while True:
+                item = await loop.run_in_executor(producer, next, iterator, None)
+                if item is None:
+                    break
+                if slots:
+                    await slots.acquire()
+                pending[0] += 1
+                queue_depth.labels("async").inc()
+                work_queue.put_nowait([item, 0, None, slots is not None, None])
+            # Failed items are queued again, so wait until every item
+            # has succeeded or been given up on
+            async with idle:
+                await idle.wait_for(lambda: pending[0] == 0)
+        finally:
+            producer.shutdown(wait=False)
+            for _ in workers:
+                work_queue.put_nowait(None)
+            await asyncio.gather(*workers)
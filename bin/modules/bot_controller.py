@@ -0,0 +1,124 @@
+import os
+import time
+import random
+import asyncio
+import threading
+
+# Requests each bot starts with in flight, and the most it may grow to
+initial_in_flight = int(os.getenv("BOT_IN_FLIGHT", 2))
+max_in_flight = int(os.getenv("BOT_MAX_IN_FLIGHT", 8))
+
+class BotController:
+    # Admission control for one bot, shared by every transfer using it.
+    # The in-flight limit grows by about one request per round of successes
+    # and halves on a 429 or an error (AIMD), so each bot settles near the
+    # highest rate Telegram lets it sustain. A 429 blocks the bot for its
+    # retry_after; other errors block it for a jittered exponential backoff.
+    def __init__(self, initial: int = None, maximum: int = None) -> None:
+        self.maximum = max(1, maximum or max_in_flight)
+        self.limit = float(min(max(1, initial or initial_in_flight), self.maximum))
+        self.active = 0
+        self.blocked_until = 0.0
+        self.failures = 0
+        self.backoff_base = 0.5
+        self.backoff_max = 30
+        # Errors from requests started before the last decrease say nothing
+        # new about the current limit
+        self.decrease_interval = 1
+        self.last_decrease = 0.0
+        self.poll_interval = 0.05
+        self.__cond = threading.Condition()
+
+    def __wait_time(self) -> float | None:
+        # 0 when a request may start now, the seconds left while the bot is
+        # blocked, None while every slot is taken
+        now = time.monotonic()
+        if now < self.blocked_until:
+            return self.blocked_until - now
+        if self.active >= int(self.limit):
+            return None
+        return 0
+
+    def __ready(self, timeout: float | None, take: bool) -> bool:
+        # Wait until a request may start, taking a slot if `take`
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self.__cond:
+            while (wait := self.__wait_time()) != 0:
+                if deadline is not None:
+                    left = deadline - time.monotonic()
+                    if left <= 0:
+                        return False
+                    wait = left if wait is None else min(wait, left)
+                self.__cond.wait(wait)
+            if take:
+                self.active += 1
+            return True
+
+    async def __ready_async(self, timeout: float | None, take: bool) -> bool:
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            with self.__cond:
+                wait = self.__wait_time()
+                if wait == 0:
+                    if take:
+                        self.active += 1
+                    return True
+            if wait is None:
+                wait = self.poll_interval
+            if deadline is not None:
+                left = deadline - time.monotonic()
+                if left <= 0:
+                    return False
+                wait = min(wait, left)
+            await asyncio.sleep(wait)
+
+    def acquire(self, timeout: float = None) -> bool:
+        return self.__ready(timeout, True)
+
+    def wait_ready(self, timeout: float = None) -> bool:
+        return self.__ready(timeout, False)
+
+    async def acquire_async(self, timeout: float = None) -> bool:
+        return await self.__ready_async(timeout, True)
+
+    async def wait_ready_async(self, timeout: float = None) -> bool:
+        return await self.__ready_async(timeout, False)
+
+    def release(self) -> None:
+        with self.__cond:
+            self.active -= 1
+            self.__cond.notify_all()
+
+    def report(self, error: Exception | None) -> None:
+        # Outcome of a request made under this controller
+        if error is None:
+            self.succeeded()
+        elif getattr(error, "retry_after", None):
+            self.throttled(error.retry_after)
+        elif not getattr(error, "permanent", False):
+            self.failed()
+
+    def succeeded(self) -> None:
+        with self.__cond:
+            self.failures = 0
+            self.limit = min(self.maximum, self.limit + 1 / self.limit)
+            self.__cond.notify_all()
+
+    def throttled(self, retry_after: float) -> None:
+        with self.__cond:
+            self.blocked_until = max(self.blocked_until, time.monotonic() + retry_after)
+            self.__decrease()
+
+    def failed(self) -> None:
+        with self.__cond:
+            self.failures += 1
+            # Full jitter keeps bots that failed together from retrying together
+            backoff = random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** self.failures))
+            self.blocked_until = max(self.blocked_until, time.monotonic() + backoff)
+            self.__decrease()
+
+    def __decrease(self) -> None:
+        now = time.monotonic()
+        if now - self.last_decrease >= self.decrease_interval:
+            self.limit = max(1.0, self.limit / 2)
+            self.last_decrease = now
@@ -0,0 +1,28 @@
+import threading
+import logging
+from bin.modules.db_manager import DBManager, db
+from bin.modules.telegram_bot import TelegramBot
+
+class BotPool:
+    # Long-lived set of TelegramBot clients built once from bot_settings and
+    # shared by every Uploader and Downloader, so their keep-alive sessions
+    # survive from one transfer to the next.
+    def __init__(self, db: DBManager) -> None:
+        self.db = db
+        self.__bots = None
+        self.__lock = threading.Lock()
+
+    def get_bots(self) -> list:
+        with self.__lock:
+            if self.__bots is None:
+                self.__bots = [TelegramBot(obj[2], obj[3], name=f"bot{obj[0]}") for obj in self.db.get_bots()]
+                logging.info(f"Initialized {len(self.__bots)} Telegram bots")
+            return list(self.__bots)
+
+    def reload(self) -> None:
+        # Call after bot_settings changes; transfers already running keep
+        # the clients they were given.
+        with self.__lock:
+            self.__bots = None
+
+bot_pool = BotPool(db)
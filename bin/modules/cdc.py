@@ -0,0 +1,99 @@
+import hashlib
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+class FastCDC:
+    # Content-defined chunking in the style of FastCDC. A gear rolling hash
+    # over the last 32 bytes picks cut points, so boundaries depend on the
+    # content around them rather than on offsets: after an insertion or
+    # deletion the chunker falls back into step and later chunks keep their
+    # hashes. Cuts never happen before `min_size` and always at `max_size`;
+    # a stricter mask before `avg_size` and a looser one after it keep chunk
+    # sizes close to the average (normalized chunking).
+    #
+    # The hash at every position is computed block-wise with numpy when it
+    # is installed, and byte by byte otherwise; both cut at the same places.
+    def __init__(self, min_size: int, avg_size: int, max_size: int) -> None:
+        if not 32 <= min_size <= avg_size <= max_size:
+            raise Exception("Chunk sizes must satisfy 32 <= min <= avg <= max")
+        self.min_size = min_size
+        self.avg_size = avg_size
+        self.max_size = max_size
+        self.window = 32
+        # Bytes hashed per numpy block; the search stops at the first cut
+        self.block_size = 1024 * 1024
+        bits = avg_size.bit_length() - 1
+        # Test the high bits of the hash, which depend on the whole window
+        self.mask_s = self.high_bits(bits + 2)
+        self.mask_l = self.high_bits(bits - 2)
+        # Fixed gear table, identical in every process and release
+        self.gear = [int.from_bytes(hashlib.md5(bytes([i])).digest()[:4], "little") for i in range(256)]
+        self.gear_array = numpy.array(self.gear, dtype=numpy.uint32) if numpy is not None else None
+
+    def high_bits(self, count: int) -> int:
+        count = min(max(count, 1), 32)
+        return ((1 << count) - 1) << (32 - count)
+
+    def cut(self, data, start: int = 0, end: int = None) -> int:
+        # Offset of the first boundary in data[start:end]
+        if end is None:
+            end = len(data)
+        if end - start <= self.min_size:
+            return end
+        normal = start + min(self.avg_size, end - start)
+        limit = start + min(self.max_size, end - start)
+        find = self.find_numpy if self.gear_array is not None else self.find_python
+        for first, last, mask in ((start + self.min_size, normal, self.mask_s), (normal, limit, self.mask_l)):
+            position = find(data, first, last, mask)
+            if position is not None:
+                return position + 1
+        return limit
+
+    def find_python(self, data, first: int, last: int, mask: int) -> int | None:
+        # First position in [first, last) whose window hash matches `mask`
+        gear = self.gear
+        h = 0
+        for i in range(max(first - self.window + 1, 0), first):
+            h = ((h << 1) + gear[data[i]]) & 0xFFFFFFFF
+        for i in range(first, last):
+            h = ((h << 1) + gear[data[i]]) & 0xFFFFFFFF
+            if not h & mask:
+                return i
+        return None
+
+    def find_numpy(self, data, first: int, last: int, mask: int) -> int | None:
+        view = memoryview(data)
+        for block in range(first, last, self.block_size):
+            block_end = min(block + self.block_size, last)
+            offset = max(block - self.window + 1, 0)
+            h = self.gear_array[numpy.frombuffer(view[offset:block_end], dtype=numpy.uint8)]
+            # h[i] = sum(gear[data[i - k]] << k for k < 32), built by doubling
+            # the window; uint32 arithmetic wraps like the rolling version.
+            width = 1
+            while width < self.window:
+                h[width:] += h[:-width] << numpy.uint32(width)
+                width *= 2
+            hits = numpy.flatnonzero((h[block - offset:] & numpy.uint32(mask)) == 0)
+            if hits.size:
+                return block + int(hits[0])
+        return None
+
+    def split(self, stream, read_size: int = None):
+        # Yield the chunks of a binary stream in order
+        read_size = read_size or self.max_size
+        buffer = b""
+        eof = False
+        while True:
+            while not eof and len(buffer) < self.max_size:
+                data = stream.read(read_size)
+                if not data:
+                    eof = True
+                buffer += data
+            if not buffer:
+                return
+            boundary = self.cut(buffer)
+            yield buffer[:boundary]
+            buffer = buffer[boundary:]
@@ -0,0 +1,62 @@
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future
+from bin.modules.metrics import cache_requests
+
+class ChunkCache:
+    # Small in-process LRU of recently fetched chunks, keyed by chunk hash.
+    # Concurrent requests for a chunk that is still being fetched wait for
+    # that fetch instead of starting another one.
+    def __init__(self, max_chunks: int = 4):
+        self.max_chunks = max_chunks
+        self.__chunks = OrderedDict()
+        self.__fetching = {}
+        self.__lock = threading.Lock()
+
+    def get(self, chunk_hash: str) -> bytes | None:
+        with self.__lock:
+            data = self.__chunks.get(chunk_hash)
+            if data is not None:
+                self.__chunks.move_to_end(chunk_hash)
+            return data
+
+    def put(self, chunk_hash: str, data: bytes) -> None:
+        with self.__lock:
+            self.__chunks[chunk_hash] = data
+            self.__chunks.move_to_end(chunk_hash)
+            while len(self.__chunks) > self.max_chunks:
+                self.__chunks.popitem(last=False)
+
+    def contains(self, chunk_hash: str) -> bool:
+        with self.__lock:
+            return chunk_hash in self.__chunks or chunk_hash in self.__fetching
+
+    def get_or_fetch(self, chunk_hash: str, fetch) -> bytes:
+        with self.__lock:
+            data = self.__chunks.get(chunk_hash)
+            if data is not None:
+                self.__chunks.move_to_end(chunk_hash)
+                cache_requests.labels("chunk", "hit").inc()
+                return data
+            future = self.__fetching.get(chunk_hash)
+            owner = future is None
+            # Waiting on a fetch already in flight still saves a request
+            cache_requests.labels("chunk", "miss" if owner else "shared").inc()
+            if owner:
+                future = Future()
+                self.__fetching[chunk_hash] = future
+
+        if not owner:
+            return future.result()
+
+        try:
+            data = fetch()
+            self.put(chunk_hash, data)
+            future.set_result(data)
+            return data
+        except Exception as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self.__lock:
+                del self.__fetching[chunk_hash]
@@ -0,0 +1,69 @@
+import os
+import zlib
+import logging
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+class ChunkCodec:
+    # Optional compression of chunks before they go to Telegram. A few
+    # slices of every chunk are compressed first and chunks that do not
+    # shrink by at least `min_gain` are stored raw, so already compressed
+    # media costs almost nothing. Chunk hashes and sizes always refer to the
+    # raw bytes; only the payload on Telegram is encoded.
+    def __init__(self, name: str = "none", level: int = None, min_gain: float = 0.1) -> None:
+        if name == "zstd" and zstandard is None:
+            logging.warning("zstandard is not installed, compressing chunks with zlib")
+            name = "zlib"
+        if name not in ("none", "zlib", "zstd"):
+            raise Exception(f"Unknown chunk codec: {name}")
+        if level is None:
+            level = 3 if name == "zstd" else 6
+        self.name = name
+        self.level = level
+        self.min_gain = min_gain
+        self.sample_size = 64 * 1024
+        self.samples = 4
+
+    def compress(self, data: bytes) -> bytes:
+        if self.name == "zstd":
+            return zstandard.ZstdCompressor(level=self.level).compress(data)
+        return zlib.compress(data, self.level)
+
+    def worth_compressing(self, data: bytes) -> bool:
+        if len(data) <= self.sample_size * self.samples:
+            return True
+        step = (len(data) - self.sample_size) // (self.samples - 1)
+        sample = b"".join(data[i * step:i * step + self.sample_size] for i in range(self.samples))
+        return len(self.compress(sample)) <= len(sample) * (1 - self.min_gain)
+
+    def encode(self, data: bytes) -> tuple:
+        # (codec, payload); a codec of None means the chunk is stored raw
+        if self.name == "none" or not data or not self.worth_compressing(data):
+            return None, data
+        payload = self.compress(data)
+        if len(payload) > len(data) * (1 - self.min_gain):
+            return None, data
+        return self.name, payload
+
+    def decode(self, codec: str | None, payload: bytes) -> bytes:
+        # Works for any codec, whatever this instance compresses with
+        if codec is None:
+            return payload
+        if codec == "zlib":
+            return zlib.decompress(payload)
+        if codec == "zstd":
+            if zstandard is None:
+                raise Exception("zstd compressed chunks need the zstandard package")
+            return zstandard.ZstdDecompressor().decompress(payload)
+        raise Exception(f"Unknown chunk codec: {codec}")
+
+# CHUNK_CODEC is none (default), zlib or zstd; CHUNK_CODEC_MIN_GAIN is the
+# fraction a chunk has to shrink by to be stored compressed.
+chunk_codec = ChunkCodec(
+    os.getenv("CHUNK_CODEC", "none"),
+    int(os.getenv("CHUNK_CODEC_LEVEL")) if os.getenv("CHUNK_CODEC_LEVEL") else None,
+    float(os.getenv("CHUNK_CODEC_MIN_GAIN", 0.1)),
+)
@@ -0,0 +1,200 @@
+import os
+import time
+import queue
+import threading
+import logging
+import requests
+from bin.modules.metrics import queue_depth, chunk_retries, chunk_failures
+from bin.modules.telegram_bot import TelegramError
+
+# Seconds a chunk keeps being retried, counted from its first try
+retry_timeout = float(os.getenv("CHUNK_RETRY_TIMEOUT", 300))
+
+def should_retry(error: Exception, deadline: float) -> bool:
+    return not getattr(error, "permanent", False) and time.monotonic() < deadline
+
+def begin(entry: list, timeout: float) -> None:
+    # Start a chunk's deadline on its first try. Transfers queue every chunk
+    # up front, so timing it from the queue would leave the last chunks of a
+    # long transfer without any retries.
+    if entry[1] == 0:
+        entry[2] = time.monotonic() + timeout
+
+def expired(entry: list) -> bool:
+    # A chunk that was tried and whose deadline passed while it waited for
+    # a bot is not tried again
+    return entry[1] > 0 and time.monotonic() >= entry[2]
+
+# Outcomes of requests to Telegram. Anything else a handler raises, like a
+# failed hash check, a missing part file or a locked database, is local and
+# says nothing about the bot.
+remote_errors = (TelegramError, requests.RequestException, TimeoutError)
+
+def report(controller, error: Exception | None, remote: tuple = remote_errors) -> None:
+    # Local errors are retried like any other, without backing the bot off
+    if error is None or isinstance(error, remote):
+        controller.report(error)
+
+def retry_reason(error: Exception) -> str:
+    return str(getattr(error, "status", None) or type(error).__name__)
+
+class ChunkScheduler:
+    # Shared work queue for chunk transfers. Every bot runs a few workers
+    # that pull the next pending chunk, so a slow or rate-limited bot simply
+    # takes fewer chunks instead of holding up a fixed slice of the file.
+    # Each bot's controller decides how many of its workers may send at
+    # once; a worker whose bot is blocked hands its chunk back for another
+    # bot. A chunk that fails goes back on the queue until its deadline.
+    def __init__(self, bots: list, in_flight_per_bot: int = None, max_queued: int = 0, operation: str = "transfer"):
+        self.bots = bots
+        # Workers per bot; by default as many as its controller allows to
+        # send when the transfer starts
+        self.in_flight_per_bot = in_flight_per_bot
+        self.max_queued = max_queued
+        self.operation = operation
+        self.retry_timeout = retry_timeout
+        # Seconds a worker holds a chunk waiting for its bot before handing
+        # it back
+        self.handoff_wait = 0.25
+        # Items given up on
+        self.failed = []
+        # Entries are [item, attempts, deadline (set on the first try), holds
+        # a producer slot, last error]. The queue itself is unbounded so
+        # retries never block a worker; the producer is throttled by the
+        # slots instead, created by start().
+        self.__queue = queue.Queue()
+        self.__slots = None
+        self.__pending = 0
+        self.__idle = threading.Condition()
+        self.__cancelled = False
+        self.__threads = []
+
+    def start(self, handler, on_failure=None) -> None:
+        # on_failure(item, error) is called for items given up on
+        workers = [
+            bot
+            for bot in self.bots
+            for _ in range(max(1, self.in_flight_per_bot or int(bot.controller.limit)))
+        ]
+        if self.max_queued:
+            # A chunk keeps its slot until it has been sent or given up on,
+            # waiting for a bot or for a retry included, so a transfer never
+            # holds more than max_queued chunks beyond one per worker
+            self.__slots = threading.Semaphore(self.max_queued + len(workers))
+        for bot in workers:
+            thread = threading.Thread(target=self.__work, args=(handler, on_failure, bot), daemon=True)
+            self.__threads.append(thread)
+            thread.start()
+
+    def submit(self, item) -> None:
+        # Blocks while the queue is full, which throttles the producer
+        if self.__slots:
+            self.__slots.acquire()
+        with self.__idle:
+            self.__pending += 1
+        queue_depth.labels("threads").inc()
+        self.__queue.put([item, 0, None, self.__slots is not None, None])
+
+    def close(self, wait: bool = True) -> None:
+        if wait:
+            # Failed items are queued again, so wait until every item has
+            # succeeded or been given up on before stopping the workers
+            with self.__idle:
+                while self.__pending:
+                    self.__idle.wait()
+        for _ in self.__threads:
+            self.__queue.put(None)
+        if wait:
+            for thread in self.__threads:
+                thread.join()
+
+    def cancel(self) -> None:
+        # Drop pending work; chunks already in flight are left to finish
+        self.__cancelled = True
+        try:
+            while True:
+                entry = self.__queue.get_nowait()
+                if entry is not None:
+                    self.__release_slot(entry)
+                    queue_depth.labels("threads").dec()
+        except queue.Empty:
+            pass
+        self.close(wait=False)
+
+    def map(self, handler, items) -> None:
+        self.start(handler)
+        try:
+            for item in items:
+                self.submit(item)
+        finally:
+            self.close()
+        if self.failed:
+            raise Exception(f"{len(self.failed)} chunks could not be transferred")
+
+    def __release_slot(self, entry: list) -> None:
+        if entry[3]:
+            entry[3] = False
+            self.__slots.release()
+
+    def __settle(self, entry: list) -> None:
+        self.__release_slot(entry)
+        with self.__idle:
+            self.__pending -= 1
+            self.__idle.notify_all()
+
+    def __work(self, handler, on_failure, bot) -> None:
+        controller = bot.controller
+        while True:
+            entry = self.__queue.get()
+            if entry is None:
+                break
+            if self.__cancelled:
+                self.__release_slot(entry)
+                queue_depth.labels("threads").dec()
+                continue
+            if expired(entry):
+                queue_depth.labels("threads").dec()
+                self.__fail(entry, on_failure)
+                continue
+            if not controller.acquire(self.handoff_wait):
+                # Blocked or busy: give the chunk back for another bot
+                self.__queue.put(entry)
+                controller.wait_ready(1)
+                continue
+            queue_depth.labels("threads").dec()
+            begin(entry, self.retry_timeout)
+
+            error = None
+            try:
+                handler(entry[0], bot)
+            except Exception as e:
+                error = e
+            finally:
+                controller.release()
+            report(controller, error)
+            if error is None:
+                self.__settle(entry)
+                continue
+
+            entry[1] += 1
+            entry[4] = error
+            if not self.__cancelled and should_retry(error, entry[2]):
+                logging.warning(f"Chunk transfer on {bot.name} failed, retrying: {error}")
+                chunk_retries.labels(self.operation, retry_reason(error)).inc()
+                queue_depth.labels("threads").inc()
+                self.__queue.put(entry)
+                continue
+            self.__fail(entry, on_failure)
+
+    def __fail(self, entry: list, on_failure) -> None:
+        item, attempts, error = entry[0], entry[1], entry[4]
+        logging.error(f"Chunk transfer failed after {attempts} attempts: {error}")
+        chunk_failures.labels(self.operation).inc()
+        with self.__idle:
+            self.failed.append(item)
+        if on_failure:
+            try:
+                on_failure(item, error)
+            except Exception as e:
+                logging.error(f"Error in chunk failure handler: {e}")
+        self.__settle(entry)
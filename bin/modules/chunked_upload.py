@@ -0,0 +1,264 @@
+import os
+import time
+import math
+import uuid
+import shutil
+import hashlib
+import threading
+import logging
+from bin.modules.bot_pool import bot_pool
+from bin.modules.chunk_codec import chunk_codec
+from bin.modules.chunk_scheduler import ChunkScheduler
+from bin.modules.db_manager import DBManager
+from bin.modules.file_manager import FileManager, hash_mode
+from bin.modules.metrics import active_transfers
+from bin.modules.telegram_bot import TelegramBot
+
+fm = FileManager()
+
+class ChunkedUploads:
+    # Resumable browser uploads. The client creates a session, PUTs numbered
+    # parts of exactly one chunk each (in parallel, in any order, again after
+    # a failure) and finally asks for the file to be finished. Every part is
+    # handed to the bot pool as soon as it is on disk, so the Telegram upload
+    # overlaps the transfer from the browser.
+    def __init__(self, db: DBManager, path: str, part_size: int) -> None:
+        self.db = db
+        self.path = path
+        self.part_size = part_size
+        # Size of the reads used to spool and hash parts
+        self.piece_size = 1024 * 1024
+        # A part queued or marked as sending without news for this long was
+        # lost, e.g. with the worker process that had it
+        self.stale_timeout = 120
+        self.__sender = None
+        self.__hashers = {}
+        self.__lock = threading.Lock()
+        if not os.path.exists(path):
+            os.makedirs(path)
+
+    def part_dir(self, upload_id: str) -> str:
+        return os.path.join(self.path, upload_id)
+
+    def part_path(self, upload_id: str, part_index: int) -> str:
+        return os.path.join(self.part_dir(upload_id), f"{part_index}.part")
+
+    def parts_total(self, session: tuple) -> int:
+        return math.ceil(session[3] / session[4])
+
+    def expected_part_size(self, session: tuple, part_index: int) -> int:
+        return min(session[4], session[3] - (part_index - 1) * session[4])
+
+    def create(self, user_id: int, file_name: str, size: int) -> dict:
+        upload_id = str(uuid.uuid4())
+        os.makedirs(self.part_dir(upload_id))
+        self.db.add_upload_session(upload_id, user_id, file_name, size, self.part_size)
+        return self.status(self.db.get_upload_session(upload_id))
+
+    def get(self, upload_id: str, user_id: int) -> tuple | None:
+        session = self.db.get_upload_session(upload_id)
+        if session is None or session[1] != user_id:
+            return None
+        return session
+
+    def status(self, session: tuple) -> dict:
+        parts = self.db.get_upload_parts(session[0])
+        return {
+            "upload_id": session[0],
+            "file_name": session[2],
+            "size": session[3],
+            "part_size": session[4],
+            "parts_total": self.parts_total(session),
+            "received": [part[1] for part in parts],
+            "sent": sum(1 for part in parts if part[5] == "sent"),
+        }
+
+    def write_part(self, session: tuple, part_index: int, stream) -> None:
+        upload_id = session[0]
+        if not 1 <= part_index <= self.parts_total(session):
+            raise Exception(f"Part {part_index} is out of range.")
+        expected = self.expected_part_size(session, part_index)
+
+        # Spool the part next to its final name and move it into place only
+        # once it is complete, so a dropped request leaves nothing behind.
+        part_path = self.part_path(upload_id, part_index)
+        temp_path = f"{part_path}.tmp-{uuid.uuid4().hex}"
+        hasher = hashlib.md5()
+        size = 0
+        with open(temp_path, "wb") as f:
+            for piece in iter(lambda: stream.read(self.piece_size), b""):
+                size += len(piece)
+                if size > expected:
+                    break
+                hasher.update(piece)
+                f.write(piece)
+        if size != expected:
+            os.remove(temp_path)
+            raise Exception(f"Part {part_index} must be {expected} bytes.")
+        os.replace(temp_path, part_path)
+
+        part_hash = hasher.hexdigest()
+        previous = next((part for part in self.db.get_upload_parts(upload_id) if part[1] == part_index), None)
+        if previous and previous[2] == part_hash and previous[5] in ("sending", "sent"):
+            # Retried after the response got lost; already on its way
+            return
+        self.db.add_upload_part(upload_id, part_index, part_hash, size)
+        if hash_mode == "md5":
+            self.advance_hash(upload_id)
+        self.sender().submit((upload_id, part_index, part_hash))
+
+    def advance_hash(self, upload_id: str) -> None:
+        # md5 mode: keep a whole-file md5 over the longest run of parts
+        # received from the start, so finishing does not have to read the
+        # file back. Parts are hashed from disk, which is also right for
+        # parts written by another worker process.
+        with self.__lock:
+            state = self.__hashers.setdefault(upload_id, {
+                "next": 1,
+                "hasher": hashlib.md5(),
+                "inodes": [],
+                "lock": threading.Lock(),
+            })
+        with state["lock"]:
+            while True:
+                part_path = self.part_path(upload_id, state["next"])
+                try:
+                    with open(part_path, "rb") as f:
+                        state["inodes"].append(os.fstat(f.fileno()).st_ino)
+                        for piece in iter(lambda: f.read(self.piece_size), b""):
+                            state["hasher"].update(piece)
+                except FileNotFoundError:
+                    return
+                state["next"] += 1
+
+    def file_hash(self, session: tuple, parts: list) -> str:
+        # In tree mode the part hashes are all that is needed
+        if hash_mode != "md5":
+            return fm.tree_hash([part[2] for part in parts])
+
+        upload_id = session[0]
+        total = self.parts_total(session)
+        with self.__lock:
+            state = self.__hashers.get(upload_id)
+        if state:
+            with state["lock"]:
+                # Parts replaced after they were hashed have a new inode
+                inodes = [os.stat(self.part_path(upload_id, i)).st_ino for i in range(1, total + 1)]
+                if state["next"] > total and state["inodes"] == inodes:
+                    return state["hasher"].hexdigest()
+
+        hasher = hashlib.md5()
+        for i in range(1, total + 1):
+            with open(self.part_path(upload_id, i), "rb") as f:
+                for piece in iter(lambda: f.read(self.piece_size), b""):
+                    hasher.update(piece)
+        return hasher.hexdigest()
+
+    def sender(self) -> ChunkScheduler:
+        # Long-lived bot workers shared by every session in this process
+        with self.__lock:
+            if self.__sender is None:
+                bots = bot_pool.get_bots()
+                if not bots:
+                    raise Exception("No Telegram bots configured.")
+                self.__sender = ChunkScheduler(bots, operation="send")
+                self.__sender.start(self.send_part, self.part_failed)
+            return self.__sender
+
+    def send_part(self, item: tuple, bot: TelegramBot) -> None:
+        upload_id, part_index, part_hash = item
+        part = next((part for part in self.db.get_upload_parts(upload_id) if part[1] == part_index), None)
+        if part is None or part[2] != part_hash or part[5] == "sent":
+            # Replaced, discarded or sent by another queue entry in the meantime
+            return
+        try:
+            stored = self.db.get_stored_chunk(part_hash)
+            if stored:
+                file_id, codec = stored[0], stored[2]
+                logging.debug("Part %s of upload %s already stored: %s", part_index, upload_id, file_id)
+            else:
+                self.db.set_upload_part(upload_id, part_index, part_hash, "sending")
+                with open(self.part_path(upload_id, part_index), "rb") as f:
+                    data = f.read()
+                codec, payload = chunk_codec.encode(data)
+                file_id = bot.send_document(payload, f"{part_hash}.chunk")
+                logging.debug("Uploaded part %s of upload %s: %s", part_index, upload_id, file_id)
+            self.db.set_upload_part(upload_id, part_index, part_hash, "sent", file_id, codec)
+        except Exception as e:
+            logging.error(f"Error sending part {part_index} of upload {upload_id}: {e}")
+            # The scheduler sends the part again; until it gives up the part
+            # stays its own, so finish() waits for it instead of sending it
+            # a second time
+            self.db.set_upload_part(upload_id, part_index, part_hash, "sending")
+            raise
+
+    def part_failed(self, item: tuple, error: Exception) -> None:
+        # Given up on by the scheduler; finish() sends it again
+        upload_id, part_index, part_hash = item
+        self.db.set_upload_part(upload_id, part_index, part_hash, "failed")
+
+    def wait_for_parts(self, session: tuple, progress_callback=None) -> list:
+        # Parts queued or being sent by a worker finish on their own; failed
+        # and lost ones are sent from here.
+        total = self.parts_total(session)
+        while True:
+            parts = self.db.get_upload_parts(session[0])
+            sent = sum(1 for part in parts if part[5] == "sent")
+            if progress_callback and total:
+                progress_callback(100 * sent / total, status_message=f"Sending to Telegram: {sent}/{total} parts")
+            cutoff = time.time() - self.stale_timeout
+            if not any(part[5] in ("received", "sending") and part[6] > cutoff for part in parts):
+                return parts
+            time.sleep(1)
+
+    @active_transfers.labels("upload").track_inprogress()
+    def finish(self, upload_id: str, progress_callback=None) -> str:
+        session = self.db.get_upload_session(upload_id)
+        if session is None:
+            raise Exception("Upload session not found.")
+        total = self.parts_total(session)
+        parts = self.wait_for_parts(session, progress_callback)
+        if [part[1] for part in parts] != list(range(1, total + 1)):
+            raise Exception("Upload is missing parts.")
+
+        unsent = [(upload_id, part[1], part[2]) for part in parts if part[5] != "sent"]
+        if unsent:
+            bots = bot_pool.get_bots()
+            if not bots:
+                raise Exception("No Telegram bots configured.")
+            # Parts given up on are marked failed and logged by the scheduler
+            scheduler = ChunkScheduler(bots, operation="send")
+            scheduler.start(self.send_part, self.part_failed)
+            for item in unsent:
+                scheduler.submit(item)
+            scheduler.close()
+            parts = self.db.get_upload_parts(upload_id)
+            if any(part[5] != "sent" for part in parts):
+                raise Exception("Some parts could not be sent to Telegram.")
+
+        file_hash = self.file_hash(session, parts)
+        logging.info(f"File hash: {file_hash}")
+        try:
+            self.db.add_file_with_chunks(session[1], session[2], file_hash, session[3], [
+                (part[2], part[1], part[4], part[3], part[7]) for part in parts
+            ])
+        except Exception:
+            # Nothing to resume when the user already has this file; on any
+            # other error the session and its parts stay for another finish()
+            if self.db.get_file(session[1], file_hash) is not None:
+                self.discard(upload_id)
+            raise
+        self.discard(upload_id)
+        return file_hash
+
+    def discard(self, upload_id: str) -> None:
+        self.db.delete_upload_session(upload_id)
+        shutil.rmtree(self.part_dir(upload_id), ignore_errors=True)
+        with self.__lock:
+            self.__hashers.pop(upload_id, None)
+
+    def purge(self, older_than: float) -> None:
+        # Sessions abandoned by their client
+        for upload_id in self.db.get_stale_upload_sessions(older_than):
+            logging.info(f"Removing abandoned upload {upload_id}")
+            self.discard(upload_id)
@@ -1,9 +1,18 @@
+import os
+import time
+import uuid
 import sqlite3
+import logging
+import threading
+from bin.modules.metrics import db_seconds, time_methods
 
 class DBManager:
     def __init__(self, db_path="db.sqlite3") -> None:
-        self.__conn = sqlite3.connect(db_path, check_same_thread=False)
-        self.__cursor = self.__conn.cursor()
+        self.db_path = db_path
+        # Every thread (Flask request, uploader worker, ...) gets its own
+        # connection and cursor; WAL lets readers run alongside a writer.
+        self.__local = threading.local()
+        self.__conn.execute("PRAGMA journal_mode=WAL")
         # Create users table
         self.__cursor.execute("""
             CREATE TABLE IF NOT EXISTS users (
@@ -12,25 +21,70 @@ class DBManager:
                 password TEXT
             )
         """)
-        # Create files table with a user_id column
-        self.__cursor.execute("""
+        # Create files table with a user_id column. The same content may be
+        # stored by several users, so the hash is only unique per user.
+        files_table = """
             CREATE TABLE IF NOT EXISTS files (
                 id INTEGER PRIMARY KEY,
                 file_name TEXT,
-                hash TEXT UNIQUE,
+                hash TEXT,
                 file_filters TEXT,
                 user_id INTEGER,
-                FOREIGN KEY(user_id) REFERENCES users(id)
+                size INTEGER,
+                uploaded_at REAL,
+                FOREIGN KEY(user_id) REFERENCES users(id),
+                UNIQUE(user_id, hash)
             )
-        """)
+        """
+        self.__cursor.execute("SELECT sql FROM sqlite_master WHERE type = 'table' AND name = 'files'")
+        row = self.__cursor.fetchone()
+        if row and "hash TEXT UNIQUE" in row[0]:
+            # Rebuild tables created with a globally unique hash
+            self.__cursor.execute("ALTER TABLE files RENAME TO files_old")
+            self.__cursor.execute(files_table)
+            self.__cursor.execute(
+                "INSERT INTO files (id, file_name, hash, file_filters, user_id) SELECT id, file_name, hash, file_filters, user_id FROM files_old"
+            )
+            self.__cursor.execute("DROP TABLE files_old")
+            self.__conn.commit()
+        else:
+            self.__cursor.execute(files_table)
+        # Size and upload time back the paginated listing; files stored before
+        # they were recorded get their size from the chunks table.
+        self.__add_column("files", "size", "INTEGER")
+        self.__add_column("files", "uploaded_at", "REAL")
         self.__cursor.execute("""CREATE TABLE IF NOT EXISTS chunks (
                             id INTEGER PRIMARY KEY,
                             main_file TEXT,
                             hash TEXT,
                             chunk_index INTEGER,
                             file_id TEXT,
-                            key TEXT
+                            key TEXT,
+                            size INTEGER,
+                            codec TEXT
+                        )""")
+        # Older databases predate the per-chunk size and codec columns. `size`
+        # is always the raw size; `codec` is NULL for chunks stored raw.
+        self.__add_column("chunks", "size", "INTEGER")
+        self.__add_column("chunks", "codec", "TEXT")
+        # Content-addressed store of chunks already on Telegram; `refs` counts
+        # the chunks rows that point at each one.
+        self.__cursor.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name = 'chunk_store'")
+        chunk_store_exists = self.__cursor.fetchone() is not None
+        self.__cursor.execute("""CREATE TABLE IF NOT EXISTS chunk_store (
+                            hash TEXT PRIMARY KEY,
+                            file_id TEXT,
+                            size INTEGER,
+                            refs INTEGER DEFAULT 0,
+                            codec TEXT
                         )""")
+        self.__add_column("chunk_store", "codec", "TEXT")
+        if not chunk_store_exists:
+            self.__cursor.execute("""
+                INSERT OR IGNORE INTO chunk_store (hash, file_id, size, refs)
+                SELECT hash, file_id, size, COUNT(*) FROM chunks GROUP BY hash
+            """)
+            self.__conn.commit()
         self.__cursor.execute("""CREATE TABLE IF NOT EXISTS bot_settings (
                             id INTEGER PRIMARY KEY,
                             domain TEXT,
@@ -45,33 +99,267 @@ class DBManager:
                 ("telegram", None, None)
             )
             self.__conn.commit()
+        # Durable ingest jobs shared by every worker process
+        self.__cursor.execute("""CREATE TABLE IF NOT EXISTS jobs (
+                            id TEXT PRIMARY KEY,
+                            kind TEXT,
+                            user_id INTEGER,
+                            payload TEXT,
+                            state TEXT,
+                            progress REAL DEFAULT 0,
+                            status TEXT,
+                            attempts INTEGER DEFAULT 0,
+                            worker TEXT,
+                            created_at REAL,
+                            updated_at REAL
+                        )""")
+        self.__cursor.execute("CREATE INDEX IF NOT EXISTS idx_jobs_state ON jobs (state, created_at)")
+        # Resumable browser uploads and the parts received for them so far
+        self.__cursor.execute("""CREATE TABLE IF NOT EXISTS upload_sessions (
+                            id TEXT PRIMARY KEY,
+                            user_id INTEGER,
+                            file_name TEXT,
+                            size INTEGER,
+                            part_size INTEGER,
+                            created_at REAL,
+                            updated_at REAL
+                        )""")
+        self.__cursor.execute("""CREATE TABLE IF NOT EXISTS upload_parts (
+                            upload_id TEXT,
+                            part_index INTEGER,
+                            hash TEXT,
+                            size INTEGER,
+                            file_id TEXT,
+                            state TEXT,
+                            updated_at REAL,
+                            codec TEXT,
+                            PRIMARY KEY (upload_id, part_index)
+                        )""")
+        self.__add_column("upload_parts", "codec", "TEXT")
+        # Checkpoints of uploads and downloads in progress, so a transfer
+        # that failed or whose process died resumes where it stopped. Upload
+        # chunks are 'sent' once Telegram has them; download chunks go from
+        # 'pending' to 'verified' once written and checked.
+        self.__cursor.execute("""CREATE TABLE IF NOT EXISTS transfers (
+                            id TEXT PRIMARY KEY,
+                            kind TEXT,
+                            key TEXT,
+                            user_id INTEGER,
+                            path TEXT,
+                            size INTEGER,
+                            created_at REAL,
+                            updated_at REAL,
+                            UNIQUE (kind, key)
+                        )""")
+        self.__cursor.execute("""CREATE TABLE IF NOT EXISTS transfer_chunks (
+                            transfer_id TEXT,
+                            chunk_index INTEGER,
+                            hash TEXT,
+                            file_id TEXT,
+                            size INTEGER,
+                            codec TEXT,
+                            state TEXT,
+                            PRIMARY KEY (transfer_id, chunk_index)
+                        ) WITHOUT ROWID""")
+        self.__cursor.execute("CREATE INDEX IF NOT EXISTS idx_transfer_chunks_hash ON transfer_chunks (hash, state)")
+        # files(user_id) is already covered by the UNIQUE(user_id, hash) index
+        self.__cursor.execute("CREATE INDEX IF NOT EXISTS idx_chunks_main_file ON chunks (main_file, chunk_index)")
+        self.__cursor.execute("CREATE INDEX IF NOT EXISTS idx_files_file_name ON files (file_name)")
+        self.__cursor.execute("CREATE INDEX IF NOT EXISTS idx_files_hash ON files (hash)")
+        self.__cursor.execute("""
+            UPDATE files SET
+                size = COALESCE(size, (SELECT COALESCE(SUM(chunks.size), 0) FROM chunks WHERE chunks.main_file = files.hash)),
+                uploaded_at = COALESCE(uploaded_at, 0)
+            WHERE size IS NULL OR uploaded_at IS NULL
+        """)
+        # One index per listing order, each ending in id for keyset paging
+        self.__cursor.execute("CREATE INDEX IF NOT EXISTS idx_files_user_name ON files (user_id, file_name, id)")
+        self.__cursor.execute("CREATE INDEX IF NOT EXISTS idx_files_user_size ON files (user_id, size, id)")
+        self.__cursor.execute("CREATE INDEX IF NOT EXISTS idx_files_user_uploaded ON files (user_id, uploaded_at, id)")
+        self.__create_tag_tables()
+        self.__conn.commit()
+
+    def __create_tag_tables(self) -> None:
+        # Tags live in their own tables (files.file_filters is no longer
+        # written). A full-text index over file names and tags is kept in
+        # sync by triggers where SQLite has FTS5.
+        self.__cursor.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name = 'file_tags'")
+        migrate = self.__cursor.fetchone() is None
+        self.__cursor.execute("""CREATE TABLE IF NOT EXISTS tags (
+                            id INTEGER PRIMARY KEY,
+                            name TEXT UNIQUE
+                        )""")
+        self.__cursor.execute("""CREATE TABLE IF NOT EXISTS file_tags (
+                            file_id INTEGER,
+                            tag_id INTEGER,
+                            PRIMARY KEY (file_id, tag_id)
+                        ) WITHOUT ROWID""")
+        self.__cursor.execute("CREATE INDEX IF NOT EXISTS idx_file_tags_tag ON file_tags (tag_id, file_id)")
+        self.__cursor.execute("""CREATE TRIGGER IF NOT EXISTS files_delete_tags AFTER DELETE ON files BEGIN
+                            DELETE FROM file_tags WHERE file_id = old.id;
+                        END""")
+
+        self.__cursor.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name = 'files_fts'")
+        fts_exists = self.__cursor.fetchone() is not None
+        try:
+            self.__cursor.execute("CREATE VIRTUAL TABLE IF NOT EXISTS files_fts USING fts5(name, tags)")
+            self.fts = True
+        except sqlite3.OperationalError:
+            logging.warning("SQLite has no FTS5, file search falls back to LIKE")
+            self.fts = False
+        if self.fts:
+            tags_of = "(SELECT group_concat(tags.name, ' ') FROM file_tags JOIN tags ON tags.id = file_tags.tag_id WHERE file_tags.file_id = {0})"
+            self.__cursor.execute("""CREATE TRIGGER IF NOT EXISTS files_fts_insert AFTER INSERT ON files BEGIN
+                                INSERT INTO files_fts (rowid, name, tags) VALUES (new.id, new.file_name, '');
+                            END""")
+            self.__cursor.execute("""CREATE TRIGGER IF NOT EXISTS files_fts_delete AFTER DELETE ON files BEGIN
+                                DELETE FROM files_fts WHERE rowid = old.id;
+                            END""")
+            self.__cursor.execute("""CREATE TRIGGER IF NOT EXISTS files_fts_rename AFTER UPDATE OF file_name ON files BEGIN
+                                UPDATE files_fts SET name = new.file_name WHERE rowid = new.id;
+                            END""")
+            self.__cursor.execute(f"""CREATE TRIGGER IF NOT EXISTS file_tags_fts_insert AFTER INSERT ON file_tags BEGIN
+                                UPDATE files_fts SET tags = {tags_of.format("new.file_id")} WHERE rowid = new.file_id;
+                            END""")
+            self.__cursor.execute(f"""CREATE TRIGGER IF NOT EXISTS file_tags_fts_delete AFTER DELETE ON file_tags BEGIN
+                                UPDATE files_fts SET tags = COALESCE({tags_of.format("old.file_id")}, '') WHERE rowid = old.file_id;
+                            END""")
+            if not fts_exists:
+                self.__cursor.execute("INSERT INTO files_fts (rowid, name, tags) SELECT id, file_name, '' FROM files")
+
+        if migrate:
+            # Move tags out of the old comma-joined column
+            self.__cursor.execute("SELECT id, file_filters FROM files WHERE file_filters IS NOT NULL AND file_filters != ''")
+            for file_id, filters in self.__cursor.fetchall():
+                self.__set_tags(file_id, filters.split(", "))
+
+    def __set_tags(self, file_id: int, tags: list) -> list:
+        # Replace the tags of one file; returns them normalized
+        tags = sorted({tag.strip().lower() for tag in tags if tag and tag.strip()})
+        self.__cursor.execute("DELETE FROM file_tags WHERE file_id = ?", (file_id,))
+        self.__cursor.executemany("INSERT OR IGNORE INTO tags (name) VALUES (?)", [(tag,) for tag in tags])
+        self.__cursor.executemany(
+            "INSERT INTO file_tags (file_id, tag_id) SELECT ?, id FROM tags WHERE name = ?",
+            [(file_id, tag) for tag in tags]
+        )
+        return tags
+
+    def __add_column(self, table: str, column: str, column_type: str) -> None:
+        self.__cursor.execute(f"PRAGMA table_info({table})")
+        if column not in [row[1] for row in self.__cursor.fetchall()]:
+            self.__cursor.execute(f"ALTER TABLE {table} ADD COLUMN {column} {column_type}")
+
+    def __connection(self):
+        local = self.__local
+        if not hasattr(local, "conn"):
+            local.conn = sqlite3.connect(self.db_path, timeout=30)
+            local.conn.execute("PRAGMA synchronous=NORMAL")
+            local.cursor = local.conn.cursor()
+        return local
+
+    @property
+    def __conn(self) -> sqlite3.Connection:
+        return self.__connection().conn
+
+    @property
+    def __cursor(self) -> sqlite3.Cursor:
+        return self.__connection().cursor
 
-    def add_file(self, user_id: int, file_name: str, file_hash: str) -> None:
+    def add_file(self, user_id: int, file_name: str, file_hash: str, file_size: int = 0) -> None:
         try:
             self.__cursor.execute(
-                "INSERT INTO files (file_name, hash, user_id) VALUES (?, ?, ?)",
-                (file_name, file_hash, user_id)
+                "INSERT INTO files (file_name, hash, user_id, size, uploaded_at) VALUES (?, ?, ?, ?, ?)",
+                (file_name, file_hash, user_id, file_size, time.time())
             )
             self.__conn.commit()
         except sqlite3.IntegrityError:
             # Raise a custom exception so that the caller (upload route) knows the file exists
             raise Exception("File already exists. Please check your uploads.")
 
-    def add_chunk(self, main_file_hash: str, chunk_hash: str, chunk_index: str, chunk_file_id: str) -> None:
+    def add_chunk(self, main_file_hash: str, chunk_hash: str, chunk_index: str, chunk_file_id: str, chunk_size: int = None, codec: str = None) -> None:
         self.__cursor.execute(
-            "INSERT INTO chunks (main_file, hash, chunk_index, file_id) VALUES (?, ?, ?, ?)",
-            (main_file_hash, chunk_hash, chunk_index, chunk_file_id)
+            "INSERT INTO chunks (main_file, hash, chunk_index, file_id, size, codec) VALUES (?, ?, ?, ?, ?, ?)",
+            (main_file_hash, chunk_hash, chunk_index, chunk_file_id, chunk_size, codec)
+        )
+        self.__cursor.execute(
+            """INSERT INTO chunk_store (hash, file_id, size, refs, codec) VALUES (?, ?, ?, 1, ?)
+               ON CONFLICT(hash) DO UPDATE SET refs = refs + 1""",
+            (chunk_hash, chunk_file_id, chunk_size, codec)
         )
         self.__conn.commit()
 
+    def add_file_with_chunks(self, user_id: int, file_name: str, file_hash: str, file_size: int, chunks: list, transfer_id: str = None) -> None:
+        # add_file and add_chunks in one transaction, also closing the
+        # transfer, so a crash never leaves a file without its chunks.
+        # Identical content uploaded before already has its chunk rows.
+        try:
+            self.__cursor.execute(
+                "INSERT INTO files (file_name, hash, user_id, size, uploaded_at) VALUES (?, ?, ?, ?, ?)",
+                (file_name, file_hash, user_id, file_size, time.time())
+            )
+            self.__cursor.execute("SELECT 1 FROM chunks WHERE main_file = ? LIMIT 1", (file_hash,))
+            if self.__cursor.fetchone() is None:
+                self.__cursor.executemany(
+                    "INSERT INTO chunks (main_file, hash, chunk_index, file_id, size, codec) VALUES (?, ?, ?, ?, ?, ?)",
+                    [(file_hash, *chunk) for chunk in chunks]
+                )
+                self.__cursor.executemany(
+                    """INSERT INTO chunk_store (hash, file_id, size, refs, codec) VALUES (?, ?, ?, 1, ?)
+                       ON CONFLICT(hash) DO UPDATE SET refs = refs + 1""",
+                    [(chunk[0], chunk[2], chunk[3], chunk[4]) for chunk in chunks]
+                )
+            if transfer_id is not None:
+                self.__delete_transfer(transfer_id)
+            self.__conn.commit()
+        except sqlite3.IntegrityError:
+            self.__conn.rollback()
+            raise Exception("File already exists. Please check your uploads.")
+        except Exception:
+            self.__conn.rollback()
+            raise
+
+    def add_chunks(self, main_file_hash: str, chunks: list) -> None:
+        # Batched add_chunk for (chunk_hash, chunk_index, chunk_file_id,
+        # chunk_size, codec) tuples, committed as a single transaction.
+        try:
+            self.__cursor.executemany(
+                "INSERT INTO chunks (main_file, hash, chunk_index, file_id, size, codec) VALUES (?, ?, ?, ?, ?, ?)",
+                [(main_file_hash, *chunk) for chunk in chunks]
+            )
+            self.__cursor.executemany(
+                """INSERT INTO chunk_store (hash, file_id, size, refs, codec) VALUES (?, ?, ?, 1, ?)
+                   ON CONFLICT(hash) DO UPDATE SET refs = refs + 1""",
+                [(chunk[0], chunk[2], chunk[3], chunk[4]) for chunk in chunks]
+            )
+            self.__conn.commit()
+        except Exception:
+            self.__conn.rollback()
+            raise
+
+    def get_stored_chunk(self, chunk_hash: str) -> tuple | None:
+        # (file_id, size, codec) of a chunk already on Telegram with this hash
+        self.__cursor.execute("SELECT file_id, size, codec FROM chunk_store WHERE hash = ?", (chunk_hash,))
+        return self.__cursor.fetchone()
+
     def del_file(self, file_name: str) -> None:
         self.__cursor.execute("DELETE FROM files WHERE file_name = ?", (file_name,))
         self.__conn.commit()
 
     def del_chunks(self, main_file_hash: str) -> None:
-        self.__cursor.execute("DELETE FROM chunks WHERE main_file = ?", (main_file_hash,))
+        self.__release_chunks(main_file_hash)
         self.__conn.commit()
 
+    def __release_chunks(self, main_file_hash: str) -> None:
+        # Drop the file's chunk rows; stored chunks nobody references any
+        # more leave the chunk store.
+        self.__cursor.execute("""
+            UPDATE chunk_store SET refs = refs - (
+                SELECT COUNT(*) FROM chunks WHERE main_file = ? AND chunks.hash = chunk_store.hash
+            ) WHERE hash IN (SELECT hash FROM chunks WHERE main_file = ?)
+        """, (main_file_hash, main_file_hash))
+        self.__cursor.execute("DELETE FROM chunks WHERE main_file = ?", (main_file_hash,))
+        self.__cursor.execute("DELETE FROM chunk_store WHERE refs <= 0")
+
     def get_files(self, user_id: int = None) -> list:
         if user_id:
             self.__cursor.execute("SELECT * FROM files WHERE user_id = ?", (user_id,))
@@ -79,43 +367,143 @@ class DBManager:
             self.__cursor.execute("SELECT * FROM files")
         return self.__cursor.fetchall()
 
+    def get_file(self, user_id: int, file_hash: str) -> tuple | None:
+        # Single row through the UNIQUE(user_id, hash) index
+        self.__cursor.execute("SELECT * FROM files WHERE user_id = ? AND hash = ?", (user_id, file_hash))
+        return self.__cursor.fetchone()
+
+    def list_files(self, user_id: int, sort: str = "uploaded_at", descending: bool = False, after: tuple = None, limit: int = 50) -> list:
+        # One page of a user's files ordered by `sort` then id. `after` is the
+        # (sort value, id) of the last row of the previous page, so every
+        # page is a range scan on the matching index, however deep.
+        if sort not in ("file_name", "size", "uploaded_at"):
+            raise Exception(f"Cannot sort files by {sort}")
+        direction, compare = ("DESC", "<") if descending else ("ASC", ">")
+        query = "SELECT * FROM files WHERE user_id = ?"
+        params = [user_id]
+        if after is not None:
+            query += f" AND ({sort}, id) {compare} (?, ?)"
+            params.extend(after)
+        query += f" ORDER BY {sort} {direction}, id {direction} LIMIT ?"
+        params.append(limit)
+        self.__cursor.execute(query, params)
+        return self.__cursor.fetchall()
+
+    def get_file_totals(self, user_id: int) -> tuple:
+        # (number of files, total size in bytes)
+        self.__cursor.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM files WHERE user_id = ?", (user_id,))
+        return self.__cursor.fetchone()
+
     def get_file_by_name(self, name: str) -> list:
         self.__cursor.execute("SELECT * FROM files WHERE file_name = ?", (name,))
         return self.__cursor.fetchall()
 
     def set_filters(self, file_name: str, filters: list) -> None:
-        filters_to_str = ', '.join(map(str, filters))
-        self.__cursor.execute("UPDATE files SET file_filters = ? WHERE file_name = ?", (filters_to_str, file_name))
-        self.__conn.commit()
+        try:
+            self.__cursor.execute("SELECT id FROM files WHERE file_name = ?", (file_name,))
+            for (file_id,) in self.__cursor.fetchall():
+                self.__set_tags(file_id, [str(f) for f in filters])
+            self.__conn.commit()
+        except Exception:
+            self.__conn.rollback()
+            raise
 
     def get_filters(self) -> list:
-        self.__cursor.execute("SELECT file_filters FROM files")
-        filters_list = []
-        for row in self.__cursor.fetchall():
-            if row and row[0]:
-                filters_list.extend(row[0].split(', '))
-        return sorted(set(filters_list))
+        self.__cursor.execute("SELECT name FROM tags WHERE id IN (SELECT tag_id FROM file_tags) ORDER BY name")
+        return [row[0] for row in self.__cursor.fetchall()]
 
     def get_filters_by_name(self, filename: str) -> list:
-        self.__cursor.execute("SELECT file_filters FROM files WHERE file_name = ?", (filename,))
-        filters_list = []
-        for row in self.__cursor.fetchall():
-            if row and row[0]:
-                filters_list.extend(row[0].split(', '))
-        return filters_list
+        self.__cursor.execute("""
+            SELECT tags.name FROM files
+            JOIN file_tags ON file_tags.file_id = files.id
+            JOIN tags ON tags.id = file_tags.tag_id
+            WHERE files.file_name = ? ORDER BY tags.name
+        """, (filename,))
+        return [row[0] for row in self.__cursor.fetchall()]
 
     def get_filter_files(self, filter: str) -> list:
-        self.__cursor.execute("SELECT * FROM files WHERE file_filters GLOB ?", (f"*{filter}*",))
+        # Files carrying exactly this tag
+        self.__cursor.execute("""
+            SELECT files.* FROM tags
+            JOIN file_tags ON file_tags.tag_id = tags.id
+            JOIN files ON files.id = file_tags.file_id
+            WHERE tags.name = ?
+        """, (filter.strip().lower(),))
+        return self.__cursor.fetchall()
+
+    def set_file_tags(self, user_id: int, file_hash: str, tags: list) -> list | None:
+        # Returns the normalized tags, or None if the user has no such file
+        try:
+            self.__cursor.execute("SELECT id FROM files WHERE user_id = ? AND hash = ?", (user_id, file_hash))
+            row = self.__cursor.fetchone()
+            if row is None:
+                return None
+            tags = self.__set_tags(row[0], tags)
+            self.__conn.commit()
+            return tags
+        except Exception:
+            self.__conn.rollback()
+            raise
+
+    def get_tag_counts(self, user_id: int) -> list:
+        # (tag, number of the user's files with it), most used first
+        self.__cursor.execute("""
+            SELECT tags.name, COUNT(*) FROM files
+            JOIN file_tags ON file_tags.file_id = files.id
+            JOIN tags ON tags.id = file_tags.tag_id
+            WHERE files.user_id = ?
+            GROUP BY tags.id ORDER BY COUNT(*) DESC, tags.name
+        """, (user_id,))
+        return self.__cursor.fetchall()
+
+    def search_files(self, user_id: int, tags: list = None, match_all: bool = True, text: str = None, limit: int = 50) -> list:
+        # The user's files carrying all (or any) of `tags` and matching the
+        # words in `text` against names and tags. Rows are the files columns
+        # plus the file's tags joined by "\x1f".
+        tags = sorted({tag.strip().lower() for tag in tags or [] if tag.strip()})
+        query = "SELECT files.*, (SELECT group_concat(tags.name, char(31)) FROM file_tags JOIN tags ON tags.id = file_tags.tag_id WHERE file_tags.file_id = files.id) FROM files"
+        where = ["files.user_id = ?"]
+        params = [user_id]
+        if tags:
+            matching = f"""SELECT file_tags.file_id FROM file_tags JOIN tags ON tags.id = file_tags.tag_id
+                           WHERE tags.name IN ({", ".join("?" * len(tags))}) GROUP BY file_tags.file_id"""
+            if match_all:
+                matching += " HAVING COUNT(*) = ?"
+            where.append(f"files.id IN ({matching})")
+            params.extend(tags)
+            if match_all:
+                params.append(len(tags))
+        words = (text or "").split()
+        if words and self.fts:
+            # Every word as a quoted prefix, so user input is never parsed
+            # as FTS syntax
+            where.append("files.id IN (SELECT rowid FROM files_fts WHERE files_fts MATCH ?)")
+            params.append(" ".join('"' + word.replace('"', '""') + '"*' for word in words))
+        elif words:
+            for word in words:
+                where.append("files.file_name LIKE ? ESCAPE '\\'")
+                params.append("%" + word.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_") + "%")
+        query += " WHERE " + " AND ".join(where) + " ORDER BY files.file_name, files.id LIMIT ?"
+        params.append(limit)
+        self.__cursor.execute(query, params)
         return self.__cursor.fetchall()
 
     def get_chunks(self, main_file_hash: str) -> list:
-        self.__cursor.execute("SELECT * FROM chunks WHERE main_file = ?", (main_file_hash,))
+        self.__cursor.execute("SELECT * FROM chunks WHERE main_file = ? ORDER BY chunk_index", (main_file_hash,))
         return self.__cursor.fetchall()
 
     def get_bots(self) -> list:
         self.__cursor.execute("SELECT * FROM bot_settings")
         return self.__cursor.fetchall()
 
+    def add_bot(self, token: str, chat_id: str, domain: str = "telegram") -> int:
+        self.__cursor.execute(
+            "INSERT INTO bot_settings (domain, bot_token, chat_id) VALUES(?, ?, ?)",
+            (domain, token, chat_id)
+        )
+        self.__conn.commit()
+        return self.__cursor.lastrowid
+
     def edit_bot(self, bot: dict) -> None:
         query = "UPDATE bot_settings SET chat_id = ?, bot_token = ? WHERE id = ?"
         self.__cursor.execute(query, (bot['chat_id'], bot['token'], bot['id']))
@@ -125,13 +513,218 @@ class DBManager:
         self.__cursor.execute("DELETE FROM bot_settings WHERE id = ?", (bot_id,))
         self.__conn.commit()
 
-    def delete_file(self, file_hash: str) -> None:
+    def delete_file(self, file_hash: str, user_id: int = None) -> bool:
+        # Returns True when no file references the content any more and its
+        # chunks were released from the chunk store.
         try:
-            self.__cursor.execute("DELETE FROM files WHERE hash = ?", (file_hash,))
+            if user_id is None:
+                self.__cursor.execute("DELETE FROM files WHERE hash = ?", (file_hash,))
+            else:
+                self.__cursor.execute("DELETE FROM files WHERE hash = ? AND user_id = ?", (file_hash, user_id))
+            self.__cursor.execute("SELECT 1 FROM files WHERE hash = ? LIMIT 1", (file_hash,))
+            released = self.__cursor.fetchone() is None
+            if released:
+                self.__release_chunks(file_hash)
             self.__conn.commit()
+            return released
         except Exception as e:
+            self.__conn.rollback()
             raise Exception(f"Error deleting file from database: {e}")
 
+    def add_job(self, job_id: str, kind: str, user_id: int, payload: str, status: str) -> None:
+        now = time.time()
+        self.__cursor.execute(
+            "INSERT INTO jobs (id, kind, user_id, payload, state, status, created_at, updated_at) VALUES (?, ?, ?, ?, 'queued', ?, ?, ?)",
+            (job_id, kind, user_id, payload, status, now, now)
+        )
+        self.__conn.commit()
+
+    def claim_job(self, worker: str, max_running: int) -> tuple | None:
+        # Atomically move the oldest queued job to running, unless
+        # `max_running` jobs are already running across all processes.
+        try:
+            self.__cursor.execute("BEGIN IMMEDIATE")
+            self.__cursor.execute("SELECT COUNT(*) FROM jobs WHERE state = 'running'")
+            if self.__cursor.fetchone()[0] >= max_running:
+                self.__conn.commit()
+                return None
+            self.__cursor.execute("SELECT * FROM jobs WHERE state = 'queued' ORDER BY created_at LIMIT 1")
+            job = self.__cursor.fetchone()
+            if job is None:
+                self.__conn.commit()
+                return None
+            self.__cursor.execute(
+                "UPDATE jobs SET state = 'running', attempts = attempts + 1, worker = ?, updated_at = ? WHERE id = ?",
+                (worker, time.time(), job[0])
+            )
+            self.__conn.commit()
+        except Exception:
+            self.__conn.rollback()
+            raise
+        self.__cursor.execute("SELECT * FROM jobs WHERE id = ?", (job[0],))
+        return self.__cursor.fetchone()
+
+    def update_job(self, job_id: str, state: str = None, progress: float = None, status: str = None) -> None:
+        self.__cursor.execute(
+            """UPDATE jobs SET state = COALESCE(?, state), progress = COALESCE(?, progress),
+               status = COALESCE(?, status), updated_at = ? WHERE id = ?""",
+            (state, progress, status, time.time(), job_id)
+        )
+        self.__conn.commit()
+
+    def touch_jobs(self, worker: str) -> None:
+        # Heartbeat for every job this worker is running
+        self.__cursor.execute("UPDATE jobs SET updated_at = ? WHERE worker = ? AND state = 'running'", (time.time(), worker))
+        self.__conn.commit()
+
+    def get_job(self, job_id: str) -> tuple | None:
+        self.__cursor.execute("SELECT * FROM jobs WHERE id = ?", (job_id,))
+        return self.__cursor.fetchone()
+
+    def get_job_counts(self) -> list:
+        self.__cursor.execute("SELECT state, COUNT(*) FROM jobs GROUP BY state")
+        return self.__cursor.fetchall()
+
+    def requeue_stale_jobs(self, timeout: float, max_attempts: int) -> int:
+        # Jobs whose worker stopped sending heartbeats (crash, restart) go
+        # back to the queue, or fail once they have used up their attempts.
+        cutoff = time.time() - timeout
+        self.__cursor.execute(
+            "UPDATE jobs SET state = 'failed', status = 'Error: worker stopped responding' WHERE state = 'running' AND updated_at < ? AND attempts >= ?",
+            (cutoff, max_attempts)
+        )
+        self.__cursor.execute(
+            "UPDATE jobs SET state = 'queued', worker = NULL WHERE state = 'running' AND updated_at < ?",
+            (cutoff,)
+        )
+        requeued = self.__cursor.rowcount
+        self.__conn.commit()
+        return requeued
+
+    def purge_jobs(self, older_than: float) -> None:
+        self.__cursor.execute("DELETE FROM jobs WHERE state IN ('done', 'failed') AND updated_at < ?", (older_than,))
+        self.__conn.commit()
+
+    def add_upload_session(self, upload_id: str, user_id: int, file_name: str, size: int, part_size: int) -> None:
+        now = time.time()
+        self.__cursor.execute(
+            "INSERT INTO upload_sessions (id, user_id, file_name, size, part_size, created_at, updated_at) VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (upload_id, user_id, file_name, size, part_size, now, now)
+        )
+        self.__conn.commit()
+
+    def get_upload_session(self, upload_id: str) -> tuple | None:
+        self.__cursor.execute("SELECT * FROM upload_sessions WHERE id = ?", (upload_id,))
+        return self.__cursor.fetchone()
+
+    def add_upload_part(self, upload_id: str, part_index: int, part_hash: str, part_size: int) -> None:
+        # A part sent again replaces the earlier copy
+        now = time.time()
+        self.__cursor.execute(
+            """INSERT INTO upload_parts (upload_id, part_index, hash, size, file_id, state, updated_at)
+               VALUES (?, ?, ?, ?, NULL, 'received', ?)
+               ON CONFLICT(upload_id, part_index) DO UPDATE SET
+               hash = excluded.hash, size = excluded.size, file_id = NULL, codec = NULL, state = 'received', updated_at = excluded.updated_at""",
+            (upload_id, part_index, part_hash, part_size, now)
+        )
+        self.__cursor.execute("UPDATE upload_sessions SET updated_at = ? WHERE id = ?", (now, upload_id))
+        self.__conn.commit()
+
+    def set_upload_part(self, upload_id: str, part_index: int, part_hash: str, state: str, file_id: str = None, codec: str = None) -> None:
+        # Only applies while the stored part still has this hash, so a
+        # late send of a replaced part cannot overwrite the new one.
+        self.__cursor.execute(
+            "UPDATE upload_parts SET state = ?, file_id = ?, codec = ?, updated_at = ? WHERE upload_id = ? AND part_index = ? AND hash = ?",
+            (state, file_id, codec, time.time(), upload_id, part_index, part_hash)
+        )
+        self.__conn.commit()
+
+    def get_upload_parts(self, upload_id: str) -> list:
+        self.__cursor.execute("SELECT * FROM upload_parts WHERE upload_id = ? ORDER BY part_index", (upload_id,))
+        return self.__cursor.fetchall()
+
+    def delete_upload_session(self, upload_id: str) -> None:
+        self.__cursor.execute("DELETE FROM upload_parts WHERE upload_id = ?", (upload_id,))
+        self.__cursor.execute("DELETE FROM upload_sessions WHERE id = ?", (upload_id,))
+        self.__conn.commit()
+
+    def get_stale_upload_sessions(self, older_than: float) -> list:
+        self.__cursor.execute("SELECT id FROM upload_sessions WHERE updated_at < ?", (older_than,))
+        return [row[0] for row in self.__cursor.fetchall()]
+
+    def begin_transfer(self, kind: str, key: str, user_id: int, path: str, size: int) -> tuple:
+        # (transfer id, whether it is resumed) for the transfer with this key
+        now = time.time()
+        self.__cursor.execute(
+            "INSERT OR IGNORE INTO transfers (id, kind, key, user_id, path, size, created_at, updated_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            (str(uuid.uuid4()), kind, key, user_id, path, size, now, now)
+        )
+        resumed = self.__cursor.rowcount == 0
+        self.__cursor.execute("UPDATE transfers SET path = ?, updated_at = ? WHERE kind = ? AND key = ?", (path, now, kind, key))
+        self.__cursor.execute("SELECT id FROM transfers WHERE kind = ? AND key = ?", (kind, key))
+        transfer_id = self.__cursor.fetchone()[0]
+        self.__conn.commit()
+        return transfer_id, resumed
+
+    def get_transfer(self, transfer_id: str) -> tuple | None:
+        self.__cursor.execute("SELECT * FROM transfers WHERE id = ?", (transfer_id,))
+        return self.__cursor.fetchone()
+
+    def get_transfers(self, user_id: int) -> list:
+        # Transfers of a user with their number of chunks done
+        self.__cursor.execute("""
+            SELECT transfers.*, COUNT(transfer_chunks.chunk_index) FROM transfers
+            LEFT JOIN transfer_chunks ON transfer_chunks.transfer_id = transfers.id AND transfer_chunks.state != 'pending'
+            WHERE transfers.user_id = ? GROUP BY transfers.id ORDER BY transfers.updated_at DESC
+        """, (user_id,))
+        return self.__cursor.fetchall()
+
+    def get_transfer_chunks(self, transfer_id: str, state: str) -> list:
+        self.__cursor.execute(
+            "SELECT chunk_index, hash, file_id, size, codec FROM transfer_chunks WHERE transfer_id = ? AND state = ? ORDER BY chunk_index",
+            (transfer_id, state)
+        )
+        return self.__cursor.fetchall()
+
+    def add_transfer_chunks(self, transfer_id: str, chunks: list) -> None:
+        # (chunk_index, hash, size) rows of chunks still to do; chunks
+        # already recorded keep their state
+        self.__cursor.executemany(
+            "INSERT OR IGNORE INTO transfer_chunks (transfer_id, chunk_index, hash, size, state) VALUES (?, ?, ?, ?, 'pending')",
+            [(transfer_id, *chunk) for chunk in chunks]
+        )
+        self.__conn.commit()
+
+    def set_transfer_chunk(self, transfer_id: str, chunk_index: int, chunk_hash: str, state: str, file_id: str = None, size: int = None, codec: str = None) -> None:
+        self.__cursor.execute(
+            """INSERT INTO transfer_chunks (transfer_id, chunk_index, hash, file_id, size, codec, state) VALUES (?, ?, ?, ?, ?, ?, ?)
+               ON CONFLICT(transfer_id, chunk_index) DO UPDATE SET
+               hash = excluded.hash, file_id = excluded.file_id, size = excluded.size, codec = excluded.codec, state = excluded.state""",
+            (transfer_id, chunk_index, chunk_hash, file_id, size, codec, state)
+        )
+        self.__cursor.execute("UPDATE transfers SET updated_at = ? WHERE id = ?", (time.time(), transfer_id))
+        self.__conn.commit()
+
+    def get_sent_chunk(self, chunk_hash: str) -> tuple | None:
+        # (file_id, size, codec) of a chunk an unfinished upload already sent
+        self.__cursor.execute(
+            "SELECT file_id, size, codec FROM transfer_chunks WHERE hash = ? AND state = 'sent' LIMIT 1",
+            (chunk_hash,)
+        )
+        return self.__cursor.fetchone()
+
+    def delete_transfer(self, transfer_id: str) -> None:
+        self.__delete_transfer(transfer_id)
+        self.__conn.commit()
+
+    def __delete_transfer(self, transfer_id: str) -> None:
+        self.__cursor.execute("DELETE FROM transfer_chunks WHERE transfer_id = ?", (transfer_id,))
+        self.__cursor.execute("DELETE FROM transfers WHERE id = ?", (transfer_id,))
+
+    def get_stale_transfers(self, older_than: float) -> list:
+        self.__cursor.execute("SELECT id, kind, path FROM transfers WHERE updated_at < ?", (older_than,))
+        return self.__cursor.fetchall()
+
     def get_user_by_username(self, username: str) -> list:
         self.__cursor.execute("SELECT * FROM users WHERE username = ?", (username,))
         return self.__cursor.fetchall()
@@ -146,3 +739,9 @@ class DBManager:
         except sqlite3.IntegrityError:
             raise Exception("Username already exists.")
 
+
+# Time spent in every query method shows up on /metrics
+time_methods(DBManager, db_seconds)
+
+# Shared instance used by the app and the transfer modules
+db = DBManager(os.getenv("DB_PATH", "db.sqlite3"))
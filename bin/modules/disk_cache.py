@@ -0,0 +1,141 @@
+import os
+import uuid
+import threading
+import logging
+from collections import OrderedDict
+from bin.modules.metrics import cache_requests
+
+class DiskCache:
+    # Byte-budgeted LRU cache of downloaded content on disk, keyed by content
+    # hash (merged files by file hash, chunks by chunk hash). Recency is
+    # tracked on every access and mirrored into the file mtime, so other
+    # processes sharing the directory see the same order after a rescan.
+    def __init__(self, path: str, max_bytes: int) -> None:
+        self.path = path
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.__entries = OrderedDict()
+        self.__size = 0
+        self.__lock = threading.Lock()
+        if not os.path.exists(path):
+            os.makedirs(path)
+        with self.__lock:
+            self.__scan()
+
+    def __scan(self) -> None:
+        # Rebuild the index from disk, oldest access first
+        entries = []
+        for name in os.listdir(self.path):
+            file_path = os.path.join(self.path, name)
+            if ".tmp-" in name or name.endswith(".part") or not os.path.isfile(file_path):
+                continue
+            stat = os.stat(file_path)
+            entries.append((stat.st_mtime, name, stat.st_size))
+        self.__entries = OrderedDict((name, size) for _, name, size in sorted(entries))
+        self.__size = sum(self.__entries.values())
+
+    def __touch(self, key: str) -> str | None:
+        file_path = os.path.join(self.path, key)
+        if key not in self.__entries:
+            # Another worker process may have added it
+            if not os.path.isfile(file_path):
+                return None
+            self.__entries[key] = os.path.getsize(file_path)
+            self.__size += self.__entries[key]
+        try:
+            os.utime(file_path)
+        except FileNotFoundError:
+            # Evicted by another worker process
+            self.__size -= self.__entries.pop(key)
+            return None
+        self.__entries.move_to_end(key)
+        return file_path
+
+    def get_path(self, key: str) -> str | None:
+        with self.__lock:
+            file_path = self.__touch(key)
+            if file_path is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        cache_requests.labels("disk", "miss" if file_path is None else "hit").inc()
+        return file_path
+
+    def get_bytes(self, key: str) -> bytes | None:
+        file_path = self.get_path(key)
+        if file_path is None:
+            return None
+        try:
+            # Unlinking an open file is safe, so a concurrent eviction cannot
+            # cut this read short.
+            with open(file_path, "rb") as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def reserve(self, key: str) -> str:
+        # Temporary path in the cache directory to build an entry in; pass it
+        # to commit() when complete.
+        return os.path.join(self.path, f"{key}.tmp-{uuid.uuid4().hex}")
+
+    def partial_path(self, key: str) -> str:
+        # Stable path for an entry built over several attempts, such as a
+        # resumable download; not part of the cache until committed
+        return os.path.join(self.path, f"{key}.part")
+
+    def commit(self, key: str, temp_path: str) -> str:
+        file_path = os.path.join(self.path, key)
+        size = os.path.getsize(temp_path)
+        with self.__lock:
+            os.replace(temp_path, file_path)
+            if key in self.__entries:
+                self.__size -= self.__entries.pop(key)
+            self.__entries[key] = size
+            self.__size += size
+            self.__evict(keep=key)
+        return file_path
+
+    def put_bytes(self, key: str, data: bytes) -> str:
+        temp_path = self.reserve(key)
+        with open(temp_path, "wb") as f:
+            f.write(data)
+        return self.commit(key, temp_path)
+
+    def discard(self, key: str) -> None:
+        with self.__lock:
+            if key in self.__entries:
+                self.__size -= self.__entries.pop(key)
+            try:
+                os.remove(os.path.join(self.path, key))
+            except FileNotFoundError:
+                pass
+
+    def __evict(self, keep: str) -> None:
+        if self.__size > self.max_bytes:
+            # Other worker processes write to the same directory
+            self.__scan()
+        while self.__size > self.max_bytes and len(self.__entries) > 1:
+            key = next(iter(self.__entries))
+            if key == keep:
+                self.__entries.move_to_end(key)
+                continue
+            self.__size -= self.__entries.pop(key)
+            try:
+                os.remove(os.path.join(self.path, key))
+                self.evictions += 1
+                logging.debug("Evicted from cache: %s", key)
+            except FileNotFoundError:
+                pass
+
+    def stats(self) -> dict:
+        with self.__lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "entries": len(self.__entries),
+                "bytes": self.__size,
+                "max_bytes": self.max_bytes,
+            }
@@ -1,80 +1,448 @@
+import io
 import os
+import asyncio
+import hashlib
+import fcntl
 import threading
+import math
 import logging
-from bin.modules.db_manager import DBManager
-from bin.modules.file_manager import FileManager
-from bin.modules.telegram_bot import TelegramBot
-from bin.modules.utils import split_chunks
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from bin.modules.async_engine import AsyncTransferEngine, transfer_engine
+from bin.modules.bot_controller import max_in_flight
+from bin.modules.bot_pool import bot_pool
+from bin.modules.chunk_cache import ChunkCache
+from bin.modules.chunk_codec import chunk_codec
+from bin.modules.chunk_scheduler import ChunkScheduler
+from bin.modules.db_manager import db
+from bin.modules.disk_cache import DiskCache
+from bin.modules.file_manager import FileManager, PositionalWriter, HashingWriter, OrderedDigest
+from bin.modules.metrics import active_transfers
+from bin.modules.telegram_bot import TelegramBot, TelegramError
 
 # Configure logging
-logging.basicConfig(level=logging.DEBUG, format='%(asctime)s - %(levelname)s - %(message)s')
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
-db = DBManager()
 fm = FileManager()
 lock = threading.Lock()
+chunk_cache = ChunkCache()
+# Downloaded chunks and merged files, evicted least recently used first once
+# CACHE_MAX_BYTES (default 10 GB) is exceeded
+disk_cache = DiskCache(fm.output_path, int(os.getenv("CACHE_MAX_BYTES", 10 * 1024 ** 3)))
+prefetch_executor = ThreadPoolExecutor(max_workers=2)
 
 class Downloader:
-    def __init__(self, filename: str):
+    def __init__(self, filename: str, file_hash: str = None, progress_callback=None, user_id: int = None):
         self.filename = filename
+        self.file_hash = file_hash
+        # User the download checkpoint is listed for in /transfers
+        self.user_id = user_id
+        # Called with a dict of progress details after every chunk
+        self.progress_callback = progress_callback
         self.t_bots = []
         self.chunks_total = 0
+        self.bytes_total = None
         self.downloaded_chunks_counter = 0
+        self.downloaded_bytes = 0
+        self.bot_chunks = {}
+        # Whole-file MD5 built while downloading; None for tree hashes
+        self.digest = None
+        # Checkpoint of an in-place download in the transfers table
+        self.transfer_id = None
+        # Chunks fetched ahead of the one currently being sent to the client
+        self.read_ahead = 4
 
-    def run(self):
+    def load_bots(self):
+        self.t_bots = bot_pool.get_bots()
+        if not self.t_bots:
+            raise Exception("No Telegram bots configured.")
+
+    def get_chunks(self) -> list:
+        if self.file_hash is None:
+            self.file_hash = db.get_file_by_name(self.filename)[0][2]
+        chunks = db.get_chunks(self.file_hash)
+        self.chunks_total = len(chunks)
+        return chunks
+
+    def get_content_length(self, chunks: list) -> int | None:
+        # Rows written before chunk sizes were recorded have no size
+        sizes = [chunk[6] for chunk in chunks]
+        if None in sizes:
+            return None
+        return sum(sizes)
+
+    @active_transfers.labels("download").track_inprogress()
+    def run(self) -> str:
         logging.info('Start download')
+        chunks = self.get_chunks()
 
-        for obj in db.get_bots():
-            bot = TelegramBot(obj[2], obj[3])
-            self.t_bots.append(bot)
-        logging.info(f"Initialized {len(self.t_bots)} Telegram bots")
+        # Hot files are served from the cache without touching Telegram
+        output_file_path = disk_cache.get_path(self.file_hash)
+        if output_file_path:
+            logging.info(f"File served from cache: {output_file_path}")
+            return output_file_path
 
-        file_hash = db.get_file_by_name(self.filename)[0][2]
-        chunks = db.get_chunks(file_hash)
-        chunk_groups = split_chunks(chunks, len(self.t_bots))
-        self.chunks_total = len(chunks)
+        self.load_bots()
+        self.bytes_total = self.get_content_length(chunks)
+        if self.bytes_total is not None:
+            output_file_path = self.download_in_place(chunks)
+            logging.info(f"File downloaded: {output_file_path}")
+            return output_file_path
 
+        # Chunk sizes are unknown, so download chunk files and merge them
         logging.info('Downloading chunks')
-        threads = []
-        for i, chunks in enumerate(chunk_groups):
-            thread = threading.Thread(target=self.bot_download, args=(chunks, self.t_bots[i]))
-            threads.append(thread)
-            thread.start()
-        for thread in threads:
-            thread.join()
-
-        # Merge chunks into a single file
-        output_file_path = fm.merge_chunks(self.filename, file_hash)
-        logging.info(f"File merged: {output_file_path}")
-
-        # Comment out or remove deletion of the merged file:
-        # try:
-        #     os.remove(output_file_path)
-        #     logging.info(f"Deleted merged file from output folder: {output_file_path}")
-        # except Exception as e:
-        #     logging.error(f"Error deleting merged file from output folder: {e}")
-
-    def bot_download(self, chunks: list, bot: TelegramBot):
-        for chunk in chunks:
-            chunk_hash = chunk[1]
-            chunk_file_id = chunk[3]
-            logging.info(f"Downloading chunk: {chunk_file_id}")
-
-            # Download chunk using Telegram bot
-            try:
-                chunk_data = bot.download_document(chunk_file_id)
-                chunk_path = os.path.join(fm.loaded_chunks, f"{chunk_hash}.chunk")
-                with open(chunk_path, "wb") as chunk_file:
-                    chunk_file.write(chunk_data)
-                logging.info(f"Downloaded chunk: {chunk_path}")
-            except Exception as e:
-                logging.error(f"Error downloading chunk from Telegram: {e}")
-                continue
+        try:
+            if transfer_engine == "async":
+                AsyncTransferEngine(self.t_bots, operation="fetch").map(self.async_bot_download, chunks)
+            else:
+                ChunkScheduler(self.t_bots, operation="fetch").map(self.bot_download, chunks)
 
+            # Merge chunks into a single file, hashing it on the way for MD5
+            # file hashes, and hand it over to the cache once it checks out
+            if not self.file_hash.startswith("mt-"):
+                self.digest = hashlib.md5()
+            temp_path = disk_cache.reserve(self.file_hash)
+            fm.merge_chunks(os.path.basename(temp_path), self.file_hash, disk_cache.path, self.digest)
             try:
-                lock.acquire(True)
-                self.downloaded_chunks_counter += 1
-                logging.info(f"Chunk downloaded: {chunk_hash}")
-            except Exception as e:
-                logging.error(f"Error processing downloaded chunk: {e}")
-            finally:
-                lock.release()
+                self.verify_file(chunks)
+            except Exception:
+                os.remove(temp_path)
+                raise
+            output_file_path = disk_cache.commit(self.file_hash, temp_path)
+            logging.info(f"File merged: {output_file_path}")
+        finally:
+            for chunk in chunks:
+                try:
+                    os.remove(os.path.join(fm.loaded_chunks, f"{self.file_hash}_{chunk[3]}"))
+                except FileNotFoundError:
+                    pass
+        return output_file_path
+
+    def download_in_place(self, chunks: list) -> str:
+        # Every chunk is written straight to its offset in a preallocated
+        # file as it arrives, so there is no separate merge pass. Chunks are
+        # hashed as they stream in and fetched again on a mismatch; the file
+        # only enters the cache once its own hash checks out too. Verified
+        # chunks are checkpointed, so a download that failed or whose
+        # process died continues from its .part file in the cache directory.
+        temp_path, fd, resumed = self.open_part_file()
+        try:
+            if not self.file_hash.startswith("mt-"):
+                self.digest = OrderedDigest(fd, [chunk[6] for chunk in chunks], fm.hash_buffer)
+            done = self.resumed_chunks(fd, chunks) if resumed else set()
+            if resumed:
+                logging.info(f"Resuming download {self.transfer_id}: {len(done)} of {len(chunks)} chunks already verified")
+            if self.transfer_id is not None:
+                db.add_transfer_chunks(self.transfer_id, [(chunk[3], chunk[2], chunk[6]) for chunk in chunks])
+
+            items = []
+            offset = 0
+            for position, chunk in enumerate(chunks):
+                if position in done:
+                    if self.digest is not None:
+                        self.digest.complete(position)
+                    self.add_downloaded_chunk(chunk[3], chunk[6], "resumed")
+                else:
+                    items.append((chunk, PositionalWriter(fd, offset, chunk[6]), position))
+                offset += chunk[6]
+
+            logging.info('Downloading chunks')
+            if transfer_engine == "async":
+                AsyncTransferEngine(self.t_bots, operation="fetch").map(self.async_bot_write, items)
+            else:
+                ChunkScheduler(self.t_bots, operation="fetch").map(self.bot_write, items)
+        except Exception:
+            os.close(fd)
+            if self.transfer_id is None:
+                os.remove(temp_path)
+            else:
+                logging.info(f"Download {self.transfer_id} can be resumed")
+            raise
+
+        try:
+            self.verify_file(chunks)
+        except Exception:
+            # Nothing in the part file can be trusted; start over next time
+            os.close(fd)
+            os.remove(temp_path)
+            if self.transfer_id is not None:
+                db.delete_transfer(self.transfer_id)
+            raise
+        output_file_path = disk_cache.commit(self.file_hash, temp_path)
+        if self.transfer_id is not None:
+            db.delete_transfer(self.transfer_id)
+        os.close(fd)
+        return output_file_path
+
+    def open_part_file(self) -> tuple:
+        # (path, descriptor, whether an earlier attempt is resumed) of the
+        # file to download into, allocated at its final size
+        temp_path = disk_cache.partial_path(self.file_hash)
+        fd = os.open(temp_path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            # Another download of this file holds the part file; this one
+            # gets a file of its own and no checkpoints
+            os.close(fd)
+            temp_path = disk_cache.reserve(self.file_hash)
+            return temp_path, fm.preallocate(temp_path, self.bytes_total), False
+        try:
+            self.transfer_id, resumed = db.begin_transfer("download", self.file_hash, self.user_id, temp_path, self.bytes_total)
+            if not resumed or os.fstat(fd).st_size != self.bytes_total:
+                os.ftruncate(fd, 0)
+                resumed = False
+            fm.allocate(fd, self.bytes_total)
+        except Exception:
+            os.close(fd)
+            raise
+        return temp_path, fd, resumed
+
+    def resumed_chunks(self, fd: int, chunks: list) -> set:
+        # Positions of chunks an earlier attempt verified that still match
+        # their hash in the part file. They are hashed again from local disk,
+        # in parallel, since the last writes may not have reached it.
+        verified = {row[0]: row[1] for row in db.get_transfer_chunks(self.transfer_id, "verified")}
+        candidates = []
+        offset = 0
+        for position, chunk in enumerate(chunks):
+            if verified.get(chunk[3]) == chunk[2]:
+                candidates.append((position, offset, chunk))
+            offset += chunk[6]
+
+        def check(candidate: tuple) -> bool:
+            position, offset, chunk = candidate
+            return fm.hash_region(fd, offset, chunk[6]) == chunk[2]
+
+        with ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+            return {candidate[0] for candidate, ok in zip(candidates, executor.map(check, candidates)) if ok}
+
+    def verify_chunk(self, chunk: tuple, writer) -> None:
+        # A chunk that does not match its stored hash raises, so the
+        # scheduler fetches just that chunk again
+        if not writer.verify(chunk[2]):
+            raise Exception(f"Chunk {chunk[3]} does not match its hash")
+
+    def verify_file(self, chunks: list) -> None:
+        # Every chunk was checked as it arrived, so a tree hash follows from
+        # the chunk hashes alone; MD5 file hashes come from self.digest
+        if self.file_hash.startswith("mt-"):
+            file_hash = fm.tree_hash([chunk[2] for chunk in chunks])
+        else:
+            file_hash = self.digest.hexdigest()
+        if file_hash != self.file_hash:
+            raise Exception(f"Downloaded file does not match its hash {self.file_hash}")
+
+    def stream(self, chunks: list = None, start: int = 0, end: int = None):
+        # Yield bytes start..end (inclusive) of the file in order, while the
+        # following chunks are already being fetched in parallel; nothing is
+        # written to disk. Byte ranges need stored chunk sizes.
+        if not self.t_bots:
+            self.load_bots()
+        if chunks is None:
+            chunks = self.get_chunks()
+
+        # Map the byte range onto chunk indexes plus offsets inside them
+        selected = []
+        if start == 0 and end is None:
+            selected = [(chunk, 0, None) for chunk in chunks]
+        else:
+            offset = 0
+            for chunk in chunks:
+                chunk_start, chunk_end = offset, offset + chunk[6] - 1
+                offset += chunk[6]
+                if chunk_end < start:
+                    continue
+                if end is not None and chunk_start > end:
+                    break
+                skip = max(start - chunk_start, 0)
+                take = (min(end, chunk_end) if end is not None else chunk_end) - chunk_start + 1 - skip
+                selected.append((chunk, skip, take))
+
+        # Bot workers pull the next wanted chunk from a shared queue; only
+        # `read_ahead` chunks beyond the one being sent are ever queued, so
+        # that many workers across the bots are enough. A seek starts a new
+        # stream, and with it a new scheduler.
+        per_bot = min(max_in_flight, math.ceil((self.read_ahead + 1) / len(self.t_bots)))
+        scheduler = ChunkScheduler(self.t_bots, in_flight_per_bot=per_bot, operation="fetch")
+        scheduler.start(self.fetch_into_future, lambda item, error: item[1].set_exception(error))
+        # The whole file is checked against its hash before its last chunk
+        # is sent. Everything before that has reached the client by then, so
+        # a mismatch can only cut the response short, which the client sees
+        # as a failed download rather than a complete file.
+        whole_file = start == 0 and end is None
+        self.digest = hashlib.md5() if whole_file and not self.file_hash.startswith("mt-") else None
+        pending = deque()
+        active_transfers.labels("stream").inc()
+        try:
+            for chunk, skip, take in selected:
+                future = Future()
+                scheduler.submit((chunk, future))
+                pending.append((future, skip, take))
+                if len(pending) > self.read_ahead:
+                    yield self.next_piece(pending)
+            while len(pending) > 1:
+                yield self.next_piece(pending)
+            if pending:
+                data = self.next_piece(pending)
+                if whole_file:
+                    self.verify_file(chunks)
+                yield data
+        finally:
+            # The client may disconnect mid-stream; drop whatever is queued
+            scheduler.cancel()
+            active_transfers.labels("stream").dec()
+
+        # A player that asked for a bounded range will most likely ask for
+        # what follows next, so warm the cache with the next chunks.
+        if selected:
+            last = chunks.index(selected[-1][0])
+            for i, chunk in enumerate(chunks[last + 1:last + 1 + self.read_ahead]):
+                if not chunk_cache.contains(chunk[2]):
+                    prefetch_executor.submit(self.get_chunk_data, chunk, self.t_bots[i % len(self.t_bots)])
+
+    def next_piece(self, pending: deque) -> bytes:
+        data = self.slice_chunk(*pending.popleft())
+        if self.digest is not None:
+            self.digest.update(data)
+        return data
+
+    def slice_chunk(self, future, skip: int, take: int | None) -> bytes:
+        data = future.result()
+        if skip == 0 and (take is None or take == len(data)):
+            return data
+        return data[skip:skip + take] if take is not None else data[skip:]
+
+    def fetch_into_future(self, item: tuple, bot: TelegramBot):
+        # Errors and hash mismatches are retried by the scheduler, which
+        # fails the future once it gives up on the chunk
+        chunk, future = item
+        future.set_result(self.get_chunk_data(chunk, bot))
+
+    def get_chunk_data(self, chunk: tuple, bot: TelegramBot) -> bytes:
+        return chunk_cache.get_or_fetch(chunk[2], lambda: self.load_chunk(chunk, bot))
+
+    def load_chunk(self, chunk: tuple, bot: TelegramBot) -> bytes:
+        # Chunks are content addressed, so a cached copy is always valid
+        chunk_data = disk_cache.get_bytes(chunk[2])
+        if chunk_data is None:
+            chunk_data = self.fetch_chunk(chunk, bot)
+            disk_cache.put_bytes(chunk[2], chunk_data)
+        return chunk_data
+
+    def fetch_chunk(self, chunk: tuple, bot: TelegramBot) -> bytes:
+        chunk_index = chunk[3]
+        chunk_file_id = chunk[4]
+        logging.debug("Downloading chunk %s: %s", chunk_index, chunk_file_id)
+        buffer = HashingWriter(io.BytesIO(), chunk[6])
+        if self.receive_chunk(chunk, bot, buffer) is None:
+            raise TelegramError(f"Chunk {chunk_index} is not available", 400)
+        self.verify_chunk(chunk, buffer)
+        chunk_data = buffer.file.getvalue()
+        with lock:
+            self.downloaded_chunks_counter += 1
+            self.downloaded_bytes += len(chunk_data)
+            self.bot_chunks[bot.name] = self.bot_chunks.get(bot.name, 0) + 1
+        return chunk_data
+
+    def bot_download(self, chunk: tuple, bot: TelegramBot):
+        chunk_index = chunk[3]
+        chunk_file_id = chunk[4]
+        logging.debug("Downloading chunk: %s", chunk_file_id)
+
+        # Download chunk using Telegram bot
+        chunk_path = os.path.join(fm.loaded_chunks, f"{self.file_hash}_{chunk_index}")
+        with open(chunk_path, "wb") as chunk_file:
+            writer = HashingWriter(chunk_file, chunk[6])
+            written = self.receive_chunk(chunk, bot, writer)
+            if written is None:
+                raise TelegramError(f"Chunk {chunk_index} is not available", 400)
+        self.verify_chunk(chunk, writer)
+        logging.debug("Downloaded chunk: %s", chunk_path)
+
+        self.add_downloaded_chunk(chunk_index, written, bot.name)
+
+    def receive_chunk(self, chunk: tuple, bot: TelegramBot, destination) -> int | None:
+        # Raw chunks are streamed straight into `destination`; compressed
+        # ones are fetched whole and decoded on this worker thread.
+        if not chunk[7]:
+            return bot.download_document(chunk[4], destination)
+        payload = bot.download_document(chunk[4])
+        if payload is None:
+            return None
+        data = chunk_codec.decode(chunk[7], payload)
+        destination.write(data)
+        return len(data)
+
+    async def async_receive_chunk(self, chunk: tuple, bot, destination) -> int | None:
+        if not chunk[7]:
+            return await bot.download_document(chunk[4], destination)
+        payload = await bot.download_document(chunk[4])
+        if payload is None:
+            return None
+        data = await asyncio.get_running_loop().run_in_executor(None, chunk_codec.decode, chunk[7], payload)
+        destination.write(data)
+        return len(data)
+
+    def bot_write(self, item: tuple, bot: TelegramBot):
+        chunk, writer, position = item
+        logging.debug("Downloading chunk: %s", chunk[4])
+        writer.reset()
+        if self.receive_chunk(chunk, bot, writer) is None:
+            raise TelegramError(f"Chunk {chunk[3]} is not available", 400)
+        self.verify_chunk(chunk, writer)
+        self.chunk_written(chunk, position, writer.written, bot.name)
+
+    async def async_bot_write(self, item: tuple, bot):
+        chunk, writer, position = item
+        logging.debug("Downloading chunk: %s", chunk[4])
+        writer.reset()
+        if await self.async_receive_chunk(chunk, bot, writer) is None:
+            raise TelegramError(f"Chunk {chunk[3]} is not available", 400)
+        self.verify_chunk(chunk, writer)
+        # The checkpoint, hashing and progress callback block, so keep them
+        # off the event loop
+        await asyncio.get_running_loop().run_in_executor(None, self.chunk_written, chunk, position, writer.written, bot.name)
+
+    def chunk_written(self, chunk: tuple, position: int, written: int, source: str):
+        if self.transfer_id is not None:
+            db.set_transfer_chunk(self.transfer_id, chunk[3], chunk[2], "verified", size=chunk[6])
+        if self.digest is not None:
+            self.digest.complete(position)
+        self.add_downloaded_chunk(chunk[3], written, source)
+
+    async def async_bot_download(self, chunk: tuple, bot):
+        chunk_index = chunk[3]
+        chunk_file_id = chunk[4]
+        logging.debug("Downloading chunk: %s", chunk_file_id)
+
+        chunk_path = os.path.join(fm.loaded_chunks, f"{self.file_hash}_{chunk_index}")
+        with open(chunk_path, "wb") as chunk_file:
+            writer = HashingWriter(chunk_file, chunk[6])
+            written = await self.async_receive_chunk(chunk, bot, writer)
+            if written is None:
+                raise TelegramError(f"Chunk {chunk_index} is not available", 400)
+        self.verify_chunk(chunk, writer)
+        logging.debug("Downloaded chunk: %s", chunk_path)
+
+        await asyncio.get_running_loop().run_in_executor(None, self.add_downloaded_chunk, chunk_index, written, bot.name)
+
+    def add_downloaded_chunk(self, chunk_index: int, chunk_size: int, source: str):
+        with lock:
+            self.downloaded_chunks_counter += 1
+            self.downloaded_bytes += chunk_size
+            self.bot_chunks[source] = self.bot_chunks.get(source, 0) + 1
+            progress = self.get_progress()
+            logging.debug("Chunk downloaded: %s", chunk_index)
+        if self.progress_callback:
+            self.progress_callback(progress)
+
+    def get_progress(self) -> dict:
+        return {
+            "stage": "download",
+            "bytes_done": self.downloaded_bytes,
+            "bytes_total": self.bytes_total,
+            "chunks_done": self.downloaded_chunks_counter,
+            "chunks_total": self.chunks_total,
+            "bots": dict(self.bot_chunks),
+        }
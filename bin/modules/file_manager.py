@@ -1,6 +1,19 @@
 import os
 import hashlib
 import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from bin.modules.cdc import FastCDC
+
+# "md5" identifies files by an MD5 over the whole file; "tree" by a hash
+# over their ordered chunk digests, which is computed in parallel. Files
+# stored under either mode stay readable, but a file is only deduplicated
+# against files stored under the mode in use, so switching an existing
+# store to "tree" stores files it already has once more.
+hash_mode = os.getenv("HASH_MODE", "md5")
+# "fixed" splits files every chunk_size MB; "cdc" cuts at content-defined
+# boundaries, so an edited file shares most chunks with its old version.
+split_strategy = os.getenv("SPLIT_STRATEGY", "fixed")
 
 class FileManager:
     def __init__(self, base_path="TEMP", base_output="output"):
@@ -9,6 +22,12 @@ class FileManager:
         self.loaded_chunks = self.create_path(os.path.join(self.base_path, "loaded"))
         self.output_path = self.create_path(base_output)
         self.chunk_size = 20  # MB
+        # Content-defined chunk bounds; the maximum is chunk_size, which
+        # Telegram bots can still download
+        self.cdc_min_size = 2  # MB
+        self.cdc_avg_size = 8  # MB
+        # Read size used when hashing chunks from disk
+        self.hash_buffer = 4 * 1024 * 1024
 
     def create_path(self, path: str) -> str:
         if not os.path.exists(path):
@@ -25,10 +44,47 @@ class FileManager:
                     yield len(chunk)  # Progress info (if needed)
         return gen(), hasher
 
+    def tree_hash(self, chunk_hashes: list) -> str:
+        # File hash derived from the ordered MD5s of its chunks. The prefix
+        # keeps it apart from whole-file MD5s.
+        return "mt-" + hashlib.sha256(b"".join(bytes.fromhex(h) for h in chunk_hashes)).hexdigest()
+
+    def get_tree_hash(self, file_path: str, workers: int = None) -> str:
+        # Tree hash of a file on disk. Chunks are read with large positional
+        # reads and hashed on a thread pool; hashlib releases the GIL on big
+        # buffers, so this scales with cores. Matches files stored with the
+        # fixed split strategy.
+        chunk_size_bytes = self.chunk_size * 1024 * 1024
+        size = os.path.getsize(file_path)
+        fd = os.open(file_path, os.O_RDONLY)
+
+        def digest(offset: int) -> str:
+            return self.hash_region(fd, offset, min(chunk_size_bytes, size - offset))
+
+        try:
+            with ThreadPoolExecutor(max_workers=workers or os.cpu_count()) as executor:
+                chunk_hashes = list(executor.map(digest, range(0, size, chunk_size_bytes)))
+        finally:
+            os.close(fd)
+        return self.tree_hash(chunk_hashes)
+
+    def hash_region(self, fd: int, offset: int, size: int) -> str:
+        # MD5 of `size` bytes at `offset`, read with positional reads
+        hasher = hashlib.md5()
+        end = offset + size
+        while offset < end:
+            data = os.pread(fd, min(self.hash_buffer, end - offset), offset)
+            if not data:
+                break
+            hasher.update(data)
+            offset += len(data)
+        return hasher.hexdigest()
+
     def get_file_size(self, file_path: str) -> int:
         return os.path.getsize(file_path)
 
-    def merge_chunks(self, filename: str, filehash: str, filepath: str = None) -> str:
+    def merge_chunks(self, filename: str, filehash: str, filepath: str = None, hasher=None) -> str:
+        # `hasher`, if given, is fed the merged file as it is written
         if filepath is None:
             filepath = self.output_path
         output_file_path = os.path.join(filepath, filename)
@@ -37,7 +93,7 @@ class FileManager:
         chunks = [f for f in os.listdir(self.loaded_chunks) 
                   if f.startswith(filehash) and "_" in f]
         
-        logging.info(f"Chunks found for merging: {chunks}")
+        logging.debug("Chunks found for merging: %s", chunks)
         
         try:
             # Sort chunks based on the index (the part after the underscore)
@@ -50,58 +106,136 @@ class FileManager:
             for chunk in chunks:
                 chunk_path = os.path.join(self.loaded_chunks, chunk)
                 with open(chunk_path, 'rb') as chunk_file:
-                    output_file.write(chunk_file.read())
+                    data = chunk_file.read()
+                output_file.write(data)
+                if hasher is not None:
+                    hasher.update(data)
         
         return output_file_path
 
-    def split_file(self, file_path: str):
-        # Assumes that self.hash_filename is already set
+    def preallocate(self, file_path: str, size: int) -> int:
+        # Create `file_path` at its final size and return a descriptor open
+        # for positional writes
+        fd = os.open(file_path, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o644)
+        self.allocate(fd, size)
+        return fd
+
+    def allocate(self, fd: int, size: int) -> None:
+        # Grow the open file to `size`, keeping what is already written
+        try:
+            os.posix_fallocate(fd, 0, size)
+        except (AttributeError, OSError):
+            # Not supported on every platform and filesystem; a sparse file
+            # works too
+            os.ftruncate(fd, size)
+
+    def chunker(self) -> FastCDC:
+        max_size = self.chunk_size * 1024 * 1024
+        return FastCDC(
+            min(int(self.cdc_min_size * 1024 * 1024), max_size),
+            min(int(self.cdc_avg_size * 1024 * 1024), max_size),
+            max_size,
+        )
+
+    def read_chunks(self, file_path: str, hasher=None):
         with open(file_path, "rb") as f:
-            i = 0
-            while True:
-                data = f.read(self.chunk_size * 1024 * 1024)
-                if not data:
-                    break
-                i += 1
-                # Format: filehash_index
-                yield f"{self.hash_filename}_{i}", data
-
-    def process_file(self, file_path: str):
-        # Calculate file hash and update self.hash_filename
-        gen, hasher = self.get_file_hash(file_path)
-        for _ in gen:
-            pass
-        self.hash_filename = hasher.hexdigest()
-        
-        file_size_bytes = self.get_file_size(file_path)
-        chunk_size_bytes = self.chunk_size * 1024 * 1024
+            yield from self.read_stream(f, hasher)
 
-        if file_size_bytes <= chunk_size_bytes:
-            # File is small; do not split
-            chunk_name = f"{self.hash_filename}_1"
-            chunk_path = os.path.join(self.split_chunks, chunk_name)
-            with open(file_path, "rb") as src:
-                data = src.read()
-            with open(chunk_path, "wb") as dst:
-                dst.write(data)
-            logging.info(f"File size ({file_size_bytes} bytes) is less than or equal to {chunk_size_bytes} bytes. Not splitting.")
-            yield "1"
+    def read_stream(self, f, hasher=None):
+        # Single pass over the source: every chunk is read once, fed to the
+        # whole-file hasher and handed to the caller as an in-memory buffer.
+        # `f` only needs read(n) returning n bytes until the end, so it may
+        # be something still being produced, like a torrent stream.
+        chunk_size_bytes = self.chunk_size * 1024 * 1024
+        if split_strategy == "cdc":
+            pieces = self.chunker().split(f)
         else:
-            # File is larger; split into chunks
-            for file_name, data in self.split_file(file_path):
-                chunk_path = os.path.join(self.split_chunks, file_name)
-                with open(chunk_path, "wb") as f:
-                    f.write(data)
-                logging.info(f"Created chunk: {file_name}")
-                yield file_name.split('_')[1]
-
-    def get_split_chunks(self, dir_chunks: str = None) -> list:
-        if not dir_chunks:
-            dir_chunks = self.split_chunks
-        chunks = os.listdir(dir_chunks)
-        try:
-            chunks = sorted(chunks, key=lambda x: int(x.split("_")[1]))
-        except (IndexError, ValueError) as e:
-            logging.error(f"Error sorting split chunks: {e}")
-            raise
-        return chunks
+            pieces = iter(lambda: f.read(chunk_size_bytes), b"")
+        for i, data in enumerate(pieces, 1):
+            if hasher is not None:
+                hasher.update(data)
+            yield i, data
+
+class PositionalWriter:
+    # File-like view of one chunk's region in a preallocated file. Writes go
+    # to `offset` onwards with os.pwrite, so chunks can land in any order
+    # from any thread, and are hashed on the way through for verification.
+    def __init__(self, fd: int, offset: int, size: int) -> None:
+        self.fd = fd
+        self.offset = offset
+        self.size = size
+        self.written = 0
+        self.hasher = hashlib.md5()
+
+    def reset(self) -> None:
+        # Start over, e.g. when a failed download of the chunk is retried
+        self.written = 0
+        self.hasher = hashlib.md5()
+
+    def write(self, data) -> int:
+        if self.written + len(data) > self.size:
+            raise Exception(f"Chunk at offset {self.offset} is larger than {self.size} bytes")
+        view = memoryview(data)
+        while view:
+            n = os.pwrite(self.fd, view, self.offset + self.written)
+            self.written += n
+            view = view[n:]
+        self.hasher.update(data)
+        return len(data)
+
+    def verify(self, chunk_hash: str) -> bool:
+        return self.written == self.size and self.hasher.hexdigest() == chunk_hash
+
+class HashingWriter:
+    # Passes writes through to `file` and hashes them on the way, so a
+    # downloaded chunk is verified without reading it again
+    def __init__(self, file, size: int = None) -> None:
+        self.file = file
+        # Expected size, if known
+        self.size = size
+        self.written = 0
+        self.hasher = hashlib.md5()
+
+    def write(self, data) -> int:
+        self.file.write(data)
+        self.hasher.update(data)
+        self.written += len(data)
+        return len(data)
+
+    def verify(self, chunk_hash: str) -> bool:
+        return (self.size is None or self.written == self.size) and self.hasher.hexdigest() == chunk_hash
+
+class OrderedDigest:
+    # Whole-file MD5 of a file whose chunks are written out of order. Once a
+    # chunk and every chunk before it are complete they are hashed, reading
+    # them back from the page cache they were just written to.
+    def __init__(self, fd: int, sizes: list, buffer: int = 4 * 1024 * 1024) -> None:
+        self.fd = fd
+        self.sizes = sizes
+        self.buffer = buffer
+        self.hasher = hashlib.md5()
+        self.next = 0
+        self.offset = 0
+        self.done = set()
+        self.lock = threading.Lock()
+
+    def complete(self, position: int) -> None:
+        # `position` is the chunk's place in `sizes`
+        with self.lock:
+            self.done.add(position)
+            while self.next in self.done:
+                end = self.offset + self.sizes[self.next]
+                while self.offset < end:
+                    data = os.pread(self.fd, min(self.buffer, end - self.offset), self.offset)
+                    if not data:
+                        raise Exception(f"File ends at {self.offset}, expected {end} bytes")
+                    self.hasher.update(data)
+                    self.offset += len(data)
+                self.done.discard(self.next)
+                self.next += 1
+
+    def hexdigest(self) -> str | None:
+        # None until every chunk is complete
+        if self.next < len(self.sizes):
+            return None
+        return self.hasher.hexdigest()
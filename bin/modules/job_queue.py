@@ -0,0 +1,126 @@
+import os
+import time
+import json
+import uuid
+import socket
+import threading
+import logging
+from bin.modules.db_manager import DBManager
+from bin.modules.progress_broker import ProgressBroker
+
+class JobQueue:
+    # Durable ingest queue on top of the jobs table. Every worker process
+    # runs a small pool of threads that claim queued jobs; the total number
+    # of running jobs is capped across all processes, and jobs left behind
+    # by a crashed process are picked up again once their heartbeat stops.
+    def __init__(self, db: DBManager, broker: ProgressBroker = None, workers: int = None, max_running: int = None) -> None:
+        if workers is None:
+            workers = int(os.getenv("INGEST_WORKERS", 2))
+        if max_running is None:
+            max_running = int(os.getenv("MAX_ACTIVE_JOBS", 4))
+        self.db = db
+        self.broker = broker
+        self.workers = workers
+        self.max_running = max_running
+        self.max_attempts = 3
+        self.poll_interval = 1
+        self.heartbeat_interval = 15
+        self.stale_timeout = 120
+        self.worker_id = f"{socket.gethostname()}:{os.getpid()}"
+        self.__handlers = {}
+        self.__last_progress = {}
+        self.__started = False
+        self.__lock = threading.Lock()
+
+    def register(self, kind: str, handler) -> None:
+        # handler(job_id, user_id, payload) runs the job; raising fails it
+        self.__handlers[kind] = handler
+
+    def submit(self, kind: str, user_id: int, payload: dict, status: str = "Queued") -> str:
+        job_id = str(uuid.uuid4())
+        self.db.add_job(job_id, kind, user_id, json.dumps(payload), status)
+        return job_id
+
+    def progress(self, job_id: str, progress: float, status: str = None, **details) -> None:
+        # Every report goes to the in-process broker, which is cheap. The
+        # jobs table is only written when the status changes or a second has
+        # passed, since producers report far more often than anyone reads.
+        if self.broker:
+            self.broker.publish(job_id, progress=progress, **({"status": status} if status else {}), **details)
+        now = time.time()
+        with self.__lock:
+            last = self.__last_progress.get(job_id)
+            if status is None and last and now - last < 1:
+                return
+            self.__last_progress[job_id] = now
+        self.db.update_job(job_id, progress=progress, status=status)
+
+    def __finish(self, job_id: str, state: str, status: str) -> None:
+        self.db.update_job(job_id, state=state, progress=100 if state == "done" else None, status=status)
+        if self.broker:
+            job = self.get(job_id)
+            self.broker.publish(job_id, **{k: job[k] for k in ("progress", "status", "complete", "success", "error")})
+            # Late subscribers read the final state from the jobs table
+            self.broker.discard(job_id)
+
+    def get(self, job_id: str) -> dict | None:
+        job = self.db.get_job(job_id)
+        if job is None:
+            return None
+        return {
+            "id": job[0],
+            "kind": job[1],
+            "user_id": job[2],
+            "state": job[4],
+            "progress": job[5],
+            "status": job[6],
+            "complete": job[4] in ("done", "failed"),
+            "success": job[4] == "done",
+            "error": job[6].removeprefix("Error: ") if job[4] == "failed" else None,
+        }
+
+    def start(self) -> None:
+        with self.__lock:
+            if self.__started:
+                return
+            self.__started = True
+        for _ in range(self.workers):
+            threading.Thread(target=self.__work, daemon=True).start()
+        threading.Thread(target=self.__heartbeat, daemon=True).start()
+
+    def __heartbeat(self) -> None:
+        while True:
+            try:
+                self.db.touch_jobs(self.worker_id)
+                requeued = self.db.requeue_stale_jobs(self.stale_timeout, self.max_attempts)
+                if requeued:
+                    logging.info(f"Requeued {requeued} stale jobs")
+            except Exception as e:
+                logging.error(f"Error in job heartbeat: {e}")
+            time.sleep(self.heartbeat_interval)
+
+    def __work(self) -> None:
+        while True:
+            try:
+                job = self.db.claim_job(self.worker_id, self.max_running)
+            except Exception as e:
+                logging.error(f"Error claiming job: {e}")
+                job = None
+            if job is None:
+                time.sleep(self.poll_interval)
+                continue
+
+            job_id, kind, user_id, payload = job[0], job[1], job[2], json.loads(job[3])
+            logging.info(f"Running job {job_id} ({kind}), attempt {job[7]}")
+            try:
+                handler = self.__handlers.get(kind)
+                if handler is None:
+                    raise Exception(f"No handler registered for job kind '{kind}'")
+                handler(job_id, user_id, payload)
+                self.__finish(job_id, "done", "Complete")
+            except Exception as e:
+                logging.error(f"Job {job_id} failed: {e}")
+                self.__finish(job_id, "failed", f"Error: {e}")
+            finally:
+                with self.__lock:
+                    self.__last_progress.pop(job_id, None)
@@ -0,0 +1,116 @@
+import os
+import time
+import contextlib
+from functools import wraps
+
+try:
+    import prometheus_client
+    from prometheus_client import multiprocess
+    from prometheus_client.core import GaugeMetricFamily
+except ImportError:
+    prometheus_client = None
+
+# Counters and histograms for transfers, served on /metrics. Under gunicorn
+# every worker writes its values to files in PROMETHEUS_MULTIPROC_DIR (set up
+# by gunicorn.conf.py) and a scrape merges them, so any worker can answer.
+# Without prometheus_client installed every metric is a no-op.
+
+class NoMetric(contextlib.ContextDecorator):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc) -> bool:
+        return False
+
+    def labels(self, *args, **kwargs):
+        return self
+
+    def inc(self, amount: float = 1) -> None:
+        pass
+
+    def dec(self, amount: float = 1) -> None:
+        pass
+
+    def set(self, value: float) -> None:
+        pass
+
+    def observe(self, value: float) -> None:
+        pass
+
+    def time(self):
+        return self
+
+    def track_inprogress(self):
+        return self
+
+def counter(name: str, documentation: str, labels: list):
+    return prometheus_client.Counter(name, documentation, labels) if prometheus_client else NoMetric()
+
+def histogram(name: str, documentation: str, labels: list, buckets: tuple):
+    return prometheus_client.Histogram(name, documentation, labels, buckets=buckets) if prometheus_client else NoMetric()
+
+def gauge(name: str, documentation: str, labels: list):
+    # Summed over live worker processes
+    if prometheus_client is None:
+        return NoMetric()
+    return prometheus_client.Gauge(name, documentation, labels, multiprocess_mode="livesum")
+
+bot_bytes = counter("clouddrive_bot_bytes", "Chunk payload bytes moved through each bot", ["bot", "direction"])
+chunk_seconds = histogram(
+    "clouddrive_chunk_seconds", "Time to send or fetch one chunk through a bot", ["bot", "operation"],
+    (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120),
+)
+chunk_retries = counter("clouddrive_chunk_retries", "Chunk requests retried, by reason", ["operation", "reason"])
+chunk_failures = counter("clouddrive_chunk_failures", "Chunk transfers that failed", ["operation"])
+queue_depth = gauge("clouddrive_chunk_queue_depth", "Chunks waiting for a free bot worker", ["engine"])
+active_transfers = gauge("clouddrive_active_transfers", "Uploads and downloads in progress", ["kind"])
+db_seconds = histogram(
+    "clouddrive_db_query_seconds", "Time spent in DBManager methods", ["method"],
+    (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1),
+)
+cache_requests = counter("clouddrive_cache_requests", "Cache lookups by cache and result", ["cache", "result"])
+
+def time_methods(cls, metric) -> None:
+    # Observe the duration of every public method of `cls`, by name
+    if prometheus_client is None:
+        return
+    for name, method in list(vars(cls).items()):
+        if name.startswith("_") or not callable(method):
+            continue
+
+        def timed(method=method, child=metric.labels(name)):
+            @wraps(method)
+            def wrapper(*args, **kwargs):
+                started = time.perf_counter()
+                try:
+                    return method(*args, **kwargs)
+                finally:
+                    child.observe(time.perf_counter() - started)
+            return wrapper
+
+        setattr(cls, name, timed())
+
+class JobsCollector:
+    # Jobs per state, read from the jobs table at scrape time so the count
+    # is the same whichever worker is asked
+    def __init__(self, db) -> None:
+        self.db = db
+
+    def collect(self):
+        family = GaugeMetricFamily("clouddrive_jobs", "Ingest jobs by state", labels=["state"])
+        for state, count in self.db.get_job_counts():
+            family.add_metric([state], count)
+        yield family
+
+def render(db) -> tuple:
+    # (body, content type) for a /metrics response
+    if prometheus_client is None:
+        return b"# prometheus_client is not installed\n", "text/plain; charset=utf-8"
+    if os.getenv("PROMETHEUS_MULTIPROC_DIR"):
+        registry = prometheus_client.CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = prometheus_client.REGISTRY
+    jobs = prometheus_client.CollectorRegistry()
+    jobs.register(JobsCollector(db))
+    return prometheus_client.generate_latest(registry) + prometheus_client.generate_latest(jobs), prometheus_client.CONTENT_TYPE_LATEST
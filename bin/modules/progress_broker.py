@@ -0,0 +1,101 @@
+import time
+import threading
+
+class ProgressBroker:
+    # Lightweight in-process pub/sub for task progress. Producers publish as
+    # often as they like; the broker only keeps the latest state per task,
+    # and subscribers receive coalesced snapshots at a capped rate.
+    def __init__(self, max_rate: float = 2) -> None:
+        self.min_interval = 1 / max_rate
+        self.__tasks = {}
+        self.__cond = threading.Condition()
+
+    def publish(self, task_id: str, **fields) -> None:
+        now = time.time()
+        with self.__cond:
+            task = self.__tasks.setdefault(task_id, {"version": 0})
+            if fields.get("stage") not in (None, task.get("stage")):
+                # New stage, new byte counter
+                for key in ("sample", "throughput", "eta"):
+                    task.pop(key, None)
+            if "bytes_done" in fields:
+                # Throughput is a moving average over samples >= 0.5 s apart
+                sample_time, sample_bytes = task.setdefault("sample", (now, fields["bytes_done"]))
+                if now - sample_time >= 0.5:
+                    speed = max(fields["bytes_done"] - sample_bytes, 0) / (now - sample_time)
+                    task["throughput"] = speed if "throughput" not in task else 0.7 * task["throughput"] + 0.3 * speed
+                    task["sample"] = (now, fields["bytes_done"])
+            task.update(fields)
+            if task.get("throughput") and task.get("bytes_total"):
+                task["eta"] = max(task["bytes_total"] - task.get("bytes_done", 0), 0) / task["throughput"]
+            task["version"] += 1
+            self.__cond.notify_all()
+
+    def get(self, task_id: str) -> dict | None:
+        with self.__cond:
+            task = self.__tasks.get(task_id)
+            return self.__snapshot(task) if task else None
+
+    def discard(self, task_id: str) -> None:
+        with self.__cond:
+            self.__tasks.pop(task_id, None)
+            self.__cond.notify_all()
+
+    def __snapshot(self, task: dict) -> dict:
+        return {k: v for k, v in task.items() if k not in ("version", "sample")}
+
+    def subscribe(self, task_id: str, fallback=None, fallback_interval: float = 2, keepalive: float = 15):
+        # Yields snapshots as they change, never more than max_rate per second,
+        # and None as a keepalive when nothing happened for a while. Tasks
+        # running in another process are not published here; `fallback()`
+        # is polled for those instead.
+        seen = -1
+        last_sent = 0
+        last_fallback = 0
+        last_fallback_state = None
+        if fallback and self.get(task_id) is None:
+            # Send the current state right away
+            last_fallback = last_sent = time.time()
+            last_fallback_state = fallback()
+            yield last_fallback_state
+            if last_fallback_state is None or last_fallback_state.get("complete"):
+                return
+        while True:
+            with self.__cond:
+                # Wakes on a new version, or when a task seen before is
+                # discarded
+                self.__cond.wait_for(
+                    lambda: self.__tasks.get(task_id, {}).get("version", -1) != seen,
+                    timeout=fallback_interval,
+                )
+                task = self.__tasks.get(task_id)
+                snapshot = self.__snapshot(task) if task and task["version"] != seen else None
+                if snapshot is not None:
+                    seen = task["version"]
+                # Only finished tasks are discarded; their final state may
+                # have been coalesced away, so it comes from the fallback
+                finished = task is None and seen != -1
+
+            if finished:
+                state = fallback() if fallback else None
+                if state is not None and state != last_fallback_state:
+                    yield state
+                return
+
+            now = time.time()
+            if snapshot is None and fallback and now - last_fallback >= fallback_interval:
+                last_fallback = now
+                state = fallback()
+                if state != last_fallback_state:
+                    last_fallback_state = snapshot = state
+
+            if snapshot is not None:
+                yield snapshot
+                last_sent = time.time()
+                if snapshot.get("complete"):
+                    return
+                # Cap the event rate; anything published meanwhile is coalesced
+                time.sleep(max(self.min_interval - (time.time() - now), 0))
+            elif time.time() - last_sent >= keepalive:
+                yield None
+                last_sent = time.time()
@@ -0,0 +1,183 @@
+import os
+import re
+import time
+import random
+import logging
+import threading
+import requests
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+from bin.modules.file_manager import FileManager
+
+# Connections per download, and the size of the ranges they fetch in turn
+connections = int(os.getenv("URL_CONNECTIONS", 8))
+segment_size = int(os.getenv("URL_SEGMENT_MB", 16)) * 1024 * 1024
+# Failed requests in a row, with no new bytes in between, before a range
+# is given up on
+segment_retries = int(os.getenv("URL_SEGMENT_RETRIES", 5))
+# (connect, read) seconds; a connection that stalls for the read timeout is
+# dropped and its range resumed on a new one
+timeout = (10, 60)
+read_size = 1024 * 1024
+
+fm = FileManager()
+
+def retryable(error: Exception) -> bool:
+    # Dropped connections, timeouts and server errors; other HTTP errors
+    # would fail the same way again
+    if isinstance(error, requests.HTTPError) and error.response is not None:
+        status = error.response.status_code
+        return status >= 500 or status in (408, 429)
+    return isinstance(error, requests.RequestException)
+
+class SegmentedDownload:
+    # HTTP download over several pooled connections. A one-byte range
+    # request finds out whether the server takes ranges and how large the
+    # file is. If it does, the file is preallocated and split into ranges
+    # that the connections fetch in parallel and write at their offsets; a
+    # range whose connection fails is requested again from its first
+    # missing byte. Servers without range support get a single stream.
+    def __init__(self, url: str, path: str, progress_callback=None) -> None:
+        self.url = url
+        self.path = path
+        # Called with (percent, bytes_done=, bytes_total=) a few times a second
+        self.progress_callback = progress_callback
+        self.size = None
+        self.bytes_done = 0
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=connections)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        # Ranges count the bytes as sent, so they must not be compressed
+        self.session.headers["Accept-Encoding"] = "identity"
+        # ETag or Last-Modified of the probed file, sent as If-Range so a
+        # file that changes mid-download is not stitched together
+        self.validator = None
+        self.__lock = threading.Lock()
+        self.__last_report = 0
+        self.__failed = False
+
+    def run(self) -> str:
+        try:
+            return self.__run()
+        except Exception:
+            # Ranged downloads preallocate the whole file, so a failed one
+            # would keep all of its disk space in TEMP
+            try:
+                os.remove(self.path)
+            except FileNotFoundError:
+                pass
+            raise
+
+    def __run(self) -> str:
+        with self.session:
+            probe = self.session.get(self.url, headers={"Range": "bytes=0-0"}, stream=True, timeout=timeout)
+            try:
+                size = self.__range_size(probe)
+                if size is None and probe.status_code == 200:
+                    # Ranges not supported: this already is the whole file
+                    return self.__single(probe)
+            finally:
+                probe.close()
+            if size is None:
+                # E.g. 416 for an empty file; ask again without a range
+                with self.session.get(self.url, stream=True, timeout=timeout) as response:
+                    return self.__single(response)
+            return self.__segmented(size)
+
+    def __range_size(self, response) -> int | None:
+        # Total size from a 206 answer to the probe, None without ranges
+        if response.status_code != 206:
+            return None
+        match = re.fullmatch(r"bytes 0-0/(\d+)", response.headers.get("Content-Range", "").strip())
+        if not match:
+            return None
+        etag = response.headers.get("ETag")
+        # Weak ETags are not allowed in If-Range
+        self.validator = etag if etag and not etag.startswith("W/") else response.headers.get("Last-Modified")
+        return int(match.group(1))
+
+    def __single(self, response) -> str:
+        response.raise_for_status()
+        self.size = int(response.headers.get("content-length", 0)) or None
+        with open(self.path, "wb") as f:
+            for data in response.iter_content(chunk_size=read_size):
+                if data:
+                    f.write(data)
+                    self.__add(len(data))
+        return self.path
+
+    def __segmented(self, size: int) -> str:
+        self.size = size
+        ranges = [(start, min(start + segment_size, size)) for start in range(0, size, segment_size)]
+        logging.info(f"Downloading {size} bytes in {len(ranges)} ranges over up to {connections} connections")
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o644)
+        try:
+            fm.allocate(fd, size)
+            with ThreadPoolExecutor(max_workers=max(1, min(connections, len(ranges)))) as executor:
+                futures = [executor.submit(self.__fetch_range, fd, start, end) for start, end in ranges]
+                try:
+                    for future in futures:
+                        future.result()
+                except Exception:
+                    # Stop the other ranges instead of finishing a file
+                    # that will be thrown away
+                    self.__failed = True
+                    executor.shutdown(cancel_futures=True)
+                    raise
+        finally:
+            os.close(fd)
+        return self.path
+
+    def __fetch_range(self, fd: int, start: int, end: int) -> None:
+        position = start
+        failures = 0
+        while position < end:
+            headers = {"Range": f"bytes={position}-{end - 1}"}
+            if self.validator:
+                headers["If-Range"] = self.validator
+            try:
+                with self.session.get(self.url, headers=headers, stream=True, timeout=timeout) as response:
+                    response.raise_for_status()
+                    if response.status_code != 206:
+                        raise Exception("The file changed on the server during the download")
+                    # Bytes of any other range would land at the wrong offset
+                    content_range = response.headers.get("Content-Range", "").strip()
+                    match = re.fullmatch(r"bytes (\d+)-(\d+)/(\d+|\*)", content_range)
+                    if not match or int(match.group(1)) != position or match.group(3) not in ("*", str(self.size)):
+                        raise Exception(f"Asked for bytes {position}-{end - 1}, got {content_range or 'no Content-Range'}")
+                    for data in response.iter_content(chunk_size=read_size):
+                        if self.__failed:
+                            return
+                        view = memoryview(data)[:end - position]
+                        while view:
+                            n = os.pwrite(fd, view, position)
+                            position += n
+                            self.__add(n)
+                            view = view[n:]
+                        failures = 0
+                        if position >= end:
+                            break
+                if position < end:
+                    raise requests.ConnectionError(f"Connection closed {end - position} bytes before the end of the range")
+            except Exception as e:
+                if self.__failed or not retryable(e):
+                    raise
+                failures += 1
+                if failures > segment_retries:
+                    raise Exception(f"Range {start}-{end - 1} failed after {failures} attempts: {e}")
+                logging.warning(f"Range {position}-{end - 1} failed, resuming: {e}")
+                time.sleep(random.uniform(0, min(10, 0.5 * 2 ** failures)))
+
+    def __add(self, n: int) -> None:
+        # Progress over every range, reported a few times per second rather
+        # than per read
+        with self.__lock:
+            self.bytes_done += n
+            now = time.monotonic()
+            if not self.progress_callback or not self.size:
+                return
+            if now - self.__last_report < 0.25 and self.bytes_done != self.size:
+                return
+            self.__last_report = now
+            self.progress_callback(self.bytes_done / self.size * 100, bytes_done=self.bytes_done, bytes_total=self.size)
@@ -2,13 +2,43 @@ import os
 import json
 import requests
 import time
+from requests.adapters import HTTPAdapter
 from dotenv import load_dotenv
+from bin.modules.bot_controller import BotController, max_in_flight
+from bin.modules.metrics import bot_bytes, chunk_seconds
 
 # Load environment variables from .env file
 load_dotenv()
 
+# Bot API server; point TELEGRAM_API_URL at a local Bot API server or at
+# benchmarks/mock_telegram.py
+api_url = os.getenv("TELEGRAM_API_URL", "https://api.telegram.org").rstrip("/")
+
+class TelegramError(Exception):
+    # An error answer from the Bot API; retry_after is set on 429s
+    def __init__(self, message: str, status: int = None, retry_after: float = None) -> None:
+        super().__init__(message)
+        self.status = status
+        self.retry_after = retry_after
+
+    @property
+    def permanent(self) -> bool:
+        # Requests that would fail the same way however often they are sent
+        return self.status in (400, 401, 403, 404)
+
+def api_error(action: str, status: int, response_data: dict | None, headers: dict) -> TelegramError:
+    response_data = response_data or {}
+    retry_after = (response_data.get("parameters") or {}).get("retry_after") or headers.get("Retry-After")
+    status = response_data.get("error_code") or status
+    if status == 429 and retry_after is None:
+        retry_after = 1
+    return TelegramError(
+        f"Error {action}: {status} {response_data.get('description', '')}".rstrip(),
+        status, float(retry_after) if retry_after is not None else None,
+    )
+
 class TelegramBot:
-    def __init__(self, bot_token: str = None, chat_id: str = None) -> None:
+    def __init__(self, bot_token: str = None, chat_id: str = None, pool_size: int = None, name: str = "bot") -> None:
         # If bot_token or chat_id are not provided, load from environment variables.
         if bot_token is None:
             bot_token = os.getenv("TELEGRAM_BOT_TOKEN")
@@ -17,7 +47,29 @@ class TelegramBot:
             
         self.bot_token = bot_token
         self.chat_id = chat_id
-        self.base_url = f"https://api.telegram.org/bot{self.bot_token}/"
+        # Label used in progress reports
+        self.name = name
+        self.base_url = f"{api_url}/bot{self.bot_token}/"
+        self.file_url = f"{api_url}/file/bot{self.bot_token}/"
+        # Size of the streamed pieces written out by download_document
+        self.piece_size = 1024 * 1024
+        # (connect, read) seconds, so a stalled request fails and is retried
+        self.timeout = (30, 300)
+        # Decides how many requests this bot may have in flight and when,
+        # from the outcome of earlier ones
+        self.controller = BotController()
+
+        # Keep-alive session so chunks reuse TCP/TLS connections; the pool
+        # should fit every request this bot has in flight at once.
+        if pool_size is None:
+            pool_size = max_in_flight + 2
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=2, pool_maxsize=pool_size)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+    def close(self) -> None:
+        self.session.close()
 
     def update_bot_token(self, token: str) -> None:
         self.bot_token = token
@@ -25,27 +77,64 @@ class TelegramBot:
     def update_chat_id(self, id: str) -> None:
         self.chat_id = id
 
-    def send_document(self, file_path: str) -> str:
+    def send_document(self, document, file_name: str = None) -> str:
+        # `document` is either a path on disk or an in-memory chunk buffer.
+        # A single attempt; failures raise TelegramError or a requests
+        # exception and are retried by the caller.
         url = self.base_url + "sendDocument"
-        with open(file_path, "rb") as file:
-            files = {"document": file}
-            data = {"chat_id": self.chat_id}
-            response = requests.post(url, data=data, files=files)
+        data = {"chat_id": self.chat_id}
+        started = time.perf_counter()
+        if isinstance(document, (bytes, bytearray, memoryview)):
+            files = {"document": (file_name or "document", document)}
+            size = len(document)
+            response = self.session.post(url, data=data, files=files, timeout=self.timeout)
+        else:
+            with open(document, "rb") as file:
+                files = {"document": file}
+                size = os.fstat(file.fileno()).st_size
+                response = self.session.post(url, data=data, files=files, timeout=self.timeout)
+        try:
             response_data = response.json()
-            if not response_data.get("ok"):
-                raise Exception(f"Error uploading document: {response_data}")
-            return response_data["result"]["document"]["file_id"]
-
-    def download_document(self, file_id: str) -> bytes | None:
-        url = self.base_url + f"getFile?file_id={file_id}"
-        response = requests.get(url)
-        for _ in range(10):
-            if response.status_code == 200:
-                file_info = response.json()["result"]
-                file_url = f"https://api.telegram.org/file/bot{self.bot_token}/{file_info['file_path']}"
-                file_response = requests.get(file_url)
-                return file_response.content
-            elif response.status_code == 400:
-                return None
-            response = requests.get(url)
-        return None
+        except ValueError:
+            response_data = None
+        if not response_data or not response_data.get("ok"):
+            raise api_error("uploading document", response.status_code, response_data, response.headers)
+        chunk_seconds.labels(self.name, "send").observe(time.perf_counter() - started)
+        bot_bytes.labels(self.name, "sent").inc(size)
+        return response_data["result"]["document"]["file_id"]
+
+    def download_document(self, file_id: str, destination=None) -> bytes | int | None:
+        # With a writable `destination` the chunk is streamed into it piece by
+        # piece and the number of bytes written is returned; otherwise the
+        # whole chunk is returned as bytes. None means Telegram does not have
+        # the file; other failures raise and are retried by the caller.
+        url = self.base_url + "getFile"
+        started = time.perf_counter()
+        response = self.session.get(url, params={"file_id": file_id}, timeout=self.timeout)
+        if response.status_code == 400:
+            return None
+        if response.status_code != 200:
+            try:
+                response_data = response.json()
+            except ValueError:
+                response_data = None
+            raise api_error("getting file", response.status_code, response_data, response.headers)
+        file_info = response.json()["result"]
+        file_url = self.file_url + file_info["file_path"]
+        with self.session.get(file_url, stream=True, timeout=self.timeout) as file_response:
+            if file_response.status_code != 200:
+                raise api_error("downloading file", file_response.status_code, None, file_response.headers)
+            if destination is None:
+                content = file_response.content
+                self.__fetched(started, len(content))
+                return content
+            written = 0
+            for piece in file_response.iter_content(chunk_size=self.piece_size):
+                destination.write(piece)
+                written += len(piece)
+            self.__fetched(started, written)
+            return written
+
+    def __fetched(self, started: float, size: int) -> None:
+        chunk_seconds.labels(self.name, "fetch").observe(time.perf_counter() - started)
+        bot_bytes.labels(self.name, "received").inc(size)
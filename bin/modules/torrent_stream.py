@@ -0,0 +1,233 @@
+import os
+import time
+import shutil
+import ctypes
+import ctypes.util
+import zipfile
+import logging
+import libtorrent as lt
+from bin.modules.chunk_codec import chunk_codec
+
+# Bytes libtorrent may download ahead of what has been read from a stream.
+# Pieces already read are dropped from disk, so this rather than the size
+# of the torrent bounds the disk space a stream uses.
+window_bytes = int(os.getenv("TORRENT_WINDOW_MB", 256)) * 1024 * 1024
+
+# fallocate(2) flags that free the blocks of a range but keep the file size
+FALLOC_FL_KEEP_SIZE = 0x01
+FALLOC_FL_PUNCH_HOLE = 0x02
+
+try:
+    fallocate = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True).fallocate
+    fallocate.argtypes = (ctypes.c_int, ctypes.c_int, ctypes.c_longlong, ctypes.c_longlong)
+except (OSError, AttributeError, TypeError):
+    fallocate = None
+
+def punch_hole(path: str, offset: int, length: int) -> None:
+    # Give the disk space of a byte range back; the range reads as zeros
+    # afterwards. Where the platform or filesystem cannot, nothing happens.
+    if fallocate is None or length <= 0:
+        return
+    try:
+        fd = os.open(path, os.O_WRONLY)
+    except OSError:
+        return
+    try:
+        if fallocate(fd, FALLOC_FL_KEEP_SIZE | FALLOC_FL_PUNCH_HOLE, offset, length) != 0:
+            logging.debug("Could not free %s bytes of %s: errno %s", length, path, ctypes.get_errno())
+    finally:
+        os.close(fd)
+
+class ArchiveSink:
+    # Write end for zipfile that collects the archive so it can be handed
+    # out piece by piece. It is not seekable, so zipfile writes sizes and
+    # CRCs in data descriptors instead of going back to patch headers.
+    def __init__(self) -> None:
+        self.parts = []
+
+    def write(self, data) -> int:
+        self.parts.append(bytes(data))
+        return len(data)
+
+    def flush(self) -> None:
+        pass
+
+    def drain(self) -> bytes:
+        data = b"".join(self.parts)
+        self.parts = []
+        return data
+
+class TorrentStream:
+    # A ZIP archive of a torrent's files that can be read while the torrent
+    # is still downloading. Pieces are downloaded in order and only a window
+    # ahead of the reader; read() blocks until the pieces covering the next
+    # bytes have finished (libtorrent's piece_finished alerts wake it up),
+    # then takes them from libtorrent with read_piece. Pieces already read
+    # are punched out of the files on disk, so the session must not serve
+    # peers.
+    def __init__(self, session, handle, name: str, save_path: str, status_callback=None, max_wait: int = 300) -> None:
+        self.session = session
+        self.handle = handle
+        # File name of the archive
+        self.name = name
+        self.save_path = save_path
+        # Called with a status message every few seconds while waiting
+        self.status_callback = status_callback
+        # Seconds without any new data before giving up
+        self.max_wait = max_wait
+        self.info = None
+        self.info_hash = None
+        # Total size of the torrent's files; the archive is slightly larger
+        self.size = None
+        self.__files = []
+        self.__buffer = bytearray()
+        self.__archive = None
+        # read_piece results not picked up yet, by piece index
+        self.__pieces = {}
+        # Last piece read, which the next file may start in
+        self.__piece = (None, b"")
+        # Pieces before these indexes are freed on disk / may be downloaded
+        self.__released = 0
+        self.__enabled = 0
+        self.__done = 0
+        self.__progress_at = time.monotonic()
+        self.__reported = 0
+
+    def start(self) -> None:
+        # Wait for the metadata (magnet links have none at first), then
+        # only let the first window of pieces download
+        while not self.handle.status().has_metadata:
+            self.__wait(1)
+        self.info = self.handle.torrent_file()
+        files = self.files()
+        self.__files = [
+            (files.file_path(i), files.file_offset(i), files.file_size(i))
+            for i in range(files.num_files())
+            if not files.file_flags(i) & lt.file_storage.flag_pad_file
+        ]
+        self.size = sum(size for _, _, size in self.__files)
+        self.info_hash = str(self.info.info_hash())
+        self.window = max(2, window_bytes // self.info.piece_length())
+        self.handle.set_flags(lt.torrent_flags.sequential_download)
+        self.handle.prioritize_pieces([0] * self.info.num_pieces())
+        self.__enable(0)
+
+    def files(self):
+        # libtorrent 2 renamed torrent_info.files() to layout()
+        return self.info.layout() if hasattr(self.info, "layout") else self.info.files()
+
+    def read(self, size: int = -1) -> bytes:
+        # Blocks until `size` bytes, or everything left if negative, are
+        # available; fewer only at the end of the archive
+        if self.__archive is None:
+            self.__archive = self.__generate()
+        while size < 0 or len(self.__buffer) < size:
+            data = next(self.__archive, None)
+            if data is None:
+                break
+            self.__buffer += data
+        if size < 0:
+            size = len(self.__buffer)
+        data = bytes(self.__buffer[:size])
+        del self.__buffer[:size]
+        return data
+
+    def close(self) -> None:
+        try:
+            self.session.remove_torrent(self.handle)
+        finally:
+            shutil.rmtree(self.save_path, ignore_errors=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc) -> bool:
+        self.close()
+        return False
+
+    def __generate(self):
+        # Same layout as the archives built from finished torrents. Chunk
+        # codecs compress per chunk later, so entries are only deflated
+        # without one. The fixed timestamps make the archive, and so its
+        # chunks, the same every time.
+        compression = zipfile.ZIP_STORED if chunk_codec.name != "none" else zipfile.ZIP_DEFLATED
+        sink = ArchiveSink()
+        with zipfile.ZipFile(sink, "w", compression) as archive:
+            for path, offset, size in self.__files:
+                entry = zipfile.ZipInfo(path, date_time=(1980, 1, 1, 0, 0, 0))
+                entry.compress_type = compression
+                entry.external_attr = 0o644 << 16
+                # Lets zipfile decide whether the entry needs ZIP64 fields
+                entry.file_size = size
+                with archive.open(entry, "w") as target:
+                    for data in self.__file_data(offset, size):
+                        target.write(data)
+                        yield sink.drain()
+                yield sink.drain()
+        yield sink.drain()
+
+    def __file_data(self, offset: int, size: int):
+        # Bytes offset..offset + size of the torrent, a piece at a time
+        piece_length = self.info.piece_length()
+        end = offset + size
+        while offset < end:
+            index = offset // piece_length
+            start = offset - index * piece_length
+            data = memoryview(self.__read_piece(index))[start:start + end - offset]
+            offset += len(data)
+            yield data
+
+    def __read_piece(self, index: int) -> bytes:
+        if self.__piece[0] == index:
+            return self.__piece[1]
+        self.__release(index)
+        self.__enable(index)
+        while not self.handle.have_piece(index):
+            self.__wait(1)
+        self.handle.read_piece(index)
+        while index not in self.__pieces:
+            self.__wait(1)
+        self.__piece = (index, self.__pieces.pop(index))
+        return self.__piece[1]
+
+    def __enable(self, index: int) -> None:
+        # Let pieces up to a window past `index` download
+        last = min(index + self.window, self.info.num_pieces())
+        for piece in range(self.__enabled, last):
+            self.handle.piece_priority(piece, 4)
+        self.__enabled = max(self.__enabled, last)
+
+    def __release(self, index: int) -> None:
+        # Free the disk space of the pieces before `index`, all read by now
+        files = self.files()
+        for piece in range(self.__released, index):
+            for part in self.info.map_block(piece, 0, self.info.piece_size(piece)):
+                if not files.file_flags(part.file_index) & lt.file_storage.flag_pad_file:
+                    punch_hole(os.path.join(self.save_path, files.file_path(part.file_index)), part.offset, part.size)
+        self.__released = max(self.__released, index)
+
+    def __wait(self, timeout: float) -> None:
+        # Handle alerts for up to `timeout` seconds and watch for stalls
+        if self.session.wait_for_alert(int(timeout * 1000)) is not None:
+            for alert in self.session.pop_alerts():
+                if isinstance(alert, lt.read_piece_alert):
+                    if alert.error.value():
+                        raise Exception(f"Could not read piece {alert.piece}: {alert.error.message()}")
+                    self.__pieces[alert.piece] = alert.buffer
+                elif isinstance(alert, lt.torrent_error_alert):
+                    raise Exception(f"Torrent error: {alert.message()}")
+
+        status = self.handle.status()
+        now = time.monotonic()
+        if status.total_done != self.__done:
+            self.__done = status.total_done
+            self.__progress_at = now
+        elif now - self.__progress_at > self.max_wait:
+            if status.num_seeds == 0 and not self.__done:
+                raise Exception("No seeders available after waiting. The link may be dead.")
+            raise Exception("Download stalled with no progress. Please try again later.")
+
+        if self.status_callback and now - self.__reported >= 5:
+            self.__reported = now
+            done = f"{status.total_done / self.size * 100:.1f}%" if self.size else "waiting for metadata"
+            self.status_callback(f"Downloading: {done} ({status.download_rate / 1024:.1f} KB/s) | Seeds: {status.num_seeds}")
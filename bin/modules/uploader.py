@@ -1,103 +1,207 @@
 import os
+import asyncio
+import hashlib
 import threading
 import logging
-from bin.modules.db_manager import DBManager
-from bin.modules.file_manager import FileManager
+from bin.modules.async_engine import AsyncTransferEngine, transfer_engine
+from bin.modules.bot_pool import bot_pool
+from bin.modules.chunk_codec import chunk_codec
+from bin.modules.chunk_scheduler import ChunkScheduler
+from bin.modules.db_manager import db
+from bin.modules.file_manager import FileManager, hash_mode
+from bin.modules.metrics import active_transfers
 from bin.modules.telegram_bot import TelegramBot
-from bin.modules.utils import split_chunks
 
 # Configure logging
-logging.basicConfig(level=logging.DEBUG, format='%(asctime)s - %(levelname)s - %(message)s')
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
-db = DBManager()
 fm = FileManager()
 lock = threading.Lock()
 
 class Uploader:
-    def __init__(self, file_path: str):
+    def __init__(self, file_path: str, progress_callback=None, stream=None, size: int = None):
         self.file_path = file_path
+        # Without a stream the file at file_path is uploaded. With one, the
+        # content is read from it instead and file_path only names the upload;
+        # `size` is the expected size, for progress.
+        self.stream = stream
+        self.size = size
+        # Called with a dict of progress details after every chunk
+        self.progress_callback = progress_callback
         self.t_bots = []
+        self.file_size = 0
         self.chunks_total = 0
         self.uploaded_chunks_counter = 0
+        self.uploaded_bytes = 0
+        self.bytes_read = 0
+        self.bot_chunks = {}
+        self.uploaded_chunks = []
+        self.deduplicated_chunks_counter = 0
+        self.resumed_chunks_counter = 0
+        # Checkpoint of this upload in the transfers table
+        self.transfer_id = None
+        # Chunks waiting for a free bot worker; together with the buffers the
+        # workers are sending this caps the memory held by a transfer.
+        self.max_queued_chunks = 2
 
+    @active_transfers.labels("upload").track_inprogress()
     def run(self, user_id: int):
         filename = os.path.basename(self.file_path)
-        file_size = fm.get_file_size(self.file_path)
+        if self.stream is None:
+            file_size = self.file_size = fm.get_file_size(self.file_path)
+        else:
+            file_size = self.file_size = self.size or 0
         total_file_size = round(file_size / (1024 * 1024))  # in MB
         logging.info(f"Uploading file: {filename} ({total_file_size} MB)")
 
-        # Initialize Telegram bots from DB
-        for obj in db.get_bots():
-            bot = TelegramBot(obj[2], obj[3])
-            self.t_bots.append(bot)
-        logging.info(f"Initialized {len(self.t_bots)} Telegram bots")
-
-        # Calculate file hash
-        gen, hasher = fm.get_file_hash(self.file_path)
-        for _ in gen:
-            pass
-        file_hash = hasher.hexdigest()
-        # Pass user_id to add_file
-        db.add_file(user_id, filename, file_hash)
-        logging.info(f"File hash: {file_hash}")
+        # Telegram bots come from the shared pool
+        self.t_bots = bot_pool.get_bots()
+        if not self.t_bots:
+            raise Exception("No Telegram bots configured.")
 
-        # Split file into chunks and save them
-        for _ in fm.process_file(self.file_path):
-            pass
-        logging.info("File split into chunks")
+        # Chunks are checkpointed as Telegram accepts them. Running the same
+        # file again (same path, size and mtime) after a failure or a crash
+        # continues this transfer, and only chunks not sent yet are sent.
+        # Streams have no mtime; their path names the content instead.
+        file_path = os.path.abspath(self.file_path)
+        version = os.stat(file_path).st_mtime_ns if self.stream is None else "stream"
+        key = f"{user_id}:{file_path}:{file_size}:{version}"
+        self.transfer_id, resumed = db.begin_transfer("upload", key, user_id, file_path, file_size)
+        if resumed:
+            logging.info(f"Resuming upload {self.transfer_id}")
 
-        # Get list of split chunk filenames
-        all_chunks = fm.get_split_chunks()
-        self.chunks_total = len(all_chunks)
+        # Bots start sending as soon as the first chunk is read, while the
+        # rest of the file is still being read. In tree mode the file hash
+        # comes from the chunk digests the workers compute anyway, so only
+        # md5 mode hashes the whole file on this thread. Failed chunks are
+        # retried until their deadline; if any is still missing the upload
+        # raises before the file is recorded and can be resumed.
+        hasher = hashlib.md5() if hash_mode == "md5" else None
+        if transfer_engine == "async":
+            engine = AsyncTransferEngine(self.t_bots, max_queued=self.max_queued_chunks, operation="send")
+            engine.map(self.async_bot_upload, self.read_chunks(hasher))
+        else:
+            scheduler = ChunkScheduler(self.t_bots, max_queued=self.max_queued_chunks, operation="send")
+            scheduler.map(self.bot_upload, self.read_chunks(hasher))
         logging.info(f"Total chunks: {self.chunks_total}")
+        if self.stream is not None:
+            # Only known now that the stream has ended
+            file_size = self.file_size = self.bytes_read
+
+        # The file hash is only known once the last chunk has been read
+        if hasher is not None:
+            file_hash = hasher.hexdigest()
+        else:
+            file_hash = fm.tree_hash([chunk[1] for chunk in sorted(self.uploaded_chunks)])
+        logging.info(f"File hash: {file_hash}")
+        logging.info(f"Chunks reused from earlier uploads: {self.deduplicated_chunks_counter}")
+        logging.info(f"Chunks sent before the upload was resumed: {self.resumed_chunks_counter}")
 
-        # Split chunks among bots
-        chunk_groups = split_chunks(all_chunks, len(self.t_bots))
-        threads = []
-        for i, chunks in enumerate(chunk_groups):
-            thread = threading.Thread(target=self.bot_upload, args=(file_hash, chunks, self.t_bots[i]))
-            threads.append(thread)
-            thread.start()
-        for thread in threads:
-            thread.join()
+        # The files row, its chunk rows and the end of the transfer are one
+        # transaction. Identical content uploaded before (by anyone) already
+        # has its chunk rows; the new files row simply points at them.
+        try:
+            db.add_file_with_chunks(user_id, filename, file_hash, file_size, [
+                (chunk_file_hash, chunk_index, chunk_file_id, chunk_size, codec)
+                for chunk_index, chunk_file_hash, chunk_file_id, chunk_size, codec in sorted(self.uploaded_chunks)
+            ], self.transfer_id)
+        except Exception:
+            # Nothing to resume when the user already has this file
+            if db.get_file(user_id, file_hash) is not None:
+                db.delete_transfer(self.transfer_id)
+            raise
+        logging.info(f"Added {len(self.uploaded_chunks)} chunks to DB")
 
         # Delete the original file from TEMP folder after uploading
+        if self.stream is not None:
+            return
         try:
             os.remove(self.file_path)
             logging.info(f"Deleted original file from TEMP folder: {self.file_path}")
         except Exception as e:
             logging.error(f"Error deleting original file from TEMP folder: {e}")
 
-    def bot_upload(self, file_hash: str, chunks: list, bot: TelegramBot):
-        for chunk in chunks:
-            chunk_path = os.path.join(fm.split_chunks, chunk)
-            logging.info(f"Uploading chunk: {chunk_path}")
-
-            # Send chunk using Telegram bot and get a file ID
-            try:
-                chunk_file_id = bot.send_document(chunk_path)
-                logging.info(f"Uploaded chunk to Telegram: {chunk_file_id}")
-            except Exception as e:
-                logging.error(f"Error uploading chunk to Telegram: {e}")
-                continue
-
-            gen, hasher = fm.get_file_hash(chunk_path)
-            for _ in gen:
-                pass
-            chunk_file_hash = hasher.hexdigest()
-
-            try:
-                lock.acquire(True)
-                db.add_chunk(file_hash, chunk_file_hash, chunk.split("_")[1], chunk_file_id)
-                self.uploaded_chunks_counter += 1
-                logging.info(f"Chunk added to DB: {chunk_file_hash}")
-            except Exception as e:
-                logging.error(f"Error adding chunk to DB: {e}")
-            finally:
-                lock.release()
-
-            try:
-                os.remove(chunk_path)
-                logging.info(f"Deleted chunk file: {chunk_path}")
-            except Exception as e:
-                logging.error(f"Error deleting chunk file: {e}")
+    def read_chunks(self, hasher):
+        if self.stream is None:
+            chunks = fm.read_chunks(self.file_path, hasher)
+        else:
+            chunks = fm.read_stream(self.stream, hasher)
+        for chunk_index, data in chunks:
+            self.chunks_total += 1
+            self.bytes_read += len(data)
+            yield chunk_index, data
+
+    def bot_upload(self, item: tuple, bot: TelegramBot):
+        chunk_index, data = item
+        chunk_file_hash = hashlib.md5(data).hexdigest()
+        if self.reuse_stored_chunk(chunk_index, chunk_file_hash, len(data)):
+            return
+        logging.debug("Uploading chunk %s: %s", chunk_index, chunk_file_hash)
+        # Compression runs here on the worker threads, in parallel
+        codec, payload = chunk_codec.encode(data)
+
+        # Send chunk using Telegram bot and get a file ID; errors go back to
+        # the scheduler, which retries the chunk
+        chunk_file_id = bot.send_document(payload, f"{chunk_file_hash}.chunk")
+        logging.debug("Uploaded chunk to Telegram: %s", chunk_file_id)
+        self.chunk_sent(chunk_index, chunk_file_hash, chunk_file_id, len(data), codec, bot.name)
+
+    async def async_bot_upload(self, item: tuple, bot):
+        chunk_index, data = item
+        loop = asyncio.get_running_loop()
+        # hashlib releases the GIL on large buffers, so hash off the loop;
+        # SQLite calls and progress callbacks block, so they run there too
+        chunk_file_hash = (await loop.run_in_executor(None, hashlib.md5, data)).hexdigest()
+        if await loop.run_in_executor(None, self.reuse_stored_chunk, chunk_index, chunk_file_hash, len(data)):
+            return
+        logging.debug("Uploading chunk %s: %s", chunk_index, chunk_file_hash)
+        codec, payload = await loop.run_in_executor(None, chunk_codec.encode, data)
+
+        chunk_file_id = await bot.send_document(payload, f"{chunk_file_hash}.chunk")
+        logging.debug("Uploaded chunk to Telegram: %s", chunk_file_id)
+        await loop.run_in_executor(None, self.chunk_sent, chunk_index, chunk_file_hash, chunk_file_id, len(data), codec, bot.name)
+
+    def chunk_sent(self, chunk_index: int, chunk_file_hash: str, chunk_file_id: str, chunk_size: int, codec: str | None, source: str):
+        db.set_transfer_chunk(self.transfer_id, chunk_index, chunk_file_hash, "sent", chunk_file_id, chunk_size, codec)
+        self.add_uploaded_chunk(chunk_index, chunk_file_hash, chunk_file_id, chunk_size, codec, source)
+
+    def reuse_stored_chunk(self, chunk_index: int, chunk_file_hash: str, chunk_size: int) -> bool:
+        # A chunk with the same content is already on Telegram: reuse its
+        # file_id instead of sending it again. That includes chunks sent by
+        # an upload that has not finished, such as this one before a crash.
+        stored = db.get_stored_chunk(chunk_file_hash)
+        if stored is not None:
+            logging.debug("Chunk %s already stored: %s", chunk_index, stored[0])
+            self.add_uploaded_chunk(chunk_index, chunk_file_hash, stored[0], chunk_size, stored[2], "reused")
+            with lock:
+                self.deduplicated_chunks_counter += 1
+            return True
+        sent = db.get_sent_chunk(chunk_file_hash)
+        if sent is not None:
+            logging.debug("Chunk %s already sent: %s", chunk_index, sent[0])
+            db.set_transfer_chunk(self.transfer_id, chunk_index, chunk_file_hash, "sent", sent[0], chunk_size, sent[2])
+            self.add_uploaded_chunk(chunk_index, chunk_file_hash, sent[0], chunk_size, sent[2], "resumed")
+            with lock:
+                self.resumed_chunks_counter += 1
+            return True
+        return False
+
+    def add_uploaded_chunk(self, chunk_index: int, chunk_file_hash: str, chunk_file_id: str, chunk_size: int, codec: str | None, source: str):
+        with lock:
+            self.uploaded_chunks.append((chunk_index, chunk_file_hash, chunk_file_id, chunk_size, codec))
+            self.uploaded_chunks_counter += 1
+            self.uploaded_bytes += chunk_size
+            self.bot_chunks[source] = self.bot_chunks.get(source, 0) + 1
+            progress = self.get_progress()
+        if self.progress_callback:
+            self.progress_callback(progress)
+
+    def get_progress(self) -> dict:
+        return {
+            "stage": "upload",
+            "bytes_done": self.uploaded_bytes,
+            "bytes_total": self.file_size,
+            "chunks_done": self.uploaded_chunks_counter,
+            "chunks_total": self.chunks_total,
+            "bots": dict(self.bot_chunks),
+        }
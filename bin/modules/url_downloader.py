@@ -5,8 +5,16 @@ import libtorrent as lt
 import time
 import shutil
 import zipfile
+import uuid
+from bin.modules.chunk_codec import chunk_codec
+from bin.modules.segmented_download import SegmentedDownload
+from bin.modules.torrent_stream import TorrentStream
 from urllib.parse import urlparse, unquote
 
+# "stream" sends torrents to Telegram while they download, as a zip built
+# from finished pieces; "zip" downloads the whole torrent and zips it first
+torrent_ingest = os.getenv("TORRENT_INGEST", "stream")
+
 class URLDownloader:
     def __init__(self, base_path="TEMP"):
         self.base_path = base_path
@@ -31,28 +39,13 @@ class URLDownloader:
         local_path = os.path.join(self.base_path, filename)
         
         # Check if URL is a magnet link or torrent
-        if url.startswith('magnet:') or url.endswith('.torrent'):
+        if self.is_torrent(url):
             return self.download_torrent(url, local_path, progress_callback)
         
-        # Regular HTTP download
+        # Regular HTTP download, over several connections when the server
+        # supports ranges
         try:
-            # Stream the download to support large files
-            with requests.get(url, stream=True) as response:
-                response.raise_for_status()
-                total_size = int(response.headers.get('content-length', 0))
-                bytes_downloaded = 0
-                
-                with open(local_path, 'wb') as f:
-                    for chunk in response.iter_content(chunk_size=8192):
-                        if chunk:
-                            f.write(chunk)
-                            bytes_downloaded += len(chunk)
-                            
-                            # Report progress if callback provided
-                            if progress_callback and total_size:
-                                progress = (bytes_downloaded / total_size) * 100
-                                progress_callback(progress)
-                
+            SegmentedDownload(url, local_path, progress_callback).run()
             logging.info(f"Downloaded file to {local_path}")
             return local_path
         
@@ -60,27 +53,18 @@ class URLDownloader:
             logging.error(f"Error downloading from URL: {e}")
             raise
     
-    def download_torrent(self, torrent_url, destination_path, progress_callback=None):
-        """Download a file from a torrent or magnet link"""
-        logging.info(f"Downloading from torrent: {torrent_url}")
-        
-        # Create a session with default settings
-        ses = lt.session()
-        ses.listen_on(6881, 6891)  # Listen on ports between 6881-6891
-        
-        # Create temporary directory
-        temp_download_dir = os.path.join(self.base_path, 'torrent_temp')
-        if not os.path.exists(temp_download_dir):
-            os.makedirs(temp_download_dir)
-        
-        # Add the torrent
+    def is_torrent(self, url):
+        return url.startswith('magnet:') or url.endswith('.torrent')
+
+    def add_torrent(self, ses, torrent_url, save_path):
+        """Add a torrent or magnet link to a session; returns (handle, name)"""
         handle = None
         torrent_name = None
         
         try:
             if torrent_url.startswith('magnet:'):
                 # For magnet links
-                handle = ses.add_torrent({'url': torrent_url, 'save_path': temp_download_dir})
+                handle = ses.add_torrent({'url': torrent_url, 'save_path': save_path})
                 # Extract torrent name from magnet link if possible
                 if 'dn=' in torrent_url:
                     torrent_name = unquote(torrent_url.split('dn=')[1].split('&')[0])
@@ -90,7 +74,7 @@ class URLDownloader:
                 torrent_data = response.content
                 info = lt.torrent_info(lt.bdecode(torrent_data))
                 torrent_name = info.name()
-                handle = ses.add_torrent({'ti': info, 'save_path': temp_download_dir})
+                handle = ses.add_torrent({'ti': info, 'save_path': save_path})
                 
             # If no name found, create a generic one
             if not torrent_name:
@@ -101,6 +85,59 @@ class URLDownloader:
             logging.error(f"Error adding torrent: {e}")
             raise
         
+        return handle, torrent_name
+
+    def safe_name(self, torrent_name):
+        # Ensure we have a valid filename for the zip
+        safe_torrent_name = ''.join(c for c in torrent_name if c.isalnum() or c in ' ._-')
+        if not safe_torrent_name:
+            safe_torrent_name = f"torrent_{int(time.time())}"
+        return safe_torrent_name
+
+    def open_torrent_stream(self, torrent_url, status_callback=None):
+        """Start a torrent and return a TorrentStream of its files as a zip,
+        readable while the torrent downloads"""
+        logging.info(f"Streaming from torrent: {torrent_url}")
+        
+        # Alerts wake the stream when pieces finish or are read back. Pieces
+        # are deleted once read, so peers are never unchoked to ask for them.
+        # With the whole window downloaded the torrent looks finished; its
+        # connections to seeds are kept for the pieces enabled next.
+        ses = lt.session({'alert_mask': lt.alert_category.error | lt.alert_category.status
+                          | lt.alert_category.storage | lt.alert_category.piece_progress,
+                          'unchoke_slots_limit': 0, 'allowed_fast_set_size': 0,
+                          'close_redundant_connections': False})
+        ses.listen_on(6881, 6891)  # Listen on ports between 6881-6891
+        
+        # Every stream gets its own directory, removed when it is closed
+        save_path = os.path.join(self.base_path, 'torrent_streams', uuid.uuid4().hex)
+        os.makedirs(save_path)
+        
+        try:
+            handle, torrent_name = self.add_torrent(ses, torrent_url, save_path)
+            stream = TorrentStream(ses, handle, f"{self.safe_name(torrent_name)}.zip", save_path, status_callback)
+            stream.start()
+        except Exception:
+            shutil.rmtree(save_path, ignore_errors=True)
+            raise
+        return stream
+
+    def download_torrent(self, torrent_url, destination_path, progress_callback=None):
+        """Download a file from a torrent or magnet link"""
+        logging.info(f"Downloading from torrent: {torrent_url}")
+        
+        # Create a session with default settings
+        ses = lt.session()
+        ses.listen_on(6881, 6891)  # Listen on ports between 6881-6891
+        
+        # Create temporary directory
+        temp_download_dir = os.path.join(self.base_path, 'torrent_temp')
+        if not os.path.exists(temp_download_dir):
+            os.makedirs(temp_download_dir)
+        
+        # Add the torrent
+        handle, torrent_name = self.add_torrent(ses, torrent_url, temp_download_dir)
+        
         # Check for seeders and download status
         max_wait_time = 300  # 5 minutes max wait for seeders
         start_time = time.time()
@@ -144,7 +181,7 @@ class URLDownloader:
                 download_speed = status.download_rate / 1024  # KB/s
                 
                 status_message = f"Downloading: {progress:.1f}% ({download_speed:.1f} KB/s) | Seeds: {status.num_seeds}"
-                progress_callback(progress, status_message=status_message)
+                progress_callback(progress, status_message=status_message, bytes_done=status.total_wanted_done, bytes_total=status.total_wanted)
             
             logging.info(f"Torrent progress: {status.progress * 100:.2f}% | Seeds: {status.num_seeds}")
             time.sleep(1)
@@ -154,10 +191,7 @@ class URLDownloader:
         # Prepare the final path - in case it's a directory
         torrent_contents = os.listdir(temp_download_dir)
         
-        # Ensure we have a valid filename for the zip
-        safe_torrent_name = ''.join(c for c in torrent_name if c.isalnum() or c in ' ._-')
-        if not safe_torrent_name:
-            safe_torrent_name = f"torrent_{int(time.time())}"
+        safe_torrent_name = self.safe_name(torrent_name)
             
         # If original destination path doesn't end with .zip, add it
         if not destination_path.lower().endswith('.zip'):
@@ -167,7 +201,11 @@ class URLDownloader:
         
         # Create a zip file with all content (even if it's just one file)
         try:
-            with zipfile.ZipFile(zip_path, 'w', zipfile.ZIP_DEFLATED) as zipf:
+            # With a chunk codec configured, compressible content is
+            # compressed per chunk later on; deflating here as well would
+            # only burn CPU on media that does not shrink.
+            compression = zipfile.ZIP_STORED if chunk_codec.name != "none" else zipfile.ZIP_DEFLATED
+            with zipfile.ZipFile(zip_path, 'w', compression) as zipf:
                 for item in torrent_contents:
                     item_path = os.path.join(temp_download_dir, item)
                     if os.path.isfile(item_path):
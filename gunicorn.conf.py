@@ -0,0 +1,23 @@
+# Read by gunicorn from the working directory; the Procfile sets the worker
+# class and threads.
+import os
+import shutil
+import tempfile
+
+# Workers write their metrics here and /metrics merges them. This has to be
+# set before any worker imports prometheus_client.
+os.environ.setdefault("PROMETHEUS_MULTIPROC_DIR", os.path.join(tempfile.gettempdir(), "clouddrive_metrics"))
+
+def on_starting(server):
+    # Values left by a previous run would be counted again
+    path = os.environ["PROMETHEUS_MULTIPROC_DIR"]
+    shutil.rmtree(path, ignore_errors=True)
+    os.makedirs(path, exist_ok=True)
+
+def child_exit(server, worker):
+    # Drop the live gauges of a worker that exited
+    try:
+        from prometheus_client import multiprocess
+    except ImportError:
+        return
+    multiprocess.mark_process_dead(worker.pid)